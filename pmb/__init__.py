@@ -6,11 +6,11 @@ import logging
 import os
 import traceback
 
+# Keep imports here to a minimum, everything imported here (and in pmb.parse)
+# gets loaded for tab completion and 'pmbootstrap --help' too. The subsystems
+# are imported in main() and by the actions in pmb/helpers/frontend.py.
 from . import config
 from . import parse
-from .config import init as config_init
-from .helpers import frontend
-from .helpers import logging as pmb_logging
 from .helpers import mount
 from .helpers import other
 
@@ -44,6 +44,7 @@ def main():
 
         # Initialize or require config
         if args.action == "init":
+            from .config import init as config_init
             return config_init.frontend(args)
         elif not os.path.exists(args.config):
             raise RuntimeError("Please specify a config file, or run"
@@ -60,6 +61,7 @@ def main():
 
         # Run the function with the action's name (in pmb/helpers/frontend.py)
         if args.action:
+            from .helpers import frontend
             getattr(frontend, args.action)(args)
         else:
             logging.info("Run pmbootstrap -h for usage information.")
@@ -99,6 +101,11 @@ def main():
         print(f"Your version: {__version__}")
         return 1
 
+    finally:
+        if args and other.cache.get("pmb.chroot.cgroup"):
+            from .chroot import cgroup
+            cgroup.finish(args)
+
 
 if __name__ == "__main__":
     sys.exit(main())
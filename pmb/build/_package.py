@@ -8,6 +8,7 @@ import pmb.build
 import pmb.build.autodetect
 import pmb.chroot
 import pmb.chroot.apk
+import pmb.helpers.manifest
 import pmb.helpers.pmaports
 import pmb.helpers.repo
 import pmb.parse
@@ -212,17 +213,22 @@ def init_buildenv(args, apkbuild, arch, strict=False, force=False, cross=None,
         return False
 
     # Install and configure abuild, ccache, gcc, dependencies
+    packages = []
     if not skip_init_buildenv:
         pmb.build.init(args, suffix)
         pmb.build.other.configure_abuild(args, suffix)
         if args.ccache:
             pmb.build.other.configure_ccache(args, suffix)
             if "rust" in depends or "cargo" in depends:
-                pmb.chroot.apk.install(args, ["sccache"], suffix)
+                packages += ["sccache"]
     if not strict and "pmb:strict" not in apkbuild["options"] and len(depends):
-        pmb.chroot.apk.install(args, depends, suffix)
+        packages += depends
     if src:
-        pmb.chroot.apk.install(args, ["rsync"], suffix)
+        packages += ["rsync"]
+
+    # Install them in one apk transaction
+    if packages:
+        pmb.chroot.apk.install(args, packages, suffix)
 
     # Cross-compiler init
     if cross:
@@ -456,6 +462,15 @@ def finish(args, apkbuild, arch, output, strict=False, suffix="native"):
     # package we need to parse it again)
     pmb.parse.apkindex.clear_cache(f"{args.work}/packages/{channel}"
                                    f"/{arch}/APKINDEX.tar.gz")
+    pmb.helpers.manifest.clear_cache()
+
+    # Remember which aport the package was built from in the manifest
+    aport = pmb.helpers.pmaports.find(args, apkbuild["pkgname"], False)
+    if aport:
+        version = f"{apkbuild['pkgver']}-r{apkbuild['pkgrel']}"
+        aport_hash = pmb.helpers.manifest.get_aport_hash(aport)
+        pmb.helpers.manifest.set_aport_hash(args, arch, apkbuild["pkgname"],
+                                            version, aport_hash)
 
     # Uninstall build dependencies (strict mode)
     if strict or "pmb:strict" in apkbuild["options"]:
@@ -40,11 +40,11 @@ def init(args, suffix="native"):
     if os.path.exists(marker):
         return
 
-    init_abuild_minimal(args, suffix)
-
-    # Initialize chroot, install packages
+    # Initialize chroot, install packages (including abuild, so
+    # init_abuild_minimal() does not need another apk transaction)
     pmb.chroot.apk.install(args, pmb.config.build_packages, suffix,
                            build=False)
+    init_abuild_minimal(args, suffix)
 
     # Generate package signing keys
     chroot = args.work + "/chroot_" + suffix
@@ -9,6 +9,7 @@ import datetime
 import pmb.chroot
 import pmb.helpers.file
 import pmb.helpers.git
+import pmb.helpers.manifest
 import pmb.helpers.pmaports
 import pmb.helpers.run
 import pmb.parse.apkindex
@@ -127,6 +128,8 @@ def index_repo(args, arch=None):
         else:
             logging.debug("NOTE: Can't build index for: " + path)
         pmb.parse.apkindex.clear_cache(f"{path}/APKINDEX.tar.gz")
+    pmb.helpers.manifest.clear_cache()
+    pmb.helpers.manifest.sync(args, arch)
 
 
 def configure_abuild(args, suffix, verify=False):
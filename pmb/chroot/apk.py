@@ -2,17 +2,43 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import os
 import logging
+import re
 import shlex
+import threading
 
 import pmb.chroot
+import pmb.chroot.apk_fetch
+import pmb.chroot.apk_store
 import pmb.config
+import pmb.config.pmaports
 import pmb.helpers.apk
+import pmb.helpers.manifest
 import pmb.helpers.pmaports
 import pmb.parse.apkindex
 import pmb.parse.arch
 import pmb.parse.depends
 import pmb.parse.version
 
+# Locks of the chroots, see get_lock()
+locks = {}
+locks_lock = threading.Lock()
+
+
+def get_lock(suffix):
+    """
+    Get the lock of a chroot, held while initializing it and while updating
+    what pmbootstrap caches about it (repository list, checked apk version).
+    Commands running in the chroot (apk, mkinitfs) run without it, so threads
+    working in different chroots (see pmb.install._install
+    .create_device_rootfs()) run in parallel. Reentrant, because initializing
+    a chroot runs commands in it, which initialize it again.
+
+    :param suffix: the chroot suffix, e.g. "native" or "rootfs_qemu-amd64"
+    :returns: threading.RLock of the chroot
+    """
+    with locks_lock:
+        return locks.setdefault(suffix, threading.RLock())
+
 
 def update_repository_list(args, suffix="native", check=False):
     """
@@ -146,15 +172,19 @@ def packages_get_locally_built_apks(args, packages, arch):
               ["/mnt/pmbootstrap/packages/x86_64/hello-world-1-r6.apk", ...]
     """
     channel = pmb.config.pmaports.read_config(args)["channel"]
+    local = {(row["pkgname"], row["version"])
+             for row in pmb.helpers.manifest.packages(args, arch)}
     ret = []
 
     for package in packages:
         data_repo = pmb.parse.apkindex.package(args, package, arch, False)
-        if not data_repo:
+        if not data_repo or (package, data_repo["version"]) not in local:
             continue
 
+        # The manifest is cached, the apk may have been removed since then
         apk_file = f"{package}-{data_repo['version']}.apk"
-        if not os.path.exists(f"{args.work}/packages/{channel}/{arch}/{apk_file}"):
+        if not os.path.exists(f"{args.work}/packages/{channel}/{arch}/"
+                              f"{apk_file}"):
             continue
 
         ret.append(f"/mnt/pmbootstrap/packages/{arch}/{apk_file}")
@@ -162,11 +192,37 @@ def packages_get_locally_built_apks(args, packages, arch):
     return ret
 
 
+def world_name(dependency):
+    """
+    :param dependency: entry of /etc/apk/world, e.g. "!osk-sdl",
+                       "hello-world>=1.0" or "hello-world><Q1..."
+    :returns: the pkgname, e.g. "osk-sdl" or "hello-world"
+    """
+    return re.split("[<>=~]", dependency.lstrip("!"), 1)[0]
+
+
+def world_read(args, suffix):
+    """
+    :returns: list of entries in the chroot's /etc/apk/world
+    """
+    path = f"{args.work}/chroot_{suffix}/etc/apk/world"
+    if not os.path.exists(path):
+        return []
+    with open(path) as handle:
+        return handle.read().split()
+
+
 def install_run_apk(args, to_add, to_add_local, to_del, suffix):
     """
     Run apk to add packages, and ensure only the desired packages get
     explicitly marked as installed.
 
+    Packages from the repositories get added in one apk transaction, so apk
+    only needs to lock and load its database once. Locally built packages
+    get upgraded in a second transaction, so '-u' does not upgrade the other
+    packages too. Afterwards /etc/apk/world gets fixed up, because apk marks
+    the local packages and conflicts as explicitly installed.
+
     :param to_add: list of pkgnames to install, without their dependencies
     :param to_add_local: return of packages_get_locally_built_apks()
     :param to_del: list of pkgnames to be deleted, this should be set to
@@ -180,33 +236,32 @@ def install_run_apk(args, to_add, to_add_local, to_del, suffix):
         if package.startswith("-"):
             raise ValueError(f"Invalid package name: {package}")
 
-    commands = [["add"] + to_add]
+    # World after the transaction: to_add gets explicitly installed, to_del
+    # removed, local packages are only installed as dependencies
+    world = [dep for dep in world_read(args, suffix)
+             if world_name(dep) not in to_del + to_add]
+    world = sorted(world + to_add)
 
-    # Use a virtual package to mark only the explicitly requested packages as
-    # explicitly installed, not the ones in to_add_local
-    if to_add_local:
-        commands += [["add", "-u", "--virtual", ".pmbootstrap"] + to_add_local,
-                     ["del", ".pmbootstrap"]]
+    commands = [["add"] + to_add + [f"!{package}" for package in to_del]]
 
-    if to_del:
-        commands += [["del"] + to_del]
+    # Upgrade to the local packages, even if pkgver and pkgrel did not change
+    if to_add_local:
+        commands += [["add", "-u"] + to_add_local]
 
-    for (i, command) in enumerate(commands):
-        # --no-interactive is a parameter to `add`, so it must be appended or apk
-        # gets confused
+    for command in commands:
+        # --no-interactive is a parameter to `add`, so it must be appended or
+        # apk gets confused
         command += ["--no-interactive"]
-
         if args.offline:
             command = ["--no-network"] + command
-        if i == 0:
-            pmb.helpers.apk.apk_with_progress(args, ["apk"] + command,
-                                              chroot=True, suffix=suffix)
-        else:
-            # Virtual package related commands don't actually install or remove
-            # packages, but only mark the right ones as explicitly installed.
-            # They finish up almost instantly, so don't display a progress bar.
-            pmb.chroot.root(args, ["apk", "--no-progress"] + command,
-                            suffix=suffix)
+        pmb.helpers.apk.apk_with_progress(args, ["apk"] + command,
+                                          chroot=True, suffix=suffix)
+
+    if to_add_local or to_del:
+        world_quoted = " ".join(shlex.quote(dep) for dep in world)
+        pmb.chroot.root(args, ["sh", "-c", "printf '%s\\n' "
+                               f"{world_quoted} > /etc/apk/world"],
+                        suffix=suffix)
 
 
 def install(args, packages, suffix="native", build=True):
@@ -225,13 +280,14 @@ def install(args, packages, suffix="native", build=True):
     arch = pmb.parse.arch.from_chroot_suffix(args, suffix)
 
     if not packages:
-        logging.verbose("pmb.chroot.apk.install called with empty packages list,"
-                        " ignoring")
+        logging.verbose("pmb.chroot.apk.install called with empty"
+                        " packages list, ignoring")
         return
 
     # Initialize chroot
-    check_min_version(args, suffix)
-    pmb.chroot.init(args, suffix)
+    with get_lock(suffix):
+        check_min_version(args, suffix)
+        pmb.chroot.init(args, suffix)
 
     packages_with_depends = pmb.parse.depends.recurse(args, packages, suffix)
     to_add, to_del = packages_split_to_add_del(packages_with_depends)
@@ -243,8 +299,23 @@ def install(args, packages, suffix="native", build=True):
     to_add_local = packages_get_locally_built_apks(args, to_add, arch)
     to_add_no_deps, _ = packages_split_to_add_del(packages)
 
+    # Nothing to do: don't wait for apk to load its database. The world
+    # file alone is not enough, packages in it may not be installed (e.g.
+    # after an aborted apk transaction).
+    world = [world_name(dep) for dep in world_read(args, suffix)]
+    packages_installed = installed(args, suffix)
+    if not to_add_local and not to_del and \
+            all(package in world for package in to_add_no_deps) and \
+            all(package in packages_installed for package in to_add):
+        logging.verbose(f"({suffix}) already installed:"
+                        f" {' '.join(to_add_no_deps)}")
+        return
+
     logging.info(f"({suffix}) install {' '.join(to_add_no_deps)}")
+    pmb.chroot.apk_store.link_to_cache(args, arch, to_add)
+    pmb.chroot.apk_fetch.download(args, to_add, suffix, packages_installed)
     install_run_apk(args, to_add_no_deps, to_add_local, to_del, suffix)
+    pmb.chroot.apk_store.add_from_cache(args, arch)
 
 
 def installed(args, suffix="native"):
@@ -263,4 +334,4 @@ def installed(args, suffix="native"):
               }
     """
     path = f"{args.work}/chroot_{suffix}/lib/apk/db/installed"
-    return pmb.parse.apkindex.parse(path, False)
+    return pmb.parse.apkindex.parse_db(path)
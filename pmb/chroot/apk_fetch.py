@@ -0,0 +1,158 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Download the packages that "apk add" is about to install in parallel, into
+$WORK/cache_apk_{arch} (the chroots' /var/cache/apk). apk would download them
+one after another, which is slow over high-latency connections. apk then
+finds the packages in its cache and only installs them. Packages that fail
+to download here are left to apk.
+"""
+import base64
+import concurrent.futures
+import hashlib
+import http.client
+import logging
+import os
+import zlib
+
+import pmb.chroot.apk_store
+import pmb.config
+import pmb.helpers.cli
+import pmb.helpers.http
+import pmb.helpers.repo
+import pmb.helpers.run
+import pmb.parse.apkindex
+import pmb.parse.arch
+
+
+def verify(path, checksum):
+    """ Check an apk file against the checksum from the APKINDEX. It is the
+        SHA1 of the compressed control segment, which is the first gzip
+        stream in the file, or the second one if the package is signed.
+
+        The file gets read in chunks (like pmb.helpers.manifest.get_sha256()),
+        and only up to the end of the control segment.
+
+        :param checksum: the "C:" field of the APKINDEX, e.g.
+                         "Q1XaZzCVZ9mvH8djPyEb5aUYhG3r4="
+        :returns: True if the checksum matches """
+    expected = base64.b64decode(checksum[2:])
+    with open(path, "rb") as handle:
+        chunks = iter(lambda: handle.read(1024 * 1024), b"")
+        data = b""
+        for _ in range(2):
+            sha1 = hashlib.sha1()
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            while not decompressor.eof:
+                data = data or next(chunks, b"")
+                if not data:
+                    return False
+                try:
+                    decompressor.decompress(data)
+                except zlib.error:
+                    return False
+                sha1.update(data[:len(data) - len(decompressor.unused_data)])
+                data = decompressor.unused_data
+            if sha1.digest() == expected:
+                return True
+    return False
+
+
+def get_downloads(args, pkgnames, arch, installed):
+    """ Find the packages that need to be downloaded.
+
+        :param pkgnames: list of pkgnames (including all dependencies)
+        :param installed: the installed packages of the chroot, from
+                          pmb.chroot.apk.installed()
+        :returns: list of (url, cache_name, checksum) tuples, e.g.:
+                  [("http://dl-cdn.alpinelinux.org/alpine/edge/main/x86_64/"
+                    "musl-1.2.4-r2.apk", "musl-1.2.4-r2.1a2b3c4d.apk",
+                    "Q1...=")] """
+    cache = f"{args.work}/cache_apk_{arch}"
+    repos = {}
+    for url in pmb.helpers.repo.urls(args, False):
+        path = f"{cache}/APKINDEX.{pmb.helpers.repo.hash(url)}.tar.gz"
+        if os.path.exists(path):
+            repos[path] = url
+
+    ret = {}
+    for pkgname in pkgnames:
+        block = pmb.parse.apkindex.package(args, pkgname, arch, False)
+        if not block or not block.get("checksum"):
+            continue
+        installed_block = installed.get(block["pkgname"], {})
+        if installed_block.get("checksum") == block["checksum"]:
+            continue
+        name = pmb.chroot.apk_store.get_cache_name(block)
+        if name in ret or os.path.exists(f"{cache}/{name}"):
+            continue
+
+        # Find the repository with this package (packages from the local
+        # repository are not in repos)
+        for path, url in repos.items():
+            found = pmb.parse.apkindex.parse(path, False).get(block["pkgname"])
+            if found and found.get("checksum") == block["checksum"]:
+                ret[name] = (f"{url}/{arch}/{block['pkgname']}-"
+                             f"{block['version']}.apk", name,
+                             block["checksum"])
+                break
+    return list(ret.values())
+
+
+def fetch(args, url, path, checksum):
+    """ Download and verify one package.
+
+        :param path: where to store the package
+        :returns: path, or None if it failed """
+    try:
+        temp = pmb.helpers.http.download(args, url, "apk", True,
+                                         logging.DEBUG, persist_stats=False)
+    except (OSError, http.client.HTTPException) as e:
+        logging.warning(f"WARNING: failed to download {url}: {e}")
+        return None
+    if not verify(temp, checksum):
+        logging.warning(f"WARNING: checksum mismatch: {url}")
+        os.remove(temp)
+        return None
+    os.replace(temp, path)
+    return path
+
+
+def download(args, pkgnames, suffix, installed):
+    """ Download all packages that are missing in the chroot and in apk's
+        cache in parallel, before running "apk add".
+
+        :param pkgnames: list of pkgnames (including all dependencies)
+        :param installed: see get_downloads() """
+    if args.offline:
+        return
+    arch = pmb.parse.arch.from_chroot_suffix(args, suffix)
+    downloads = get_downloads(args, pkgnames, arch, installed)
+    if not downloads:
+        return
+
+    # Download as user, then move the packages into apk's cache (owned by
+    # root) with one command
+    logging.info(f"({suffix}) download {len(downloads)} package(s)")
+    staging = f"{args.work}/cache_http/apk_{arch}"
+    if not os.path.exists(staging):
+        pmb.helpers.run.user(args, ["mkdir", "-p", staging])
+    paths = []
+    with concurrent.futures.ThreadPoolExecutor(
+            pmb.config.apk_fetch_jobs) as executor:
+        futures = [executor.submit(fetch, args, url, f"{staging}/{name}",
+                                   checksum)
+                   for url, name, checksum in downloads]
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            pmb.helpers.cli.progress_print(args, (i + 1) / len(futures))
+            if future.result():
+                paths.append(future.result())
+    pmb.helpers.cli.progress_flush(args)
+    pmb.helpers.http.write_stats(args)
+
+    if not paths:
+        return
+    cache = f"{args.work}/cache_apk_{arch}"
+    if not os.path.exists(cache):
+        pmb.helpers.run.root(args, ["mkdir", "-p", cache])
+    pmb.helpers.run.root(args, ["mv", "-f"] + paths + [f"{cache}/"])
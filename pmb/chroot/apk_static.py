@@ -13,6 +13,7 @@ import pmb.config
 import pmb.config.load
 import pmb.parse.apkindex
 import pmb.helpers.http
+import pmb.helpers.mirror
 import pmb.parse.version
 
 
@@ -139,6 +140,7 @@ def download(args, file):
     """
     Download a single file from an Alpine mirror.
     """
+    pmb.helpers.mirror.resolve(args)
     channel_cfg = pmb.config.pmaports.read_config_channel(args)
     mirrordir = channel_cfg["mirrordir_alpine"]
     base_url = f"{args.mirror_alpine}{mirrordir}/main/{pmb.config.arch_native}"
@@ -0,0 +1,195 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Optional package store, shared by all work dirs (and thereby channels). Set
+apk_store in pmbootstrap.cfg to enable it, e.g.:
+apk_store = ~/.cache/pmbootstrap-apk-store
+apk_store_size = 20G
+
+Packages are stored as {apk_store}/{arch}/{pkgname}-{version}.{hash}.apk, the
+same file names apk uses in its cache, where the hash comes from the checksum
+in the APKINDEX ("C:" field). So the same file name always has the same
+content. Before apk installs packages, the ones found in the store get
+hardlinked into $WORK/cache_apk_{arch} (the chroots' /var/cache/apk), and
+after apk downloaded new packages they get hardlinked back into the store.
+If the store is on another filesystem, the packages get copied instead.
+"""
+import base64
+import fcntl
+import json
+import logging
+import os
+import time
+
+import pmb.helpers.other
+import pmb.helpers.run
+import pmb.parse.apkindex
+
+
+def get_path(args):
+    """ :returns: path to the store, or None if it is disabled """
+    if not args.apk_store:
+        return None
+    return os.path.expanduser(args.apk_store)
+
+
+def parse_size(size):
+    """ :param size: size with optional unit, e.g. "20G", "500M", "1024"
+        :returns: size in bytes """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    try:
+        if size[-1:].upper() in units:
+            return int(float(size[:-1]) * units[size[-1].upper()])
+        return int(size)
+    except ValueError:
+        raise ValueError(f"Invalid apk_store_size: '{size}' (expected a size"
+                         " like 20G or 500M)")
+
+
+def get_cache_name(block):
+    """ :param block: APKINDEX block from pmb.parse.apkindex.package()
+        :returns: file name of the package in apk's cache, e.g.
+                  "hello-world-1-r6.5a0bd1e8.apk" """
+    checksum = base64.b64decode(block["checksum"][2:])
+    return f"{block['pkgname']}-{block['version']}.{checksum[:4].hex()}.apk"
+
+
+def update_last_used(path, names=None, removed=None):
+    """ Remember when packages in the store were used, for the garbage
+        collection. The file is locked, so multiple pmbootstrap instances with
+        different work dirs can use the store at the same time.
+
+        :param path: path to the store
+        :param names: list of packages that were used now, e.g.
+                      ["aarch64/hello-world-1-r6.5a0bd1e8.apk"]
+        :param removed: list of packages that were removed from the store
+        :returns: dict of package names and last used timestamps """
+    with open(f"{path}/.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(f"{path}/last_used.json") as handle:
+                ret = json.load(handle)
+        except (OSError, ValueError):
+            ret = {}
+        if not names and not removed:
+            return ret
+
+        now = time.time()
+        for name in names or []:
+            ret[name] = now
+        for name in removed or []:
+            ret.pop(name, None)
+        with open(f"{path}/last_used.json.new", "w") as handle:
+            json.dump(ret, handle)
+        os.replace(f"{path}/last_used.json.new", f"{path}/last_used.json")
+    return ret
+
+
+def copy(args, paths, target):
+    """ Hardlink (or copy, if not on the same filesystem) files into a
+        directory, as root since apk's cache is owned by root. Existing files
+        do not get overwritten. """
+    cmd = ["cp", "-n"]
+    if os.stat(os.path.dirname(paths[0])).st_dev == os.stat(target).st_dev:
+        cmd += ["-l"]
+    pmb.helpers.run.root(args, cmd + paths + [f"{target}/"])
+
+
+def link_to_cache(args, arch, pkgnames):
+    """ Hardlink the packages about to be installed from the store into
+        apk's cache of the work dir, so apk does not download them again.
+
+        :param pkgnames: list of pkgnames (including all dependencies) """
+    store = get_path(args)
+    if not store or not os.path.exists(f"{store}/{arch}"):
+        return
+
+    cache = f"{args.work}/cache_apk_{arch}"
+    used = []
+    paths = []
+    for pkgname in pkgnames:
+        block = pmb.parse.apkindex.package(args, pkgname, arch, False)
+        if not block or not block.get("checksum"):
+            continue
+        name = get_cache_name(block)
+        if not os.path.exists(f"{store}/{arch}/{name}"):
+            continue
+        used.append(f"{arch}/{name}")
+        if not os.path.exists(f"{cache}/{name}"):
+            paths.append(f"{store}/{arch}/{name}")
+
+    if used:
+        update_last_used(store, used)
+    if paths:
+        logging.debug(f"Using {len(paths)} package(s) from the apk store")
+        if not os.path.exists(cache):
+            pmb.helpers.run.root(args, ["mkdir", "-p", cache])
+        copy(args, paths, cache)
+
+
+def add_from_cache(args, arch):
+    """ Add packages that apk downloaded into the work dir's cache to the
+        store, then remove the least recently used packages if the store is
+        too big. The latter is done only once per pmbootstrap invocation, as
+        it needs to stat all packages in the store. """
+    store = get_path(args)
+    cache = f"{args.work}/cache_apk_{arch}"
+    if not store or not os.path.exists(cache):
+        return
+
+    names = [name for name in os.listdir(cache) if name.endswith(".apk") and
+             not os.path.exists(f"{store}/{arch}/{name}")]
+    if not names:
+        return
+
+    logging.debug(f"Adding {len(names)} package(s) to the apk store")
+    if not os.path.exists(f"{store}/{arch}"):
+        pmb.helpers.run.user(args, ["mkdir", "-p", f"{store}/{arch}"])
+    copy(args, [f"{cache}/{name}" for name in names], f"{store}/{arch}")
+    update_last_used(store, [f"{arch}/{name}" for name in names])
+    if not pmb.helpers.other.cache["pmb.chroot.apk_store.gc"]:
+        gc(args)
+
+
+def gc(args, dry=False):
+    """ Remove the least recently used packages from the store, until it is
+        smaller than apk_store_size. Packages still hardlinked in a work dir's
+        cache only free up space once apk removed them there too (see
+        pmb.chroot.zap.zap_pkgs_online_mismatch()).
+
+        :param dry: only show what would be deleted """
+    store = get_path(args)
+    if not store or not os.path.exists(store):
+        return
+    size_max = parse_size(args.apk_store_size)
+    pmb.helpers.other.cache["pmb.chroot.apk_store.gc"] = True
+
+    last_used = update_last_used(store)
+    packages = []
+    size = 0
+    for arch in sorted(os.listdir(store)):
+        if not os.path.isdir(f"{store}/{arch}"):
+            continue
+        for name in os.listdir(f"{store}/{arch}"):
+            stat = os.stat(f"{store}/{arch}/{name}")
+            key = f"{arch}/{name}"
+            packages.append((last_used.get(key, stat.st_mtime), stat.st_size,
+                             key))
+            size += stat.st_size
+    if size <= size_max:
+        return
+
+    # The directories belong to the user, so no root is needed for removing
+    removed = []
+    for _, package_size, key in sorted(packages):
+        if size <= size_max:
+            break
+        logging.verbose(f"Remove from apk store: {key}")
+        if not dry:
+            os.remove(f"{store}/{key}")
+        removed.append(key)
+        size -= package_size
+    if not dry:
+        update_last_used(store, removed=removed)
+    logging.info(f"Removed {len(removed)} package(s) from the apk store,"
+                 f" {size / 1024 / 1024:.0f} MiB left")
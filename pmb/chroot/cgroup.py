@@ -0,0 +1,196 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import logging
+import os
+import shlex
+
+import pmb.helpers.other
+import pmb.helpers.run
+
+cgroup_root = "/sys/fs/cgroup"
+
+# Limits from pmbootstrap.cfg (written to the cgroup of the work dir) and the
+# controllers they need. See the kernel's cgroup-v2.rst for the formats, e.g.:
+# cgroup_memory_max = 8G
+# cgroup_cpu_max = 400000 100000 (4 CPUs)
+# cgroup_io_max = 8:0 rbps=104857600 wbps=104857600,8:16 wbps=max
+limits = {"cgroup_memory_max": ("memory", "memory.max"),
+          "cgroup_cpu_max": ("cpu", "cpu.max"),
+          "cgroup_io_max": ("io", "io.max")}
+
+
+def is_enabled(args):
+    """ :returns: True if chroot commands should run in a cgroup """
+    return args.cgroup or any(getattr(args, key) for key in limits)
+
+
+def get_paths(args):
+    """
+    Get the cgroups for the current work dir and the current pmbootstrap
+    session. Several pmbootstrap work dirs on the same host get separate
+    cgroups with their own limits.
+
+    :returns: (work, session) paths, e.g.
+              ("/sys/fs/cgroup/pmbootstrap/work-1a2b3c4d",
+               "/sys/fs/cgroup/pmbootstrap/work-1a2b3c4d/session-1234")
+    """
+    work_hash = hashlib.sha256(os.path.realpath(args.work).encode())
+    work = f"{cgroup_root}/pmbootstrap/work-{work_hash.hexdigest()[:8]}"
+    return (work, f"{work}/session-{os.getpid()}")
+
+
+def create(args):
+    """
+    Create the cgroups from get_paths(), enable the controllers and write the
+    limits from pmbootstrap.cfg to the work dir cgroup.
+
+    :returns: path to the session cgroup, or None if cgroup v2 is not
+              available
+    """
+    if not os.path.exists(f"{cgroup_root}/cgroup.controllers"):
+        logging.warning("WARNING: cgroup v2 is not available on this system,"
+                        " running chroot commands without cgroup limits")
+        return None
+
+    with open(f"{cgroup_root}/cgroup.controllers") as handle:
+        available = handle.read().split()
+    controllers = [c for c in ["cpu", "io", "memory"] if c in available]
+    enable = " ".join(f"+{c}" for c in controllers)
+
+    (work, session) = get_paths(args)
+    parent = os.path.dirname(work)
+    script = []
+    for path in [cgroup_root, parent, work]:
+        if path != cgroup_root:
+            script += [f"mkdir -p {shlex.quote(path)}"]
+        script += [f"echo {shlex.quote(enable)} >"
+                   f" {shlex.quote(path)}/cgroup.subtree_control"]
+
+    for key, (controller, name) in limits.items():
+        value = getattr(args, key)
+        if not value:
+            continue
+        if controller not in controllers:
+            raise RuntimeError(f"{key} is set in pmbootstrap.cfg, but the"
+                               f" cgroup v2 '{controller}' controller is not"
+                               " available on this system")
+        for line in value.split(","):
+            script += [f"echo {shlex.quote(line.strip())} >"
+                       f" {shlex.quote(work)}/{name}"]
+
+    script += [f"mkdir -p {shlex.quote(session)}"]
+    logging.debug(f"Create cgroup: {session}")
+    pmb.helpers.run.root(args, ["sh", "-c", " && ".join(script)])
+    return session
+
+
+def get(args):
+    """
+    Get the session cgroup for chroot commands, create it on first use.
+
+    :returns: path to the session cgroup, or None if chroot commands should
+              not run in a cgroup
+    """
+    cache = pmb.helpers.other.cache
+    if "pmb.chroot.cgroup" not in cache:
+        cache["pmb.chroot.cgroup"] = None
+        if is_enabled(args):
+            cache["pmb.chroot.cgroup"] = create(args)
+    return cache["pmb.chroot.cgroup"]
+
+
+def shell_prefix(args):
+    """
+    :returns: shell code that moves the current shell to the session cgroup,
+              to run it as root before the chroot command (so the command
+              and all its child processes are in the cgroup), or "" if
+              chroot commands should not run in a cgroup
+    """
+    session = get(args)
+    if not session:
+        return ""
+    return f"echo $$ > {shlex.quote(session)}/cgroup.procs; "
+
+
+def read_stats(path):
+    """
+    Read the resource usage of a cgroup.
+
+    :param path: path to the cgroup
+    :returns: dict with the keys that were found, e.g.:
+              {"usage_usec": 12345, "user_usec": 10000,
+               "system_usec": 2345, "throttled_usec": 0,
+               "memory_peak": 1048576, "rbytes": 4096, "wbytes": 8192}
+    """
+    ret = {}
+    try:
+        with open(f"{path}/cpu.stat") as handle:
+            for line in handle:
+                key, value = line.split()
+                if key in ["usage_usec", "user_usec", "system_usec",
+                           "throttled_usec"]:
+                    ret[key] = int(value)
+    except OSError:
+        pass
+
+    try:
+        with open(f"{path}/memory.peak") as handle:
+            ret["memory_peak"] = int(handle.read())
+    except OSError:
+        pass
+
+    # io.stat: one line per device, e.g. "8:0 rbytes=1 wbytes=2 rios=3 ..."
+    try:
+        with open(f"{path}/io.stat") as handle:
+            ret["rbytes"] = 0
+            ret["wbytes"] = 0
+            for line in handle:
+                for field in line.split()[1:]:
+                    key, value = field.split("=", 1)
+                    if key in ["rbytes", "wbytes"]:
+                        ret[key] += int(value)
+    except OSError:
+        pass
+    return ret
+
+
+def format_stats(stats):
+    """ :returns: readable summary of read_stats() output """
+    mib = 1024 * 1024
+    ret = []
+    if "usage_usec" in stats:
+        ret += [f"CPU: {stats['usage_usec'] / 1000000:.1f}s"
+                f" (user: {stats.get('user_usec', 0) / 1000000:.1f}s,"
+                f" system: {stats.get('system_usec', 0) / 1000000:.1f}s,"
+                " throttled:"
+                f" {stats.get('throttled_usec', 0) / 1000000:.1f}s)"]
+    if "memory_peak" in stats:
+        ret += [f"memory peak: {stats['memory_peak'] / mib:.0f} MiB"]
+    if "rbytes" in stats:
+        ret += [f"I/O: {stats['rbytes'] / mib:.0f} MiB read,"
+                f" {stats['wbytes'] / mib:.0f} MiB written"]
+    return ", ".join(ret)
+
+
+def finish(args):
+    """
+    Write the resource usage of all chroot commands of this pmbootstrap
+    session to the log, then remove the session cgroup if no processes are
+    left in it (e.g. adb or sccache daemons).
+    """
+    cache = pmb.helpers.other.cache
+    session = cache.get("pmb.chroot.cgroup") if cache else None
+    if not session:
+        return
+
+    stats = read_stats(session)
+    logging.debug(f"Resource usage of chroot commands ({session}):"
+                  f" {format_stats(stats)}")
+
+    with open(f"{session}/cgroup.procs") as handle:
+        if handle.read().strip():
+            logging.debug("Processes left in the cgroup, not removing it")
+            return
+    pmb.helpers.run.root(args, ["rmdir", session], check=False)
+    cache["pmb.chroot.cgroup"] = None
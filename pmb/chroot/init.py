@@ -6,7 +6,9 @@ import glob
 import filecmp
 
 import pmb.chroot
+import pmb.chroot.apk
 import pmb.chroot.apk_static
+import pmb.chroot.apk_store
 import pmb.config
 import pmb.config.workdir
 import pmb.helpers.repo
@@ -75,55 +77,57 @@ def init_keys(args):
 
 
 def init(args, suffix="native"):
-    # When already initialized: just prepare the chroot
-    chroot = f"{args.work}/chroot_{suffix}"
-    arch = pmb.parse.arch.from_chroot_suffix(args, suffix)
-
-    pmb.chroot.mount(args, suffix)
-    setup_qemu_emulation(args, suffix)
-    mark_in_chroot(args, suffix)
-    if os.path.islink(f"{chroot}/bin/sh"):
-        pmb.config.workdir.chroot_check_channel(args, suffix)
+    with pmb.chroot.apk.get_lock(suffix):
+        # When already initialized: just prepare the chroot
+        chroot = f"{args.work}/chroot_{suffix}"
+        arch = pmb.parse.arch.from_chroot_suffix(args, suffix)
+
+        pmb.chroot.mount(args, suffix)
+        setup_qemu_emulation(args, suffix)
+        mark_in_chroot(args, suffix)
+        if os.path.islink(f"{chroot}/bin/sh"):
+            pmb.config.workdir.chroot_check_channel(args, suffix)
+            copy_resolv_conf(args, suffix)
+            pmb.chroot.apk.update_repository_list(args, suffix)
+            return
+
+        # Require apk-tools-static
+        pmb.chroot.apk_static.init(args)
+
+        logging.info(f"({suffix}) install alpine-base")
+
+        # Initialize cache
+        apk_cache = f"{args.work}/cache_apk_{arch}"
+        pmb.helpers.run.root(args, ["ln", "-s", "-f", "/var/cache/apk",
+                                    f"{chroot}/etc/apk/cache"])
+
+        # Initialize /etc/apk/keys/, resolv.conf, repositories
+        init_keys(args)
         copy_resolv_conf(args, suffix)
         pmb.chroot.apk.update_repository_list(args, suffix)
-        return
 
-    # Require apk-tools-static
-    pmb.chroot.apk_static.init(args)
-
-    logging.info(f"({suffix}) install alpine-base")
-
-    # Initialize cache
-    apk_cache = f"{args.work}/cache_apk_{arch}"
-    pmb.helpers.run.root(args, ["ln", "-s", "-f", "/var/cache/apk",
-                                f"{chroot}/etc/apk/cache"])
-
-    # Initialize /etc/apk/keys/, resolv.conf, repositories
-    init_keys(args)
-    copy_resolv_conf(args, suffix)
-    pmb.chroot.apk.update_repository_list(args, suffix)
-
-    pmb.config.workdir.chroot_save_init(args, suffix)
-
-    # Install alpine-base
-    pmb.helpers.repo.update(args, arch)
-    pmb.chroot.apk_static.run(args, ["--root", chroot,
-                                     "--cache-dir", apk_cache,
-                                     "--initdb", "--arch", arch,
-                                     "add", "alpine-base"])
-
-    # Building chroots: create "pmos" user, add symlinks to /home/pmos
-    if not suffix.startswith("rootfs_"):
-        pmb.chroot.root(args, ["adduser", "-D", "pmos", "-u",
-                               pmb.config.chroot_uid_user],
-                        suffix, auto_init=False)
-
-        # Create the links (with subfolders if necessary)
-        for target, link_name in pmb.config.chroot_home_symlinks.items():
-            link_dir = os.path.dirname(link_name)
-            if not os.path.exists(f"{chroot}{link_dir}"):
-                pmb.chroot.user(args, ["mkdir", "-p", link_dir], suffix)
-            if not os.path.exists(f"{chroot}{target}"):
-                pmb.chroot.root(args, ["mkdir", "-p", target], suffix)
-            pmb.chroot.user(args, ["ln", "-s", target, link_name], suffix)
-            pmb.chroot.root(args, ["chown", "pmos:pmos", target], suffix)
+        pmb.config.workdir.chroot_save_init(args, suffix)
+
+        # Install alpine-base
+        pmb.helpers.repo.update(args, arch)
+        pmb.chroot.apk_static.run(args, ["--root", chroot,
+                                         "--cache-dir", apk_cache,
+                                         "--initdb", "--arch", arch,
+                                         "add", "alpine-base"])
+        pmb.chroot.apk_store.add_from_cache(args, arch)
+
+        # Building chroots: create "pmos" user, add symlinks to /home/pmos
+        if not suffix.startswith("rootfs_"):
+            pmb.chroot.root(args, ["adduser", "-D", "pmos", "-u",
+                                   pmb.config.chroot_uid_user],
+                            suffix, auto_init=False)
+
+            # Create the links (with subfolders if necessary)
+            for target, link_name in pmb.config.chroot_home_symlinks.items():
+                link_dir = os.path.dirname(link_name)
+                if not os.path.exists(f"{chroot}{link_dir}"):
+                    pmb.chroot.user(args, ["mkdir", "-p", link_dir], suffix)
+                if not os.path.exists(f"{chroot}{target}"):
+                    pmb.chroot.root(args, ["mkdir", "-p", target], suffix)
+                pmb.chroot.user(args, ["ln", "-s", target, link_name], suffix)
+                pmb.chroot.root(args, ["chown", "pmos:pmos", target], suffix)
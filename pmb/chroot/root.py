@@ -6,6 +6,7 @@ import shutil
 import pmb.config
 import pmb.chroot
 import pmb.chroot.binfmt
+import pmb.chroot.cgroup
 import pmb.helpers.run
 import pmb.helpers.run_core
 
@@ -75,11 +76,13 @@ def root(args, cmd, suffix="native", working_dir="/", output="log",
     # cmd: ["echo", "test"]
     # cmd_chroot: ["/sbin/chroot", "/..._native", "/bin/sh", "-c", "echo test"]
     # cmd_sudo: ["sudo", "env", "-i", "sh", "-c", "PATH=... /sbin/chroot ..."]
+    # (with "echo $$ > .../cgroup.procs; " in front if using a cgroup)
     executables = executables_absolute_path()
     cmd_chroot = [executables["chroot"], chroot, "/bin/sh", "-c",
                   pmb.helpers.run_core.flat_cmd(cmd, working_dir)]
     cmd_sudo = pmb.config.sudo([
         "env", "-i", executables["sh"], "-c",
+        pmb.chroot.cgroup.shell_prefix(args) +
         pmb.helpers.run_core.flat_cmd(cmd_chroot, env=env_all)]
     )
     return pmb.helpers.run_core.core(args, msg, cmd_sudo, None, output,
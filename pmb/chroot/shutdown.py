@@ -8,6 +8,7 @@ from contextlib import closing
 
 import pmb.chroot
 import pmb.helpers.mount
+import pmb.helpers.run_core
 import pmb.install.losetup
 import pmb.parse.arch
 
@@ -59,9 +60,10 @@ def shutdown_cryptsetup_device(args, name):
 
 
 def shutdown(args, only_install_related=False):
-    # Stop daemons
+    # Stop daemons and leftover background processes
     kill_adb(args)
     kill_sccache(args)
+    pmb.helpers.run_core.kill_background(args)
 
     # Umount installation-related paths (order is important!)
     pmb.helpers.mount.umount_all(args, args.work +
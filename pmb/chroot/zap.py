@@ -1,21 +1,27 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import functools
 import glob
 import logging
 import math
 import os
 
 import pmb.chroot
+import pmb.chroot.apk
+import pmb.chroot.apk_store
 import pmb.config.pmaports
 import pmb.config.workdir
+import pmb.helpers.manifest
 import pmb.helpers.pmaports
 import pmb.helpers.run
 import pmb.parse.apkindex
+import pmb.parse.arch
+import pmb.parse.version
 
 
 def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
         pkgs_local_mismatch=False, pkgs_online_mismatch=False, distfiles=False,
-        rust=False, netboot=False):
+        rust=False, netboot=False, gc=False, gc_keep=None):
     """
     Shutdown everything inside the chroots (e.g. adb), umount
     everything and then safely remove folders from the work-directory.
@@ -30,26 +36,30 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
     :param distfiles: Clear the downloaded files cache
     :param rust: Remove rust related caches
     :param netboot: Remove images for netboot
+    :param gc: Remove old versions and unreferenced packages from the locally
+        compiled packages (see zap_pkgs_gc())
+    :param gc_keep: Versions to keep per origin with gc (default:
+        pmb.config.zap_gc_keep)
 
     NOTE: This function gets called in pmb/config/init.py, with only args.work
     and args.device set!
     """
-    # Get current work folder size
-    if not dry:
-        pmb.chroot.shutdown(args)
-        logging.debug("Calculate work folder size")
-        size_old = pmb.helpers.other.folder_size(args, args.work)
-
     # Delete packages with a different version compared to aports,
     # then re-index
     if pkgs_local_mismatch:
         zap_pkgs_local_mismatch(args, confirm, dry)
 
+    # Delete old and unreferenced packages, then re-index
+    size = 0
+    if gc:
+        size += zap_pkgs_gc(args, confirm, dry, gc_keep) / 1024
+
     # Delete outdated binary packages
     if pkgs_online_mismatch:
         zap_pkgs_online_mismatch(args, confirm, dry)
 
-    pmb.chroot.shutdown(args)
+    if not dry:
+        pmb.chroot.shutdown(args)
 
     # Deletion patterns for folders inside args.work
     patterns = [
@@ -59,7 +69,7 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
         "chroot_rootfs_*",
     ]
     if pkgs_local:
-        patterns += ["packages"]
+        patterns += ["packages", "cache_manifest"]
     if http:
         patterns += ["cache_http"]
     if distfiles:
@@ -69,7 +79,8 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
     if netboot:
         patterns += ["images_netboot"]
 
-    # Delete everything matching the patterns
+    # Delete everything matching the patterns, estimate the size of each
+    # folder right before removing it
     for pattern in patterns:
         pattern = os.path.realpath(f"{args.work}/{pattern}")
         matches = glob.glob(pattern)
@@ -77,6 +88,8 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
             if (not confirm or
                     pmb.helpers.cli.confirm(args, f"Remove {match}?")):
                 logging.info(f"% rm -rf {match}")
+                size += pmb.helpers.other.folder_size_scandir(match, False,
+                                                              args)
                 if not dry:
                     pmb.helpers.run.root(args, ["rm", "-rf", match])
 
@@ -87,11 +100,11 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
     pmb.helpers.other.cache["apk_repository_list_updated"].clear()
 
     # Print amount of cleaned up space
+    mb = size / 1024
     if dry:
-        logging.info("Dry run: nothing has been deleted")
+        logging.info("Dry run: nothing has been deleted (would clear up"
+                     f" ~{math.ceil(mb)} MB of space)")
     else:
-        size_new = pmb.helpers.other.folder_size(args, args.work)
-        mb = (size_old - size_new) / 1024
         logging.info(f"Cleared up ~{math.ceil(mb)} MB of space")
 
 
@@ -100,54 +113,175 @@ def zap_pkgs_local_mismatch(args, confirm=True, dry=False):
     if not os.path.exists(f"{args.work}/packages/{channel}"):
         return
 
-    question = "Remove binary packages that are newer than the corresponding" \
+    question = "Remove binary packages that don't match the corresponding" \
                f" pmaports (channel '{channel}')?"
     if confirm and not pmb.helpers.cli.confirm(args, question):
         return
 
     reindex = False
-    pattern = f"{args.work}/packages/{channel}/*/APKINDEX.tar.gz"
-    for apkindex_path in glob.glob(pattern):
-        # Delete packages without same version in aports
-        blocks = pmb.parse.apkindex.parse_blocks(apkindex_path)
-        for block in blocks:
-            pkgname = block["pkgname"]
-            origin = block["origin"]
-            version = block["version"]
-            arch = block["arch"]
-
-            # Apk path
-            apk_path_short = f"{arch}/{pkgname}-{version}.apk"
-            apk_path = f"{args.work}/packages/{channel}/{apk_path_short}"
-            if not os.path.exists(apk_path):
-                logging.info("WARNING: Package mentioned in index not"
-                             f" found: {apk_path_short}")
-                continue
+    aport_hashes = {}
+    # Delete packages without same version or changed aport
+    for package in pmb.helpers.manifest.packages(args):
+        origin = package["origin"]
+        version = package["version"]
+        apk_path_short = (f"{package['arch']}/{package['pkgname']}-"
+                          f"{version}.apk")
+        apk_path = f"{args.work}/packages/{channel}/{apk_path_short}"
 
-            # Aport path
-            aport_path = pmb.helpers.pmaports.find(args, origin, False)
-            if not aport_path:
-                logging.info(f"% rm {apk_path_short}"
-                             f" ({origin} aport not found)")
-                if not dry:
-                    pmb.helpers.run.root(args, ["rm", apk_path])
-                    reindex = True
-                continue
+        # Aport path
+        aport_path = pmb.helpers.pmaports.find(args, origin, False)
+        if not aport_path:
+            logging.info(f"% rm {apk_path_short}"
+                         f" ({origin} aport not found)")
+            if not dry:
+                pmb.helpers.run.root(args, ["rm", apk_path])
+                reindex = True
+            continue
 
-            # Clear out any binary apks that do not match what is in aports
-            apkbuild = pmb.parse.apkbuild(f"{aport_path}/APKBUILD")
-            version_aport = f"{apkbuild['pkgver']}-r{apkbuild['pkgrel']}"
-            if version != version_aport:
-                logging.info(f"% rm {apk_path_short}"
-                             f" ({origin} aport: {version_aport})")
-                if not dry:
-                    pmb.helpers.run.root(args, ["rm", apk_path])
-                    reindex = True
+        # Clear out any binary apks that do not match what is in aports
+        apkbuild = pmb.parse.apkbuild(f"{aport_path}/APKBUILD")
+        version_aport = f"{apkbuild['pkgver']}-r{apkbuild['pkgrel']}"
+        if version != version_aport:
+            logging.info(f"% rm {apk_path_short}"
+                         f" ({origin} aport: {version_aport})")
+            if not dry:
+                pmb.helpers.run.root(args, ["rm", apk_path])
+                reindex = True
+            continue
+
+        # Same version, but the aport was changed after building the package
+        # (only known for packages built since the manifest exists)
+        if not package["aport_hash"]:
+            continue
+        if aport_path not in aport_hashes:
+            aport_hashes[aport_path] = \
+                pmb.helpers.manifest.get_aport_hash(aport_path)
+        if package["aport_hash"] != aport_hashes[aport_path]:
+            logging.info(f"% rm {apk_path_short}"
+                         f" ({origin} aport changed since the build)")
+            if not dry:
+                pmb.helpers.run.root(args, ["rm", apk_path])
+                reindex = True
 
     if reindex:
         pmb.build.other.index_repo(args)
 
 
+def zap_pkgs_gc_referenced(args):
+    """
+    Get the origins of all packages that the configured device and the
+    chroots in the work dir need: the packages "pmbootstrap install" would
+    install for the device, the /etc/apk/world of each chroot, and all of
+    their dependencies.
+
+    :returns: set of (arch, origin) tuples, e.g. {("aarch64", "linux-foo")}
+    """
+    roots = {}
+    device_packages = (pmb.config.install_device_packages +
+                       [f"device-{args.device}"])
+    if args.kernel and args.kernel != "none":
+        device_packages += [f"device-{args.device}-kernel-{args.kernel}"]
+    if args.ui.lower() != "none":
+        device_packages += [f"postmarketos-ui-{args.ui}",
+                            f"postmarketos-ui-{args.ui}-extras"]
+    if args.extra_packages.lower() != "none":
+        device_packages += args.extra_packages.split(",")
+    roots[args.deviceinfo["arch"]] = device_packages
+
+    for path in glob.glob(f"{args.work}/chroot_*"):
+        suffix = os.path.basename(path)[len("chroot_"):]
+        arch = pmb.parse.arch.from_chroot_suffix(args, suffix)
+        roots.setdefault(arch, [])
+        roots[arch] += pmb.chroot.apk.world_read(args, suffix)
+
+    ret = set()
+    for arch, pkgnames in roots.items():
+        todo = [pmb.chroot.apk.world_name(pkgname) for pkgname in pkgnames
+                if not pkgname.startswith("!")]
+        done = set()
+        while todo:
+            pkgname = todo.pop()
+            if pkgname in done:
+                continue
+            done.add(pkgname)
+            block = pmb.parse.apkindex.package(args, pkgname, arch, False)
+            if not block:
+                continue
+            ret.add((arch, block.get("origin")))
+            todo += block["depends"]
+    return ret
+
+
+def zap_pkgs_gc(args, confirm=True, dry=False, keep=None):
+    """
+    Remove packages from the local repository that are not needed anymore:
+    for each arch and origin only the packages of the newest versions get
+    kept, and origins that are not referenced by the configured device or
+    any chroot (see zap_pkgs_gc_referenced()) get removed completely.
+
+    Everything gets decided from the manifest in one pass, then the packages
+    get removed with as few rm calls as possible and the repository gets
+    indexed once.
+
+    :param keep: versions to keep per origin and arch (default:
+                 pmb.config.zap_gc_keep)
+    :returns: size of the removed packages in bytes
+    """
+    channel = pmb.config.pmaports.read_config(args)["channel"]
+    if keep is None:
+        keep = pmb.config.zap_gc_keep
+    if keep < 1:
+        raise ValueError(f"Invalid number of versions to keep: {keep}")
+
+    packages = pmb.helpers.manifest.packages(args)
+    if not packages:
+        return 0
+
+    question = "Remove old versions and unreferenced binary packages from" \
+               f" the locally compiled packages (channel '{channel}')?"
+    if confirm and not pmb.helpers.cli.confirm(args, question):
+        return 0
+
+    # Group by arch, origin and version
+    origins = {}
+    for package in packages:
+        versions = origins.setdefault((package["arch"], package["origin"]),
+                                      {})
+        versions.setdefault(package["version"], []).append(package)
+
+    referenced = zap_pkgs_gc_referenced(args)
+    remove = []
+    # Packages without origin get sorted first instead of raising TypeError
+    for (arch, origin), versions in sorted(
+            origins.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+        newest = sorted(versions, reverse=True,
+                        key=functools.cmp_to_key(pmb.parse.version.compare))
+        if (arch, origin) in referenced:
+            reason = f"{origin}: keeping {keep} newest version(s)"
+            newest = newest[keep:]
+        else:
+            reason = f"{origin}: not referenced"
+        for version in newest:
+            for package in versions[version]:
+                logging.info(f"% rm {arch}/{package['pkgname']}-"
+                             f"{version}.apk ({reason})")
+                remove.append(package)
+
+    size = sum(package["size"] for package in remove)
+    logging.info(f"Removing {len(remove)} of {len(packages)} locally compiled"
+                 f" packages ({size / 1024 / 1024:.1f} MiB)")
+    if not remove or dry:
+        return size
+
+    paths = [f"{args.work}/packages/{channel}/{package['arch']}/"
+             f"{package['pkgname']}-{package['version']}.apk"
+             for package in remove]
+    for i in range(0, len(paths), 1000):
+        pmb.helpers.run.root(args, ["rm", "-f"] + paths[i:i + 1000])
+    pmb.build.other.index_repo(args)
+    return size
+
+
 def zap_pkgs_online_mismatch(args, confirm=True, dry=False):
     # Check whether we need to do anything
     paths = glob.glob(f"{args.work}/cache_apk_*")
@@ -165,7 +299,14 @@ def zap_pkgs_online_mismatch(args, confirm=True, dry=False):
         if arch == pmb.config.arch_native:
             suffix = "native"
 
+        # Keep the packages in the apk store, for other work dirs
+        if not dry:
+            pmb.chroot.apk_store.add_from_cache(args, arch)
+
         # Clean the cache with apk
         logging.info(f"({suffix}) apk -v cache clean")
         if not dry:
             pmb.chroot.root(args, ["apk", "-v", "cache", "clean"], suffix)
+
+    # Remove the least recently used packages from the apk store
+    pmb.chroot.apk_store.gc(args, dry)
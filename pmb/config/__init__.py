@@ -1,6 +1,5 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
-import multiprocessing
 import os
 import pmb.parse.arch
 import sys
@@ -57,7 +56,7 @@ ondev_min_version = "0.2.0"
 required_programs = [
     "git",
     "openssl",
-    "ps",
+    "setsid",
     "tar",
 ]
 
@@ -73,11 +72,17 @@ def sudo(cmd: List[str]) -> List[str]:
 
 # Keys saved in the config file (mostly what we ask in 'pmbootstrap init')
 config_keys = [
+    "apk_store",
+    "apk_store_size",
     "aports",
     "boot_size",
     "build_default_device_arch",
     "build_pkgs_on_install",
     "ccache_size",
+    "cgroup",
+    "cgroup_cpu_max",
+    "cgroup_io_max",
+    "cgroup_memory_max",
     "device",
     "extra_packages",
     "extra_space",
@@ -105,17 +110,27 @@ config_keys = [
 # overridden on the commandline)
 defaults = {
     # This first chunk matches config_keys
+    # Package store shared by all work dirs (pmb/chroot/apk_store.py),
+    # disabled if empty
+    "apk_store": "",
+    "apk_store_size": "20G",
     "aports": "$WORK/cache_git/pmaports",
     "boot_size": "256",
     "build_default_device_arch": False,
     "build_pkgs_on_install": True,
     "ccache_size": "5G",
+    # Run chroot commands in a cgroup v2 (pmb/chroot/cgroup.py), implied by
+    # setting any of the limits
+    "cgroup": False,
+    "cgroup_cpu_max": "",
+    "cgroup_io_max": "",
+    "cgroup_memory_max": "",
     "device": "qemu-amd64",
     "extra_packages": "none",
     "extra_space": "0",
     "hostname": "",
     "is_default_channel": True,
-    "jobs": str(multiprocessing.cpu_count() + 1),
+    "jobs": str(os.cpu_count() + 1),
     "kernel": "stable",
     "keymap": "",
     "locale": "en_US.UTF-8",
@@ -262,6 +277,36 @@ chroot_device_nodes = [
 # You can force-update them with 'pmbootstrap update'.
 apkindex_retention_time = 4
 
+# Downloads (pmb.helpers.http): seconds to wait for a server before giving
+# up, how often to retry a mirror after a network error, and the delay in
+# seconds before the first retry (doubled for each further retry)
+http_timeout = 30
+http_retries = 3
+http_retry_delay = 1
+
+# Packages to download at once before running "apk add"
+# (pmb/chroot/apk_fetch.py)
+apk_fetch_jobs = 8
+
+# Versions per origin and arch of locally built packages that
+# "pmbootstrap zap --gc" keeps by default
+zap_gc_keep = 2
+
+# Alpine mirrors to try if args.mirror_alpine fails
+mirrors_alpine_fallback = ["http://dl-cdn.alpinelinux.org/alpine/",
+                           "http://dl-4.alpinelinux.org/alpine/"]
+
+# Mirror selection with "-m auto" / "-mp auto" (pmb.helpers.mirror): lists
+# of mirrors, how long to keep the ranking (seconds), how much of an
+# APKINDEX to download from each mirror (bytes), seconds to wait for a
+# mirror and how many mirrors to probe at once
+mirrors_json_postmarketos = "https://postmarketos.org/mirrors.json"
+mirrors_json_alpine = "https://mirrors.alpinelinux.org/mirrors.json"
+mirror_probe_ttl = 3600 * 24
+mirror_probe_size = 64 * 1024
+mirror_probe_timeout = 5
+mirror_probe_jobs = 16
+
 
 # When chroot is considered outdated (in seconds)
 chroot_outdated = 3600 * 24 * 2
@@ -14,6 +14,7 @@ import pmb.helpers.devices
 import pmb.helpers.git
 import pmb.helpers.http
 import pmb.helpers.logging
+import pmb.helpers.mirror
 import pmb.helpers.other
 import pmb.helpers.pmaports
 import pmb.helpers.run
@@ -517,20 +518,9 @@ def ask_for_mirror(args):
 
     urls = []
     for key in keys:
-        # accept only http:// or https:// urls
-        http_count = 0  # remember if we saw any http:// only URLs
-        link_list = []
-        for k in mirrors[key]["urls"]:
-            if k.startswith("http"):
-                link_list.append(k)
-            if k.startswith("http://"):
-                http_count += 1
-        # remove all https urls if there is more that one URL and one of
-        #     them was http://
-        if http_count > 0 and len(link_list) > 1:
-            link_list = [k for k in link_list if not k.startswith("https")]
-        if len(link_list) > 0:
-            urls.append(link_list[0])
+        url = pmb.helpers.mirror.get_url(mirrors[key]["urls"])
+        if url:
+            urls.append(url)
 
     mirror_indexes = []
     for mirror in args.mirrors_postmarketos:
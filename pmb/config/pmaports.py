@@ -7,6 +7,7 @@ import sys
 
 import pmb.config
 import pmb.helpers.git
+import pmb.helpers.other
 import pmb.helpers.pmaports
 
 
@@ -160,6 +161,9 @@ def switch_to_channel_branch(args, channel_new):
     """ Checkout the channel's branch in pmaports.git.
         :channel_new: channel name (e.g. "edge", "v21.03")
         :returns: True if another branch was checked out, False otherwise """
+    # Imported here to keep parsing arguments fast (see pmb/__init__.py)
+    import pmb.chroot
+
     # Check current pmaports branch channel
     channel_current = read_config(args)["channel"]
     if channel_current == channel_new:
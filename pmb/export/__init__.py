@@ -1,5 +1,6 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+from pmb.export.compress import compress
 from pmb.export.frontend import frontend
 from pmb.export.odin import odin
 from pmb.export.symlinks import symlinks
@@ -0,0 +1,366 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import errno
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import threading
+import time
+
+import pmb.chroot
+import pmb.chroot.apk
+import pmb.helpers.run_core
+
+# Compression tools running in the native chroot, with all CPU cores
+compressors = {"zstd": {"package": "zstd",
+                        "cmd": ["zstd", "-T0", "-q", "-c"],
+                        "extension": ".zst"},
+               "xz": {"package": "xz",
+                      "cmd": ["xz", "-T0", "-c"],
+                      "extension": ".xz"}}
+
+# Android sparse image format, see libsparse/sparse_format.h in AOSP
+sparse_magic = 0xed26ff3a
+sparse_chunk_raw = 0xcac1
+sparse_chunk_dont_care = 0xcac3
+
+block_size = 4096
+# Chunk sizes are stored as uint32 including the 12 bytes chunk header, so
+# bigger regions get split into multiple chunks
+sparse_chunk_blocks_max = (2**32 - block_size - 12) // block_size
+read_size = 4 * 1024 * 1024
+zeros = bytes(read_size)
+
+
+def get_extents(handle, size):
+    """
+    Find the data and hole regions of a (sparse) file with SEEK_DATA and
+    SEEK_HOLE, so the holes don't need to be read.
+
+    :param handle: file object opened for reading
+    :param size: size of the file in bytes
+    :returns: list of (start, end, is_data) tuples, start and end are byte
+              offsets aligned to block_size (except for the end of the file)
+    """
+    fd = handle.fileno()
+    data_ranges = []
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO: no more data after offset
+            if e.errno == errno.ENXIO:
+                break
+            # Filesystem without SEEK_DATA support: treat everything as data
+            logging.debug(f"NOTE: SEEK_DATA not supported ({e}), reading the"
+                          " whole image")
+            data_ranges = [[0, size]]
+            break
+        hole = os.lseek(fd, data, os.SEEK_HOLE)
+
+        # Align to blocks and merge with the previous range if they touch
+        start = data - data % block_size
+        end = min(size, -(-hole // block_size) * block_size)
+        if data_ranges and data_ranges[-1][1] >= start:
+            data_ranges[-1][1] = end
+        else:
+            data_ranges.append([start, end])
+        offset = hole
+    os.lseek(fd, 0, os.SEEK_SET)
+
+    # Fill the gaps with holes
+    ret = []
+    offset = 0
+    for start, end in data_ranges:
+        if start > offset:
+            ret.append((offset, start, False))
+        ret.append((start, end, True))
+        offset = end
+    if offset < size:
+        ret.append((offset, size, False))
+    return ret
+
+
+def split_extents(extents):
+    """
+    Split extents that are too big for one Android sparse image chunk.
+
+    :param extents: return value of get_extents()
+    :returns: list of (start, end, is_data) tuples like get_extents(), but
+              none of them longer than sparse_chunk_blocks_max blocks
+    """
+    length_max = sparse_chunk_blocks_max * block_size
+    ret = []
+    for start, end, is_data in extents:
+        for offset in range(start, end, length_max):
+            ret.append((offset, min(end, offset + length_max), is_data))
+    return ret
+
+
+def sparse_header(size, chunks):
+    """
+    :param size: size of the image in bytes
+    :param chunks: amount of chunks that will follow the header
+    :returns: the Android sparse image file header as bytes
+    """
+    blocks = -(-size // block_size)
+    return struct.pack("<IHHHHIIII", sparse_magic, 1, 0, 28, 12, block_size,
+                       blocks, chunks, 0)
+
+
+def sparse_chunk_header(chunk_type, length):
+    """
+    :param chunk_type: sparse_chunk_raw or sparse_chunk_dont_care
+    :param length: amount of bytes in the image, that the chunk describes
+    :returns: the Android sparse image chunk header as bytes
+    """
+    blocks = -(-length // block_size)
+    total = 12
+    if chunk_type == sparse_chunk_raw:
+        total += blocks * block_size
+    return struct.pack("<HHII", chunk_type, 0, blocks, total)
+
+
+def bmap_content(size, ranges):
+    """
+    Generate a block map for bmaptool (format version 2.0).
+
+    :param size: size of the image in bytes
+    :param ranges: list of (first_block, last_block, sha256) for all blocks
+                   that contain data
+    :returns: the bmap file content as string
+    """
+    blocks = -(-size // block_size)
+    mapped = sum(last - first + 1 for first, last, _ in ranges)
+    lines = ['<?xml version="1.0" ?>',
+             '<bmap version="2.0">',
+             f"    <ImageSize> {size} </ImageSize>",
+             f"    <BlockSize> {block_size} </BlockSize>",
+             f"    <BlocksCount> {blocks} </BlocksCount>",
+             f"    <MappedBlocksCount> {mapped} </MappedBlocksCount>",
+             "    <ChecksumType> sha256 </ChecksumType>",
+             "    <BmapFileChecksum> {checksum} </BmapFileChecksum>",
+             "    <BlockMap>"]
+    for first, last, checksum in ranges:
+        blocks_range = str(first) if first == last else f"{first}-{last}"
+        lines.append(f'        <Range chksum="{checksum}"> {blocks_range}'
+                     " </Range>")
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    template = "\n".join(lines)
+
+    # The checksum of the bmap file is calculated with the checksum field
+    # itself filled with zeros
+    checksum = hashlib.sha256(template.format(checksum="0" * 64).encode())
+    return template.format(checksum=checksum.hexdigest())
+
+
+def stream_image(path, outputs):
+    """
+    Read an image file once and pass its content to all outputs. Holes are
+    not read from disk: they are written as zeros to the compressor, as
+    "don't care" chunks to the sparse image and skipped in the block map.
+
+    :param path: path to the image file
+    :param outputs: dict with the optional keys "compress", "sparse" (file
+                    objects opened for writing in binary mode) and "bmap"
+                    (file object opened for writing in text mode)
+    :returns: amount of bytes that contain data
+    """
+    compress = outputs.get("compress")
+    sparse = outputs.get("sparse")
+    bmap = outputs.get("bmap")
+
+    size = os.path.getsize(path)
+    size_data = 0
+    bmap_ranges = []
+    with open(path, "rb") as handle:
+        extents = split_extents(get_extents(handle, size))
+        if sparse:
+            sparse.write(sparse_header(size, len(extents)))
+
+        for start, end, is_data in extents:
+            length = end - start
+            if not is_data:
+                if sparse:
+                    sparse.write(sparse_chunk_header(sparse_chunk_dont_care,
+                                                     length))
+                if compress:
+                    for offset in range(start, end, read_size):
+                        compress.write(zeros[:min(read_size, end - offset)])
+                continue
+
+            size_data += length
+            if sparse:
+                sparse.write(sparse_chunk_header(sparse_chunk_raw, length))
+            checksum = hashlib.sha256()
+            handle.seek(start)
+            remaining = length
+            while remaining:
+                chunk = handle.read(min(read_size, remaining))
+                if not chunk:
+                    raise RuntimeError(f"Unexpected end of file: {path}")
+                remaining -= len(chunk)
+                if compress:
+                    compress.write(chunk)
+                if sparse:
+                    sparse.write(chunk)
+                if bmap:
+                    checksum.update(chunk)
+
+            # Sparse chunks and bmap ranges are always full blocks
+            padding = -length % block_size
+            if padding:
+                if sparse:
+                    sparse.write(zeros[:padding])
+                checksum.update(zeros[:padding])
+            bmap_ranges.append((start // block_size,
+                                (end - 1) // block_size,
+                                checksum.hexdigest()))
+
+    if bmap:
+        bmap.write(bmap_content(size, bmap_ranges))
+    return size_data
+
+
+def open_fifo(path, process):
+    """
+    Open a fifo for writing, without blocking forever if the process that
+    should read from it exits before opening it.
+
+    :param path: path to the fifo
+    :param process: subprocess.Popen object of the reading process
+    :returns: file object opened for writing in binary mode
+    """
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            # ENXIO: no reader yet
+            if e.errno != errno.ENXIO:
+                raise
+        if process.poll() is not None:
+            raise RuntimeError(f"Process reading from {path} exited with"
+                               f" {process.returncode} before opening it")
+        time.sleep(0.05)
+    os.set_blocking(fd, True)
+    return os.fdopen(fd, "wb")
+
+
+def is_sparse(path):
+    """ :returns: True if the file is an Android sparse image already """
+    with open(path, "rb") as handle:
+        magic = handle.read(4)
+    return len(magic) == 4 and struct.unpack("<I", magic)[0] == sparse_magic
+
+
+def export_image(args, path, folder, compress, sparse, bmap):
+    """
+    Export one image file in a single pass over the data, optionally
+    compressed, as Android sparse image and with a block map.
+
+    :param path: path to the image file
+    :param folder: export folder
+    :param compress: "zstd", "xz" or None
+    :param sparse: write an Android sparse image
+    :param bmap: write a block map for bmaptool
+    """
+    name = os.path.basename(path)
+    if (sparse or bmap) and is_sparse(path):
+        logging.info(f"NOTE: {name} is an Android sparse image already, not"
+                     " generating a sparse image or block map from it")
+        sparse = bmap = False
+        if not compress:
+            return
+
+    outputs = {}
+    files = []
+    if sparse:
+        stem = os.path.splitext(name)[0]
+        files.append(f"{folder}/{stem}-sparse.img")
+        outputs["sparse"] = open(files[-1], "wb")
+    if bmap:
+        files.append(f"{folder}/{name}.bmap")
+        outputs["bmap"] = open(files[-1], "w")
+
+    process = None
+    thread = None
+    if compress:
+        compressor = compressors[compress]
+        pmb.chroot.apk.install(args, [compressor["package"]])
+        files.append(f"{folder}/{name}{compressor['extension']}")
+        handle_compressed = open(files[-1], "wb")
+
+        # The compressor reads the image data from a fifo and writes the
+        # compressed data to stdout, which gets copied to the export folder
+        fifo = "/tmp/pmbootstrap_export_fifo"
+        fifo_outside = f"{args.work}/chroot_native{fifo}"
+        pmb.chroot.root(args, ["rm", "-f", fifo])
+        pmb.chroot.root(args, ["mkfifo", "-m", "666", fifo])
+        cmd = pmb.helpers.run_core.flat_cmd(compressor["cmd"])
+        process = pmb.chroot.root(args, ["sh", "-c", f"exec {cmd} < {fifo}"],
+                                  output="pipe")
+        thread = threading.Thread(target=shutil.copyfileobj,
+                                  args=(process.stdout, handle_compressed,
+                                        read_size))
+        thread.start()
+        try:
+            outputs["compress"] = open_fifo(fifo_outside, process)
+        except RuntimeError:
+            thread.join()
+            handle_compressed.close()
+            for handle in outputs.values():
+                handle.close()
+            raise
+
+    logging.info(f"Export {name}: " + ", ".join(os.path.basename(f)
+                                                  for f in files))
+    time_start = time.time()
+    try:
+        size_data = stream_image(path, outputs)
+    finally:
+        for handle in outputs.values():
+            handle.close()
+        if process:
+            process.wait()
+            thread.join()
+            handle_compressed.close()
+            pmb.chroot.root(args, ["rm", "-f", fifo])
+
+    if process:
+        pmb.helpers.run_core.check_return_code(args, process.returncode,
+                                               f"{compress} {name}")
+
+    # Statistics
+    mib = 1024 * 1024
+    duration = time.time() - time_start
+    logging.info(f" * {name}: {os.path.getsize(path) / mib:.0f} MiB"
+                 f" ({size_data / mib:.0f} MiB data) in {duration:.1f}s")
+    for file in files:
+        logging.info(f" * {os.path.basename(file)}:"
+                     f" {os.path.getsize(file) / mib:.0f} MiB")
+
+
+def compress(args, folder):
+    """
+    Export the rootfs image files of the device as compressed, Android sparse
+    and/or block map files, depending on 'pmbootstrap export --compress
+    --sparse --bmap'.
+
+    :param folder: export folder
+    """
+    pattern = f"{args.work}/chroot_native/home/pmos/rootfs/{args.device}*.img"
+    images = [path for path in sorted(glob.glob(pattern))
+              if not path.endswith("-sparse.img")]
+    if not images:
+        logging.info("NOTE: No rootfs image found to compress, run"
+                     " 'pmbootstrap install' first.")
+        return
+
+    for path in images:
+        export_image(args, path, folder, args.export_compress,
+                     args.export_sparse, args.export_bmap)
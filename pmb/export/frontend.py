@@ -31,3 +31,5 @@ def frontend(args):
     if args.odin_flashable_tar:
         pmb.export.odin(args, flavor, target)
     pmb.export.symlinks(args, flavor, target)
+    if args.export_compress or args.export_sparse or args.export_bmap:
+        pmb.export.compress(args, target)
@@ -3,7 +3,10 @@
 import copy
 import os
 import pmb.config
+import pmb.config.pmaports
 import pmb.helpers.git
+import pmb.helpers.logging
+import pmb.helpers.other
 
 """ This file constructs the args variable, which is passed to almost all
     functions in the pmbootstrap code base. Here's a listing of the kind of
@@ -8,6 +8,7 @@ import readline
 import sys
 
 import pmb.config
+import pmb.helpers.logging
 
 
 class ReadlineTabCompleter:
@@ -83,6 +84,7 @@ def ask(question="Continue?", choices=["y", "n"], default="n",
         if ret == "":
             ret = str(default)
 
+        pmb.helpers.logging.flush()
         pmb.helpers.logging.logfd.write(f"{line}: {ret}\n")
         pmb.helpers.logging.logfd.flush()
 
@@ -0,0 +1,108 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Cache for shell completion with argcomplete. The completers in
+pmb/parse/arguments.py run on every TAB press, so instead of scanning pmaports
+they read a small JSON file. It gets written whenever pmbootstrap scans
+pmaports anyway (see pmb.helpers.pmaports._find_apkbuilds()), and is
+considered outdated when HEAD of pmaports.git changes.
+"""
+import json
+import os
+
+import pmb.helpers.git
+import pmb.helpers.other
+import pmb.helpers.pmaports
+
+
+def get_path(args):
+    return f"{args.work}/completion.json"
+
+
+def generate(args, apkbuilds):
+    """
+    Generate the completion cache from a pmaports scan.
+
+    :param apkbuilds: dict of pkgname and APKBUILD path, as found by
+                      pmb.helpers.pmaports._find_apkbuilds()
+    :returns: dict with the pmaports path and its HEAD commit (to check if
+              the cache is outdated) and the names to complete, e.g.:
+              {"aports": "/home/user/.local/var/pmbootstrap/cache_git/...",
+               "head": "90cd0ad84d390897efdcf881c0315747a4f3a966",
+               "packages": ["0xffff", "alsa-ucm-conf", ...],
+               "devices": ["pine64-pinephone", "qemu-amd64", ...],
+               "kernels": ["linux-postmarketos-allwinner", ...],
+               "uis": ["none", "phosh", ...]}
+    """
+    ret = {"aports": args.aports,
+           "head": pmb.helpers.git.get_head(args.aports),
+           "packages": sorted(apkbuilds),
+           "devices": [],
+           "kernels": [],
+           "uis": ["none"]}
+    for pkgname, path in sorted(apkbuilds.items()):
+        folder = os.path.dirname(os.path.dirname(path))
+        if pkgname.startswith("device-") and \
+                os.path.dirname(folder) == f"{args.aports}/device":
+            ret["devices"].append(pkgname.split("-", 1)[1])
+        elif pkgname.startswith("linux-"):
+            ret["kernels"].append(pkgname)
+        elif pkgname.startswith("postmarketos-ui-") and \
+                folder == f"{args.aports}/main":
+            ret["uis"].append(pkgname[len("postmarketos-ui-"):])
+    return ret
+
+
+def read(args):
+    """
+    :returns: the completion cache from generate(), or None if it does not
+              exist or is outdated
+    """
+    try:
+        with open(get_path(args)) as handle:
+            ret = json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+    if ret.get("aports") != args.aports or \
+            ret.get("head") != pmb.helpers.git.get_head(args.aports):
+        return None
+    return ret
+
+
+def update(args, apkbuilds):
+    """
+    Write the completion cache, unless it is up-to-date already.
+
+    :param apkbuilds: see generate()
+    """
+    if not os.path.exists(args.work) or read(args):
+        return
+
+    # Without a HEAD commit, the cache could never be considered up-to-date
+    cache = generate(args, apkbuilds)
+    if not cache["head"]:
+        return
+
+    # Write atomically, so a completer running at the same time never reads a
+    # partial file
+    path = get_path(args)
+    with open(f"{path}.new", "w") as handle:
+        json.dump(cache, handle)
+    os.replace(f"{path}.new", path)
+
+
+def get(args, key):
+    """
+    Get names for shell completion. Scan pmaports (which writes the
+    completion cache) only if the cache does not exist or is outdated.
+
+    :param key: "packages", "devices", "kernels" or "uis"
+    :returns: list of names, see generate()
+    """
+    cache = read(args)
+    if not cache:
+        pmb.helpers.pmaports.get_list(args)
+        apkbuilds = pmb.helpers.other.cache["pmb.helpers.pmaports.apkbuilds"]
+        cache = generate(args, apkbuilds)
+    return cache[key]
@@ -4,6 +4,7 @@
 import os
 import time
 
+import pmb.helpers.other
 import pmb.helpers.run
 
 
@@ -6,33 +6,16 @@ import logging
 import os
 import sys
 
-import pmb.aportgen
-import pmb.build
-import pmb.build.autodetect
-import pmb.chroot
-import pmb.chroot.initfs
-import pmb.chroot.other
-import pmb.ci
+# Only import what is needed for parsing the arguments here, the subsystems
+# get imported in the actions that use them (see pmb/__init__.py)
 import pmb.config
-import pmb.export
-import pmb.flasher
-import pmb.helpers.aportupgrade
 import pmb.helpers.devices
 import pmb.helpers.git
-import pmb.helpers.lint
 import pmb.helpers.logging
-import pmb.helpers.pkgrel_bump
 import pmb.helpers.pmaports
-import pmb.helpers.repo
-import pmb.helpers.repo_missing
 import pmb.helpers.run
 import pmb.helpers.status
-import pmb.install
-import pmb.install.blockdevice
-import pmb.netboot
 import pmb.parse
-import pmb.qemu
-import pmb.sideload
 
 
 def _parse_flavor(args, autoinstall=True):
@@ -40,6 +23,8 @@ def _parse_flavor(args, autoinstall=True):
     Verify the flavor argument if specified, or return a default value.
     :param autoinstall: make sure that at least one kernel flavor is installed
     """
+    import pmb.chroot
+    import pmb.chroot.other
     # Install a kernel and get its "flavor", where flavor is a pmOS-specific
     # identifier that is typically in the form
     # "postmarketos-<manufacturer>-<device/chip>", e.g.
@@ -88,12 +73,16 @@ def _install_ondev_verify_no_rootfs(args):
 
 
 def aportgen(args):
+    import pmb.aportgen
     for package in args.packages:
         logging.info("Generate aport: " + package)
         pmb.aportgen.generate(args, package)
 
 
 def build(args):
+    import pmb.build
+    import pmb.build.autodetect
+    import pmb.chroot
     # Strict mode: zap everything
     if args.strict:
         pmb.chroot.zap(args, False)
@@ -120,11 +109,13 @@ def build(args):
 
 
 def build_init(args):
+    import pmb.build
     suffix = _parse_suffix(args)
     pmb.build.init(args, suffix)
 
 
 def checksum(args):
+    import pmb.build
     for package in args.packages:
         if args.verify:
             pmb.build.checksum.verify(args, package)
@@ -133,21 +124,27 @@ def checksum(args):
 
 
 def sideload(args):
+    import pmb.sideload
     arch = args.deviceinfo["arch"]
     if args.arch:
         arch = args.arch
     user = args.user
-    host = args.host
-    pmb.sideload.sideload(args, user, host, args.port, arch, args.install_key,
-                          args.packages)
+    hosts = args.hosts or ["172.16.42.1"]
+    pmb.sideload.sideload(args, user, hosts, args.port, arch,
+                          args.install_key, args.packages)
 
 
 def netboot(args):
+    import pmb.netboot
     if args.action_netboot == "serve":
         pmb.netboot.start_nbd_server(args)
 
 
 def chroot(args):
+    import pmb.chroot
+    import pmb.chroot.other
+    import pmb.install
+    import pmb.install.blockdevice
     # Suffix
     suffix = _parse_suffix(args)
     if (args.user and suffix != "native" and
@@ -218,33 +215,62 @@ def config(args):
 
 
 def repo_missing(args):
-    missing = pmb.helpers.repo_missing.generate(args, args.arch, args.overview,
-                                                args.package, args.built)
+    import pmb.helpers.repo_missing
+    if args.all_arches:
+        missing = pmb.helpers.repo_missing.generate_arches(
+            args, pmb.config.build_device_architectures, args.overview,
+            args.package, args.built, args.parallel)
+    else:
+        missing = pmb.helpers.repo_missing.generate(args, args.arch,
+                                                    args.overview,
+                                                    args.package, args.built)
     print(json.dumps(missing, indent=4))
 
 
+def repo(args):
+    import pmb.helpers.repo_publish
+    if args.action_repo == "publish":
+        pmb.helpers.repo_publish.publish(args, args.dest, args.arches,
+                                         args.port, args.dry)
+
+
 def index(args):
+    import pmb.build
     pmb.build.index_repo(args)
 
 
 def initfs(args):
+    import pmb.chroot
+    import pmb.chroot.initfs
     pmb.chroot.initfs.frontend(args)
 
 
 def install(args):
+    import pmb.install
     if args.no_fde:
         logging.warning("WARNING: --no-fde is deprecated,"
                         " as it is now the default.")
     if args.rsync and args.full_disk_encryption:
         raise ValueError("Installation using rsync is not compatible with full"
                          " disk encryption.")
-    if args.rsync and not args.disk:
-        raise ValueError("Installation using rsync only works with --disk.")
+    if args.rsync and (args.android_recovery_zip or args.no_image):
+        raise ValueError("Installation using rsync only works with --disk or"
+                         " image files.")
 
     if args.rsync and args.filesystem == "btrfs":
         raise ValueError("Installation using rsync"
                         " is not currently supported on btrfs filesystem.")
 
+    if args.mkfs_populate:
+        if args.rsync:
+            raise ValueError("--mkfs-populate cannot be combined with --rsync")
+        if args.full_disk_encryption:
+            raise ValueError("--mkfs-populate is not compatible with full disk"
+                             " encryption.")
+        if pmb.install.get_root_filesystem(args) != "ext4":
+            raise ValueError("--mkfs-populate only works with the ext4 root"
+                             " filesystem.")
+
     # On-device installer checks
     # Note that this can't be in the mutually exclusive group that has most of
     # the conflicting options, because then it would not work with --disk.
@@ -330,14 +356,17 @@ def install(args):
 
 
 def flasher(args):
+    import pmb.flasher
     pmb.flasher.frontend(args)
 
 
 def export(args):
+    import pmb.export
     pmb.export.frontend(args)
 
 
 def update(args):
+    import pmb.helpers.repo
     existing_only = not args.non_existing
     if not pmb.helpers.repo.update(args, args.arch, True, existing_only):
         logging.info("No APKINDEX files exist, so none have been updated."
@@ -349,6 +378,7 @@ def update(args):
 
 
 def newapkbuild(args):
+    import pmb.build
     # Check for SRCURL usage
     is_url = False
     for prefix in ["http://", "https://", "ftp://"]:
@@ -380,6 +410,7 @@ def newapkbuild(args):
 
 
 def kconfig(args):
+    import pmb.build
     if args.action_kconfig == "check":
         details = args.kconfig_check_details
         # Build the components list from cli arguments (--waydroid etc.)
@@ -467,19 +498,22 @@ def apkbuild_parse(args):
 
 
 def apkindex_parse(args):
+    import pmb.parse.apkindex
     result = pmb.parse.apkindex.parse(args.apkindex_path)
     if args.package:
         if args.package not in result:
             raise RuntimeError("Package not found in the APKINDEX: " +
                                args.package)
         result = result[args.package]
-    print(json.dumps(result, indent=4))
+    print(json.dumps(result, indent=4, default=dict))
 
 
 def pkgrel_bump(args):
+    import pmb.helpers.pkgrel_bump
     would_bump = True
     if args.auto:
-        would_bump = pmb.helpers.pkgrel_bump.auto(args, args.dry)
+        would_bump = pmb.helpers.pkgrel_bump.auto(args, args.dry,
+                                                   args.report)
     else:
         # Each package must exist
         for package in args.packages:
@@ -495,6 +529,7 @@ def pkgrel_bump(args):
 
 
 def aportupgrade(args):
+    import pmb.helpers.aportupgrade
     if args.all or args.all_stable or args.all_git:
         pmb.helpers.aportupgrade.upgrade_all(args)
     else:
@@ -508,15 +543,18 @@ def aportupgrade(args):
 
 
 def qemu(args):
+    import pmb.qemu
     pmb.qemu.run(args)
 
 
 def shutdown(args):
+    import pmb.chroot
     pmb.chroot.shutdown(args)
 
 
 def stats(args):
     # Chroot suffix
+    import pmb.chroot
     suffix = "native"
     if args.arch != pmb.config.arch_native:
         suffix = "buildroot_" + args.arch
@@ -555,17 +593,20 @@ def log(args):
 
 
 def zap(args):
+    import pmb.chroot
     pmb.chroot.zap(args, dry=args.dry, http=args.http,
                    distfiles=args.distfiles, pkgs_local=args.pkgs_local,
                    pkgs_local_mismatch=args.pkgs_local_mismatch,
                    pkgs_online_mismatch=args.pkgs_online_mismatch,
-                   rust=args.rust, netboot=args.netboot)
+                   rust=args.rust, netboot=args.netboot, gc=args.gc,
+                   gc_keep=args.gc_keep)
 
     # Don't write the "Done" message
     pmb.helpers.logging.disable()
 
 
 def bootimg_analyze(args):
+    import pmb.aportgen
     bootimg = pmb.parse.bootimg(args, args.path)
     tmp_output = "Put these variables in the deviceinfo file of your device:\n"
     for line in pmb.aportgen.device.\
@@ -601,6 +642,7 @@ def pull(args):
 
 
 def lint(args):
+    import pmb.helpers.lint
     packages = args.packages
     if not packages:
         packages = pmb.helpers.pmaports.get_list(args)
@@ -613,7 +655,25 @@ def status(args):
         sys.exit(1)
 
 
+def mirror(args):
+    import pmb.helpers.mirror
+    for kind in pmb.helpers.mirror.kinds:
+        ranking = pmb.helpers.mirror.get_ranking(args, kind, args.probe)
+        if not ranking:
+            logging.info(f"No {kind} mirror could be reached")
+            continue
+        logging.info(f"Fastest {kind} mirrors:")
+        for i, result in enumerate(ranking[:10]):
+            logging.info(f"[{i + 1}]\t{result['url']}"
+                         f" ({result['latency'] * 1000:.0f} ms,"
+                         f" {result['throughput'] / 1024 / 1024:.1f} MiB/s)")
+    logging.info("Use the fastest mirrors automatically with: pmbootstrap"
+                 " config mirror_alpine auto; pmbootstrap config"
+                 " mirrors_postmarketos auto")
+
+
 def ci(args):
+    import pmb.ci
     topdir = pmb.helpers.git.get_topdir(args, os.getcwd())
     if not os.path.exists(topdir):
         logging.error("ERROR: change your current directory to a git"
@@ -5,9 +5,8 @@ import logging
 import os
 import time
 
-import pmb.build
-import pmb.chroot.apk
 import pmb.config
+import pmb.helpers.other
 import pmb.helpers.pmaports
 import pmb.helpers.run
 
@@ -66,6 +65,51 @@ def rev_parse(args, path, revision="HEAD", extra_args: list = []):
     return rev.rstrip()
 
 
+def get_head(path):
+    """ Get the commit that HEAD points to by reading the files in .git,
+        without running git. This is fast enough to run on every TAB press
+        for shell completion.
+
+        :param path: to the git repository
+        :returns: commit string like "90cd0ad84d390897efdcf881c0315747a4f3a966"
+                  or None if it can't be determined (not a git repository,
+                  unborn branch, ...) """
+    git_dir = f"{path}/.git"
+    try:
+        # Worktrees and submodules: .git is a file with "gitdir: <path>"
+        if os.path.isfile(git_dir):
+            with open(git_dir) as handle:
+                git_dir = handle.read().strip().split("gitdir: ", 1)[1]
+            git_dir = os.path.join(path, git_dir)
+
+        with open(f"{git_dir}/HEAD") as handle:
+            head = handle.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[len("ref: "):]
+
+        # Loose or packed ref (e.g. after "git gc"). Worktrees have their
+        # refs in the .git dir of the main repository.
+        git_dirs = [git_dir]
+        if os.path.exists(f"{git_dir}/commondir"):
+            with open(f"{git_dir}/commondir") as handle:
+                git_dirs += [os.path.join(git_dir, handle.read().strip())]
+        for git_dir in git_dirs:
+            if os.path.exists(f"{git_dir}/{ref}"):
+                with open(f"{git_dir}/{ref}") as handle:
+                    return handle.read().strip()
+        for git_dir in git_dirs:
+            if not os.path.exists(f"{git_dir}/packed-refs"):
+                continue
+            with open(f"{git_dir}/packed-refs") as handle:
+                for line in handle:
+                    if line.rstrip().endswith(f" {ref}"):
+                        return line.split(" ", 1)[0]
+    except (OSError, IndexError):
+        pass
+    return None
+
+
 def can_fast_forward(args, path, branch_upstream, branch="HEAD"):
     command = ["git", "merge-base", "--is-ancestor", branch, branch_upstream]
     ret = pmb.helpers.run.user(args, command, path, check=False)
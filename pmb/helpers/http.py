@@ -1,23 +1,214 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import hashlib
+import http.client
 import json
 import logging
 import os
-import shutil
+import threading
+import time
+import urllib.parse
 import urllib.request
 
+import pmb.config
+import pmb.helpers.mirror
+import pmb.helpers.other
 import pmb.helpers.run
 
+# Protects the throughput statistics, downloads may run in multiple threads
+stats_lock = threading.Lock()
+
+
+def get_mirror_urls(args, url):
+    """ Get the URLs to try for downloading a file, so we can fail over to
+        other mirrors.
+
+        :param url: the http(s) address of the file to download
+        :returns: list of URLs, starting with url. If url is on one of the
+                  postmarketOS mirrors (args.mirrors_postmarketos) or on an
+                  Alpine mirror (args.mirror_alpine,
+                  pmb.config.mirrors_alpine_fallback), the same file on the
+                  other mirrors of that kind gets appended. """
+    pmb.helpers.mirror.resolve(args)
+
+    groups = [args.mirrors_postmarketos,
+              [args.mirror_alpine] + pmb.config.mirrors_alpine_fallback]
+    ret = [url]
+    for mirrors in groups:
+        for mirror in mirrors:
+            if not mirror or not url.startswith(mirror):
+                continue
+            path = url[len(mirror):]
+            for other in mirrors:
+                if other and f"{other}{path}" not in ret:
+                    ret.append(f"{other}{path}")
+            return ret
+    return ret
+
+
+def get_stats_path(args):
+    return f"{args.work}/cache_http/stats.json"
+
+
+def get_stats(args):
+    """ Get the download statistics, which are recorded by download() and
+        persist across pmbootstrap runs.
+
+        :returns: dict of hosts and their statistics, e.g.:
+                  {"mirror.postmarketos.org": {"throughput": 2345678.9,
+                                               "downloads": 12,
+                                               "failures": 1,
+                                               "last": 1700000000.0}}
+                  with throughput in bytes per second (moving average) and
+                  last as timestamp of the last download attempt. """
+    if pmb.helpers.other.cache["pmb.helpers.http.stats"] is None:
+        try:
+            with open(get_stats_path(args)) as handle:
+                stats = json.load(handle)
+        except (OSError, ValueError):
+            stats = {}
+        pmb.helpers.other.cache["pmb.helpers.http.stats"] = stats
+    return pmb.helpers.other.cache["pmb.helpers.http.stats"]
+
+
+def write_stats(args):
+    """ Write the download statistics to disk (see get_stats()). """
+    path = get_stats_path(args)
+    if not os.path.exists(os.path.dirname(path)):
+        return
+
+    # Write atomically, other threads and processes may read it
+    with stats_lock:
+        with open(f"{path}.new", "w") as handle:
+            json.dump(get_stats(args), handle, indent=4)
+        os.replace(f"{path}.new", path)
+
+
+def record_stats(args, url, size=0, duration=0, failed=False,
+                 persist_stats=True):
+    """ Update the download statistics of the host of url (see get_stats()).
+
+        :param size: amount of bytes downloaded
+        :param duration: seconds it took to download them
+        :param failed: set to True if the download failed
+        :param persist_stats: write the statistics to disk. Set to False when
+                              downloading many files at once, and call
+                              write_stats() afterwards. """
+    host = urllib.parse.urlparse(url).netloc
+    with stats_lock:
+        stats = get_stats(args)
+        entry = stats.setdefault(host, {"throughput": None, "downloads": 0,
+                                        "failures": 0})
+        entry["last"] = time.time()
+        if failed:
+            entry["failures"] += 1
+        else:
+            entry["downloads"] += 1
+            throughput = size / max(duration, 0.001)
+            if entry["throughput"] is None:
+                entry["throughput"] = throughput
+            else:
+                entry["throughput"] = (0.7 * entry["throughput"] +
+                                       0.3 * throughput)
+    if persist_stats:
+        write_stats(args)
+
+
+def get_part_path(path, url):
+    """ :returns: path of the partial download of url for the cache file at
+                  path. It depends on the URL, so a download does not get
+                  resumed with data from another mirror. """
+    return f"{path}.{hashlib.sha256(url.encode('utf-8')).hexdigest()[:8]}.part"
+
+
+def download_part(args, url, part, persist_stats=True):
+    """ Download a file, or resume downloading it if part exists.
+
+        :param url: the http(s) address of the file to download
+        :param part: where to write the file to
+        :param persist_stats: see record_stats() """
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request,
+                                          timeout=pmb.config.http_timeout)
+    except urllib.error.HTTPError as e:
+        # Partial file is complete already or invalid: start over
+        if e.code == 416 and offset:
+            os.remove(part)
+            return download_part(args, url, part, persist_stats)
+        raise
+
+    with response:
+        # Server may ignore the Range header and send the whole file
+        mode = "ab"
+        if response.status != 206:
+            mode = "wb"
+            offset = 0
+        if offset:
+            logging.debug(f"Resume download at {offset} bytes: {url}")
+
+        size = 0
+        start = time.monotonic()
+        with open(part, mode) as handle:
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                handle.write(chunk)
+                size += len(chunk)
+
+        # urllib does not complain if the connection closes early
+        length = response.headers.get("Content-Length")
+        if length and size != int(length):
+            raise http.client.IncompleteRead(b"", int(length) - size)
+    record_stats(args, url, size, time.monotonic() - start, False,
+                 persist_stats)
+
+
+def download_retry(args, url, part, persist_stats=True):
+    """ Run download_part() and retry with increasing delays on network
+        errors and temporary server errors.
+
+        :param persist_stats: see record_stats()
+
+        :raises: the last error, if all retries failed """
+    for attempt in range(pmb.config.http_retries + 1):
+        if attempt:
+            delay = pmb.config.http_retry_delay * 2 ** (attempt - 1)
+            logging.debug(f"Retrying in {delay}s ({attempt}/"
+                          f"{pmb.config.http_retries}): {url}")
+            time.sleep(delay)
+        try:
+            return download_part(args, url, part, persist_stats)
+        except urllib.error.HTTPError as e:
+            if e.code not in [408, 429] and e.code < 500:
+                raise
+            error = e
+        except (OSError, http.client.HTTPException) as e:
+            # URLError (e.g. connection refused), timeouts, connection reset,
+            # incomplete read
+            error = e
+        logging.debug(f"Download failed: {url}: {error}")
+        record_stats(args, url, failed=True, persist_stats=persist_stats)
+    raise error
+
 
 def download(args, url, prefix, cache=True, loglevel=logging.INFO,
-             allow_404=False):
+             allow_404=False, persist_stats=True):
     """ Download a file to disk.
 
+        Partial downloads are written next to the cache file and only moved
+        to the cache file when complete. After network errors, the download
+        gets retried and resumed. If that does not help, the next mirror from
+        get_mirror_urls() is tried.
+
         :param url: the http(s) address of to the file to download
         :param prefix: for the cache, to make it easier to find (cache files
                        get a hash of the URL after the prefix)
-        :param cache: if True, and url is cached, do not download it again
+        :param cache: if True, and url is cached, do not download it again.
+                      If False, do not resume partial downloads either.
         :param loglevel: change to logging.DEBUG to only display the download
                          message in 'pmbootstrap log', not in stdout. We use
                          this when downloading many APKINDEX files at once, no
@@ -25,6 +216,7 @@ def download(args, url, prefix, cache=True, loglevel=logging.INFO,
         :param allow_404: do not raise an exception when the server responds
                           with a 404 Not Found error. Only display a warning on
                           stdout (no matter if loglevel is changed).
+        :param persist_stats: see record_stats()
         :returns: path to the downloaded file in the cache or None on 404 """
     # Create cache folder
     if not os.path.exists(args.work + "/cache_http"):
@@ -46,19 +238,35 @@ def download(args, url, prefix, cache=True, loglevel=logging.INFO,
 
     # Download the file
     logging.log(loglevel, "Download " + url)
-    try:
-        with urllib.request.urlopen(url) as response:
-            with open(path, "wb") as handle:
-                shutil.copyfileobj(response, handle)
-    # Handle 404
-    except urllib.error.HTTPError as e:
-        if e.code == 404 and allow_404:
-            logging.warning("WARNING: file not found: " + url)
-            return None
-        raise
+    error_404 = None
+    error = None
+    for mirror_url in get_mirror_urls(args, url):
+        if mirror_url != url:
+            logging.log(loglevel, f"Trying another mirror: {mirror_url}")
+        part = get_part_path(path, mirror_url)
+        if not cache and os.path.exists(part):
+            os.remove(part)
+        try:
+            download_retry(args, mirror_url, part, persist_stats)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                error_404 = error_404 or e
+            else:
+                error = e
+            logging.debug(f"Download failed: {mirror_url}: {e}")
+            continue
+        except (OSError, http.client.HTTPException) as e:
+            error = e
+            logging.warning(f"WARNING: download failed: {mirror_url}: {e}")
+            continue
+        os.replace(part, path)
+        return path
 
-    # Return path in cache
-    return path
+    # Handle 404
+    if not error and allow_404:
+        logging.warning("WARNING: file not found: " + url)
+        return None
+    raise error or error_404
 
 
 def retrieve(url, headers=None, allow_404=False):
@@ -78,7 +286,8 @@ def retrieve(url, headers=None, allow_404=False):
 
     req = urllib.request.Request(url, headers=headers)
     try:
-        with urllib.request.urlopen(req) as response:
+        with urllib.request.urlopen(req, timeout=pmb.config.http_timeout) \
+                as response:
             return response.read()
     # Handle 404
     except urllib.error.HTTPError as e:
@@ -1,16 +1,32 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import atexit
+import json
 import logging
 import os
+import queue
 import sys
+import threading
 import pmb.config
 
 logfd = None
 
+# Path to the JSON lines log (pmbootstrap --log-json), or None
+log_json_path = None
+
+# Queue of (line, line_json) for log_writer(), and its thread
+log_queue = queue.Queue()
+writer = None
+
+# (old, new) pairs for colorize(), filled on first use
+colors = None
+
 
 class log_handler(logging.StreamHandler):
     """
-    Write to stdout and to the already opened log file.
+    Write to stdout and to the already opened log file. Records for the log
+    file go through a queue to a writer thread (see log_writer()), which
+    writes and flushes them in batches.
     """
     _args = None
 
@@ -21,52 +37,21 @@ class log_handler(logging.StreamHandler):
             # INFO or higher: Write to stdout
             if (not self._args.details_to_stdout and
                 not self._args.quiet and
-                    record.levelno >= logging.INFO):
+                    record.levelno >= logging.INFO and
+                    not getattr(record, "log_json_only", False)):
                 stream = self.stream
-
-                styles = pmb.config.styles
-
-                msg_col = (
-                    msg.replace(
-                        "NOTE:",
-                        f"{styles['BLUE']}NOTE:{styles['END']}",
-                        1,
-                    )
-                    .replace(
-                        "WARNING:",
-                        f"{styles['YELLOW']}WARNING:{styles['END']}",
-                        1,
-                    )
-                    .replace(
-                        "ERROR:",
-                        f"{styles['RED']}ERROR:{styles['END']}",
-                        1,
-                    )
-                    .replace(
-                        "DONE!",
-                        f"{styles['GREEN']}DONE!{styles['END']}",
-                        1,
-                    )
-                    .replace(
-                        "*** ",
-                        f"{styles['GREEN']}*** ",
-                        1,
-                    )
-                    .replace(
-                        " ***",
-                        f" ***{styles['END']}",
-                        1,
-                    )
-                )
-
-                stream.write(msg_col)
+                stream.write(colorize(msg))
                 stream.write(self.terminator)
                 self.flush()
 
-            # Everything: Write to logfd
-            msg = "(" + str(os.getpid()).zfill(6) + ") " + msg
-            logfd.write(msg + "\n")
-            logfd.flush()
+            # Everything: Write to logfd (and the JSON lines log)
+            line = None
+            if not getattr(record, "log_json_only", False):
+                line = f"({str(record.process).zfill(6)}) {msg}\n"
+            line_json = None
+            if log_json_path:
+                line_json = format_json(record)
+            log_queue.put((line, line_json))
 
         except (KeyboardInterrupt, SystemExit):
             raise
@@ -74,6 +59,107 @@ class log_handler(logging.StreamHandler):
             self.handleError(record)
 
 
+def colorize(msg):
+    """ Highlight the first NOTE:, WARNING:, ... in a message for stdout """
+    global colors
+    if colors is None:
+        styles = pmb.config.styles
+        colors = [("NOTE:", f"{styles['BLUE']}NOTE:{styles['END']}"),
+                  ("WARNING:", f"{styles['YELLOW']}WARNING:{styles['END']}"),
+                  ("ERROR:", f"{styles['RED']}ERROR:{styles['END']}"),
+                  ("DONE!", f"{styles['GREEN']}DONE!{styles['END']}"),
+                  ("*** ", f"{styles['GREEN']}*** "),
+                  (" ***", f" ***{styles['END']}")]
+        colors = [(old, new) for old, new in colors if old != new]
+    for old, new in colors:
+        if old in msg:
+            msg = msg.replace(old, new, 1)
+    return msg
+
+
+def format_json(record):
+    """
+    Format a log record as one line of JSON. The pid is the one of the
+    pmbootstrap process, except for the record that pmb.helpers.run_core.core()
+    logs after running a command: it has the command's pid (passed with
+    extra=) and additional fields, e.g.:
+    {"time": 1700000000.123, "level": "DEBUG", "pid": 1234,
+     "msg": "(native) % echo test: exit code 0", "suffix": "native",
+     "command": "echo test", "exit_code": 0, "duration": 0.012}
+    """
+    ret = {"time": round(record.created, 3),
+           "level": record.levelname,
+           "pid": record.process,
+           "msg": record.getMessage()}
+    ret.update(getattr(record, "log_json", {}))
+    return json.dumps(ret) + "\n"
+
+
+def log_writer():
+    """
+    Write the queued log lines. Block until there is at least one line, then
+    write everything that is in the queue and flush once. Runs in a separate
+    thread, see init().
+    """
+    handle_json = None
+    handle_json_path = None
+    while True:
+        batch = [log_queue.get()]
+        while True:
+            try:
+                batch.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            if log_json_path != handle_json_path:
+                if handle_json:
+                    handle_json.close()
+                handle_json = None
+                handle_json_path = log_json_path
+                if log_json_path:
+                    handle_json = open(log_json_path, "a")
+
+            # Text written to logfd directly (e.g. print() with
+            # --details-to-stdout) must come first
+            logfd.flush()
+            lines = []
+            lines_json = []
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    continue
+                line, line_json = item
+                if line:
+                    lines.append(line)
+                if line_json:
+                    lines_json.append(line_json)
+            logfd.buffer.write("".join(lines).encode("utf-8"))
+            logfd.flush()
+            if handle_json:
+                handle_json.write("".join(lines_json))
+                handle_json.flush()
+        except (OSError, ValueError):
+            # logfd was closed (e.g. at the end of a test)
+            pass
+
+        for item in batch:
+            if isinstance(item, threading.Event):
+                item.set()
+
+
+def flush():
+    """
+    Wait until the writer thread has written all queued log lines. Call this
+    before writing to logfd directly, e.g. before running a program that
+    writes its output to the log, so the log lines stay in order.
+    """
+    if not writer or not writer.is_alive():
+        return
+    event = threading.Event()
+    log_queue.put(event)
+    event.wait()
+
+
 def add_verbose_log_level():
     """
     Add a new log level "verbose", which is below "debug". Also monkeypatch
@@ -99,6 +185,12 @@ def init(args):
     verbose log level.
     """
     global logfd
+    global log_json_path
+    global writer
+
+    # Write pending lines to the previous logfd
+    flush()
+
     # Set log file descriptor (logfd)
     if args.details_to_stdout:
         logfd = sys.stdout
@@ -121,17 +213,33 @@ def init(args):
     formatter = logging.Formatter("[%(asctime)s] %(message)s",
                                   datefmt="%H:%M:%S")
 
+    # Don't collect information for log records that pmbootstrap doesn't
+    # use (caller's source file and line, thread and process names), see
+    # "Optimization" in the Python logging HOWTO
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+
     # Set log level
     add_verbose_log_level()
     root_logger.setLevel(logging.DEBUG)
     if args.verbose:
         root_logger.setLevel(logging.VERBOSE)
 
-    # Add a custom log handler
+    # JSON lines log next to the regular log (e.g. log.jsonl)
+    log_json_path = None
+    if getattr(args, "log_json", False):
+        log_json_path = os.path.splitext(args.log)[0] + ".jsonl"
+
+    # Add a custom log handler, start the log writer thread
     handler = log_handler()
     log_handler._args = args
     handler.setFormatter(formatter)
     root_logger.addHandler(handler)
+    if not writer:
+        writer = threading.Thread(target=log_writer, daemon=True)
+        writer.start()
+        atexit.register(flush)
 
 
 def disable():
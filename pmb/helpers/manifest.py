@@ -0,0 +1,216 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Manifest of the local package repository ($WORK/packages/$CHANNEL), stored
+in a SQLite database at $WORK/cache_manifest/$CHANNEL.sqlite (the packages
+folder belongs to the chroot user). For each package it stores the origin,
+version, build time, size, checksums and the hash of the aport it was built
+from, so code that needs to know which packages were built locally can query
+it instead of parsing the APKINDEX and stat'ing the apk files.
+
+The manifest gets synced with the APKINDEX.tar.gz of each arch whenever the
+APKINDEX changed (abuild and pmb.build.index_repo() rewrite it after every
+build). Only new or changed apk files get hashed during sync. The result of
+packages() is cached for the current pmbootstrap session, the cache gets
+cleared after building packages and in pmb.build.index_repo().
+
+Apk files that get removed without updating the APKINDEX (e.g. by hand)
+stay in the manifest until the next sync, so code that needs the file must
+check that it still exists.
+"""
+import contextlib
+import glob
+import hashlib
+import logging
+import os
+import sqlite3
+
+import pmb.config.pmaports
+import pmb.helpers.other
+import pmb.parse.apkindex
+
+schema = """
+CREATE TABLE IF NOT EXISTS packages (
+    arch TEXT NOT NULL,
+    pkgname TEXT NOT NULL,
+    version TEXT NOT NULL,
+    origin TEXT,
+    build_time INTEGER,
+    size INTEGER,
+    mtime INTEGER,
+    checksum TEXT,
+    sha256 TEXT,
+    aport_hash TEXT,
+    PRIMARY KEY (arch, pkgname, version)
+);
+CREATE TABLE IF NOT EXISTS indexes (
+    arch TEXT PRIMARY KEY,
+    lastmod INTEGER
+);
+"""
+
+
+def get_path(args):
+    """ :returns: path to the manifest of the current channel """
+    channel = pmb.config.pmaports.read_config(args)["channel"]
+    return f"{args.work}/cache_manifest/{channel}.sqlite"
+
+
+def connect(args):
+    """ Open the manifest and create its tables if necessary.
+
+        :returns: sqlite3 connection, rows can be accessed like dicts """
+    path = get_path(args)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(schema)
+    return conn
+
+
+def get_sha256(path):
+    """ :returns: sha256 checksum of a file as hex string """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_aport_hash(path):
+    """ :param path: path to an aport folder
+        :returns: sha256 checksum of all file names and contents in the aport
+                  folder, to find out later if a package was built from the
+                  same aport """
+    sha256 = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            sha256.update(os.path.relpath(file_path, path).encode() + b"\0")
+            with open(file_path, "rb") as handle:
+                sha256.update(handle.read())
+            sha256.update(b"\0")
+    return sha256.hexdigest()
+
+
+def update(args, conn, arch):
+    """ Sync the manifest of one arch with its APKINDEX.tar.gz, if the
+        APKINDEX changed since the last sync.
+
+        :param conn: return value of connect() """
+    channel = pmb.config.pmaports.read_config(args)["channel"]
+    path_repo = f"{args.work}/packages/{channel}/{arch}"
+    path_index = f"{path_repo}/APKINDEX.tar.gz"
+    lastmod = None
+    if os.path.exists(path_index):
+        lastmod = os.stat(path_index).st_mtime_ns
+
+    row = conn.execute("SELECT lastmod FROM indexes WHERE arch = ?",
+                       (arch,)).fetchone()
+    if row and row["lastmod"] == lastmod:
+        return
+
+    logging.verbose(f"Updating manifest of the local {arch} repository")
+    old = {(row["pkgname"], row["version"]): row for row in
+           conn.execute("SELECT * FROM packages WHERE arch = ?", (arch,))}
+    blocks = pmb.parse.apkindex.parse_blocks(path_index) if lastmod else []
+    rows = []
+    for block in blocks:
+        pkgname = block["pkgname"]
+        version = block["version"]
+        path_apk = f"{path_repo}/{pkgname}-{version}.apk"
+        if not os.path.exists(path_apk):
+            logging.info("WARNING: Package mentioned in index not found:"
+                         f" {arch}/{pkgname}-{version}.apk")
+            continue
+
+        # Only hash new or changed files
+        stat = os.stat(path_apk)
+        row = old.get((pkgname, version))
+        if row and row["checksum"] == block.get("checksum") and \
+                row["size"] == stat.st_size and \
+                row["mtime"] == stat.st_mtime_ns:
+            sha256 = row["sha256"]
+            aport_hash = row["aport_hash"]
+        else:
+            sha256 = get_sha256(path_apk)
+            aport_hash = None
+        rows.append((arch, pkgname, version, block.get("origin"),
+                     int(block["timestamp"]), stat.st_size,
+                     stat.st_mtime_ns, block.get("checksum"), sha256,
+                     aport_hash))
+
+    clear_cache()
+    with conn:
+        conn.execute("DELETE FROM packages WHERE arch = ?", (arch,))
+        conn.executemany("INSERT OR REPLACE INTO packages VALUES"
+                         " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO indexes VALUES (?, ?)",
+                     (arch, lastmod))
+
+
+def sync(args, arch=None):
+    """ Sync the manifest with the APKINDEX files of the local repository.
+
+        :param arch: only sync this arch (default: all arches) """
+    channel = pmb.config.pmaports.read_config(args)["channel"]
+    if arch:
+        arches = [arch]
+    else:
+        arches = [os.path.basename(path) for path in
+                  glob.glob(f"{args.work}/packages/{channel}/*")
+                  if os.path.isdir(path)]
+
+    with contextlib.closing(connect(args)) as conn:
+        for arch_sync in arches:
+            update(args, conn, arch_sync)
+
+
+def clear_cache():
+    """ Clear the cache of packages(), so it looks at the APKINDEX files
+        again. """
+    pmb.helpers.other.cache["pmb.helpers.manifest.packages"].clear()
+
+
+def packages(args, arch=None):
+    """ Get all packages in the local repository (cached for the current
+        pmbootstrap session, see clear_cache()).
+
+        :param arch: only get packages of this arch (default: all arches)
+        :returns: list of dicts with the columns of the packages table, e.g.
+                  [{"arch": "x86_64", "pkgname": "hello-world",
+                    "version": "1-r6", "origin": "hello-world",
+                    "build_time": 1700000000, "size": 5678,
+                    "mtime": 1700000000000000000, "checksum": "Q1...",
+                    "sha256": "1a2b...", "aport_hash": "3c4d..."}, ...] """
+    cache = pmb.helpers.other.cache["pmb.helpers.manifest.packages"]
+    if arch in cache:
+        return cache[arch]
+
+    sync(args, arch)
+    query = "SELECT * FROM packages"
+    params = ()
+    if arch:
+        query += " WHERE arch = ?"
+        params = (arch,)
+    query += " ORDER BY arch, pkgname, version"
+    with contextlib.closing(connect(args)) as conn:
+        ret = [dict(row) for row in conn.execute(query, params)]
+    cache[arch] = ret
+    return ret
+
+
+def set_aport_hash(args, arch, origin, version, aport_hash):
+    """ Remember the aport a package and its subpackages were built from.
+
+        :param origin: pkgname of the aport
+        :param version: pkgver-rpkgrel of the aport
+        :param aport_hash: get_aport_hash() of the aport folder """
+    with contextlib.closing(connect(args)) as conn:
+        update(args, conn, arch)
+        clear_cache()
+        with conn:
+            conn.execute("UPDATE packages SET aport_hash = ? WHERE arch = ?"
+                         " AND origin = ? AND version = ?",
+                         (aport_hash, arch, origin, version))
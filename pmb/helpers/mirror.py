@@ -0,0 +1,256 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Select the fastest mirrors, when args.mirror_alpine is "auto" or
+args.mirrors_postmarketos is ["auto"] ("-m auto", "-mp auto" or the same in
+the config). The beginning of an APKINDEX gets downloaded from all known
+mirrors in parallel, and the ranking is cached in $WORK/cache_http for
+pmb.config.mirror_probe_ttl.
+"""
+import concurrent.futures
+import contextlib
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import pmb.config
+import pmb.config.pmaports
+import pmb.helpers.http
+import pmb.helpers.run
+
+kinds = ["postmarketos", "alpine"]
+
+# See selecting()
+resolve_lock = threading.RLock()
+resolving = False
+
+
+@contextlib.contextmanager
+def selecting():
+    """ Hold resolve_lock and set resolving while selecting mirrors. Getting
+        the mirror lists builds mirror URLs too, resolve() must not select the
+        mirrors again then.
+
+        :returns: True if this is nested in another selecting() block """
+    global resolving
+    with resolve_lock:
+        nested = resolving
+        resolving = True
+        try:
+            yield nested
+        finally:
+            resolving = nested
+
+
+def get_url(urls):
+    """ Pick one URL of a mirror from mirrors.json.
+
+        :param urls: list of URLs of the mirror (http, https, rsync, ...)
+        :returns: the http:// URL if there is one (faster, apk verifies the
+                  signatures anyway), the https:// URL otherwise, or None """
+    links = [url for url in urls if url.startswith("http")]
+    links_http = [url for url in links if url.startswith("http://")]
+    if links_http:
+        return links_http[0]
+    return links[0] if links else None
+
+
+def get_candidates(args, kind):
+    """ Get all mirrors that may get selected.
+
+        :param kind: "postmarketos" or "alpine"
+        :returns: list of mirror URLs, from the mirrors.json of the project
+                  and the defaults of pmbootstrap """
+    if kind == "postmarketos":
+        ret = pmb.config.defaults["mirrors_postmarketos"].split(",")
+        url = pmb.config.mirrors_json_postmarketos
+    else:
+        ret = [pmb.config.defaults["mirror_alpine"]]
+        ret += pmb.config.mirrors_alpine_fallback
+        url = pmb.config.mirrors_json_alpine
+
+    try:
+        with selecting():
+            path = pmb.helpers.http.download(args, url, f"mirrors_{kind}",
+                                             False, logging.DEBUG)
+        with open(path) as handle:
+            mirrors = json.load(handle)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        logging.warning(f"WARNING: failed to get the list of {kind} mirrors,"
+                        f" only trying the default mirrors: {e}")
+        mirrors = {}
+
+    # postmarketos.org: {"name": {"urls": [...]}}, alpinelinux.org: list
+    if isinstance(mirrors, dict):
+        mirrors = mirrors.values()
+    for mirror in mirrors:
+        url = get_url(mirror.get("urls", []))
+        if not url:
+            continue
+        if not url.endswith("/"):
+            url += "/"
+        if url not in ret:
+            ret.append(url)
+    return ret
+
+
+def get_probe_path(args, kind):
+    """ :returns: path of the file to download from each mirror (relative to
+                  the mirror URL) """
+    channel_cfg = pmb.config.pmaports.read_config_channel(args)
+    arch = pmb.config.arch_native
+    if kind == "postmarketos":
+        return f"{channel_cfg['branch_pmaports']}/{arch}/APKINDEX.tar.gz"
+    return f"{channel_cfg['mirrordir_alpine']}/main/{arch}/APKINDEX.tar.gz"
+
+
+def probe(args, mirror, path):
+    """ Measure latency and throughput of a mirror, by downloading the first
+        pmb.config.mirror_probe_size bytes of a file.
+
+        :param mirror: URL of the mirror
+        :param path: file to download, see get_probe_path()
+        :returns: dict with the mirror URL, latency (seconds until the
+                  response headers arrived), throughput (bytes per second)
+                  and score (lower is better), or None if the mirror failed
+    """
+    url = f"{mirror}{path}"
+    size = pmb.config.mirror_probe_size
+    request = urllib.request.Request(url, headers={
+        "Range": f"bytes=0-{size - 1}"})
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(
+                request, timeout=pmb.config.mirror_probe_timeout) as response:
+            latency = time.monotonic() - start
+            received = len(response.read(size))
+    except (OSError, http.client.HTTPException) as e:
+        logging.debug(f"Mirror failed: {url}: {e}")
+        return None
+    if not received:
+        logging.debug(f"Mirror failed: {url}: empty response")
+        return None
+    duration = time.monotonic() - start - latency
+    throughput = received / max(duration, 0.001)
+    pmb.helpers.http.record_stats(args, url, received, duration)
+
+    # Take throughput of previous downloads from this mirror into account,
+    # a small probe alone is not very accurate
+    host = urllib.parse.urlparse(url).netloc
+    recorded = pmb.helpers.http.get_stats(args)[host]["throughput"]
+    if recorded:
+        throughput = (throughput + recorded) / 2
+
+    return {"url": mirror,
+            "latency": latency,
+            "throughput": throughput,
+            "score": latency + size / throughput}
+
+
+def probe_all(args, mirrors, path):
+    """ Probe mirrors in parallel.
+
+        :param mirrors: list of mirror URLs
+        :param path: see get_probe_path()
+        :returns: list of probe() results for the working mirrors, the
+                  fastest first """
+    with concurrent.futures.ThreadPoolExecutor(
+            pmb.config.mirror_probe_jobs) as executor:
+        results = executor.map(lambda mirror: probe(args, mirror, path),
+                               mirrors)
+        ret = [result for result in results if result]
+    return sorted(ret, key=lambda result: result["score"])
+
+
+def get_cache_path(args):
+    return f"{args.work}/cache_http/mirrors.json"
+
+
+def read_cache(args):
+    """ :returns: dict of kinds and their cached ranking, e.g.:
+                  {"alpine": {"time": 1700000000.0,
+                              "mirrors": [probe() result, ...]}} """
+    try:
+        with open(get_cache_path(args)) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_ranking(args, kind, probe_again=False):
+    """ Get the ranking of mirrors from the cache, or probe them if the
+        cache is outdated.
+
+        :param kind: "postmarketos" or "alpine"
+        :param probe_again: probe even if the cache is up-to-date
+        :returns: list of probe() results, the fastest first (may be empty,
+                  e.g. when offline and nothing is cached) """
+    cache = read_cache(args)
+    entry = cache.get(kind)
+    if entry and (args.offline or (not probe_again and time.time() -
+                  entry["time"] < pmb.config.mirror_probe_ttl)):
+        return entry["mirrors"]
+    if args.offline:
+        return []
+
+    mirrors = get_candidates(args, kind)
+    logging.info(f"Finding the fastest {kind} mirror ({len(mirrors)}"
+                 " candidates)")
+    ranking = probe_all(args, mirrors, get_probe_path(args, kind))
+
+    # Network is down, try again next time
+    if not ranking:
+        return entry["mirrors"] if entry else []
+
+    # Write atomically, as in pmb.helpers.completion.update()
+    cache[kind] = {"time": time.time(), "mirrors": ranking}
+    path = get_cache_path(args)
+    if not os.path.exists(os.path.dirname(path)):
+        pmb.helpers.run.user(args, ["mkdir", "-p", os.path.dirname(path)])
+    with open(f"{path}.new", "w") as handle:
+        json.dump(cache, handle, indent=4)
+    os.replace(f"{path}.new", path)
+    return ranking
+
+
+def resolve(args):
+    """ Replace "auto" in args.mirror_alpine and args.mirrors_postmarketos
+        with the fastest mirror. Fall back to the default mirrors if none of
+        them can be reached.
+
+        This gets called wherever mirror URLs get built (e.g.
+        pmb.helpers.repo.urls()), so the mirrors only get selected when they
+        are needed, no matter which action runs. """
+    if args.mirror_alpine != "auto" and args.mirrors_postmarketos != ["auto"]:
+        return
+
+    # Other threads wait until the mirrors are selected
+    with selecting() as nested:
+        if not nested:
+            resolve_auto(args)
+
+
+def resolve_auto(args):
+    """ Do the work of resolve(). """
+    if args.mirrors_postmarketos == ["auto"]:
+        ranking = get_ranking(args, "postmarketos")
+        if ranking:
+            args.mirrors_postmarketos = [ranking[0]["url"]]
+        else:
+            args.mirrors_postmarketos = \
+                pmb.config.defaults["mirrors_postmarketos"].split(",")
+        logging.debug("Selected postmarketOS mirror:"
+                      f" {','.join(args.mirrors_postmarketos)}")
+
+    if args.mirror_alpine == "auto":
+        ranking = get_ranking(args, "alpine")
+        if ranking:
+            args.mirror_alpine = ranking[0]["url"]
+        else:
+            args.mirror_alpine = pmb.config.defaults["mirror_alpine"]
+        logging.debug(f"Selected Alpine mirror: {args.mirror_alpine}")
@@ -3,10 +3,11 @@
 import glob
 import logging
 import os
+import queue
 import re
-import pmb.chroot
 import pmb.config
-import pmb.config.init
+import pmb.helpers.cli
+import pmb.helpers.logging
 import pmb.helpers.pmaports
 import pmb.helpers.run
 
@@ -29,6 +30,82 @@ def folder_size(args, path):
     return ret
 
 
+def folder_size_scandir(path, use_cache=True, args=None, hardlinks_seen=None):
+    """
+    Calculate the size of a folder in-process with os.scandir(), without
+    running `du` as root. Like `du -ks`, hardlinked files are counted once
+    and file systems mounted inside the folder are skipped.
+
+    :param use_cache: remember the sizes of the files directly inside each
+                      folder together with the folder's mtime for this
+                      session. Calling this function again only scans the
+                      folders where files were added, removed or renamed
+                      since then (files changed in place are not noticed).
+    :param args: when set, the size of folders that can't be read by the
+                 current user gets calculated with folder_size() as root.
+                 Otherwise they are skipped and the result is an estimate.
+    :param hardlinks_seen: set of (st_dev, st_ino) of hardlinked files that
+                           were counted already, pass the same set to
+                           multiple calls to count hardlinks between the
+                           folders once
+    :returns: folder size in kilobytes
+    """
+    folders_cache = cache["folder_size"] if use_cache else {}
+    dev = os.lstat(path).st_dev
+    if hardlinks_seen is None:
+        hardlinks_seen = set()
+    ret = 0
+    unreadable = []
+    todo = [path]
+    while todo:
+        folder = todo.pop()
+        try:
+            mtime = os.lstat(folder).st_mtime_ns
+        except OSError:
+            continue
+
+        entry = folders_cache.get(folder)
+        if not entry or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "size": 0, "hardlinks": [],
+                     "folders": []}
+            try:
+                with os.scandir(folder) as it:
+                    for dir_entry in it:
+                        st = dir_entry.stat(follow_symlinks=False)
+                        size = st.st_blocks * 512
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            if st.st_dev != dev:
+                                continue
+                            entry["folders"].append(dir_entry.path)
+                        elif st.st_nlink > 1:
+                            entry["hardlinks"].append(
+                                ((st.st_dev, st.st_ino), size))
+                            continue
+                        entry["size"] += size
+            except OSError as e:
+                logging.debug(f"folder_size_scandir: can't read {folder}:"
+                              f" {e}")
+                unreadable.append(folder)
+                continue
+            folders_cache[folder] = entry
+
+        ret += entry["size"]
+        for inode, size in entry["hardlinks"]:
+            if inode not in hardlinks_seen:
+                hardlinks_seen.add(inode)
+                ret += size
+        todo += entry["folders"]
+
+    ret //= 1024
+    if unreadable and args:
+        for folder in unreadable:
+            ret += folder_size(args, folder)
+    elif unreadable:
+        logging.verbose(f"NOTE: skipped {len(unreadable)} folder(s) that"
+                        f" can't be read in {path}, the size is an estimate")
+    return ret
+
+
 def check_grsec():
     """
     Check if the current kernel is based on the grsec patchset, and if
@@ -87,6 +164,17 @@ def migrate_work_folder(args):
     logging.info("WARNING: Your work folder version needs to be migrated"
                  " (from version " + str(current) + " to " + str(required) +
                  ")!")
+    migrate_work_folder_steps(args, current)
+
+
+def migrate_work_folder_steps(args, current):
+    """
+    Run all migration steps of the work folder, starting at version current.
+    The version file gets updated after each step.
+    """
+    # Imported here to keep parsing arguments fast (see pmb/__init__.py)
+    import pmb.chroot
+    import pmb.config.init
 
     # 0 => 1
     if current == 0:
@@ -281,6 +369,110 @@ def validate_hostname(hostname):
     return True
 
 
+class RemoteTraceback(Exception):
+    """ Traceback of an exception in a child process of run_forked(), set as
+        __cause__ of the exception (like concurrent.futures does). """
+    def __str__(self):
+        return self.args[0]
+
+
+def run_forked_process(func, item, connection):
+    """ Run func(item) in a child process of run_forked(). Log records and
+        the result get sent to the parent process through connection. """
+    import logging.handlers
+    import pickle
+    import traceback
+
+    class PipeHandler(logging.handlers.QueueHandler):
+        def enqueue(self, record):
+            self.queue.send(("log", record))
+
+    # The log writer thread of the parent does not exist in the child
+    handler = PipeHandler(connection)
+    logging.getLogger().handlers = [handler]
+    pmb.helpers.logging.writer = None
+
+    try:
+        ret = ("result", func(item), None)
+    except Exception as e:
+        error = e
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = RuntimeError(f"{type(e).__name__}: {e}")
+        ret = ("result", error, traceback.format_exc())
+    with handler.lock:
+        connection.send(ret)
+
+
+def run_forked(func, items):
+    """
+    Run func(item) for all items at the same time, each in its own forked
+    process. The child processes inherit the caches of the parent process,
+    so fill the caches before calling this to avoid parsing the same files in
+    each process. Their log messages get written to the log of the parent
+    process.
+
+    :param func: function that gets called with one item as parameter, its
+                 return value must be picklable
+    :param items: list of items, e.g. architectures
+    :returns: {item: func(item), ...}
+    """
+    # Imported here to keep parsing arguments fast (see pmb/__init__.py)
+    import multiprocessing
+    import multiprocessing.connection
+
+    if len(items) == 1:
+        return {items[0]: func(items[0])}
+
+    # Fork only after the log writer thread has written everything, so the
+    # children don't inherit pending log lines or a locked log queue
+    pmb.helpers.logging.flush()
+
+    # One pipe per child instead of a shared queue: terminating a child
+    # while it holds the lock of a shared queue would block the others
+    context = multiprocessing.get_context("fork")
+    processes = {}
+    ret = {}
+    try:
+        for item in items:
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(target=run_forked_process,
+                                      args=(func, item, writer))
+            process.start()
+            writer.close()
+            processes[reader] = (item, process)
+
+        readers = list(processes)
+        while readers:
+            for reader in multiprocessing.connection.wait(readers):
+                item = processes[reader][0]
+                try:
+                    message = reader.recv()
+                except EOFError:
+                    readers.remove(reader)
+                    if item not in ret:
+                        raise RuntimeError(f"{item}: child process exited"
+                                           " without result")
+                    continue
+                if message[0] == "log":
+                    logging.getLogger().handle(message[1])
+                    continue
+                _, result, trace = message
+                if trace:
+                    result.__cause__ = RemoteTraceback(f"{item}:\n{trace}")
+                    raise result
+                ret[item] = result
+    finally:
+        for reader, (item, process) in processes.items():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            reader.close()
+
+    return {item: ret[item] for item in items}
+
+
 """
 pmbootstrap uses this dictionary to save the result of expensive
 results, so they work a lot faster the next time they are needed in the
@@ -307,9 +499,16 @@ def init_cache():
              "apk_min_version_checked": [],
              "apk_repository_list_updated": [],
              "built": {},
+             "pmb.chroot.apk_store.gc": False,
              "find_aport": {},
+             "folder_size": {},
              "pmb.helpers.package.depends_recurse": {},
+             "pmb.helpers.manifest.packages": {},
              "pmb.helpers.package.get": {},
+             "pmb.helpers.run_core.background": [],
              "pmb.helpers.repo.update": repo_update,
              "pmb.helpers.git.parse_channels_cfg": {},
+             "pmb.helpers.http.stats": None,
+             "pmb.parse.apkindex.parse_db": {},
+             "pmb.helpers.repo_missing.pmaports_index": None,
              "pmb.config.pmaports.read_config": None}
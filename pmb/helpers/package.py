@@ -5,11 +5,12 @@ Functions that work with both pmaports and binary package repos. See also:
 - pmb/helpers/pmaports.py (work with pmaports)
 - pmb/helpers/repo.py (work with binary package repos)
 """
-import copy
 import logging
 
+import pmb.build._package
 import pmb.helpers.pmaports
 import pmb.helpers.repo
+import pmb.parse.apkindex
 
 
 def remove_operators(package):
@@ -56,10 +57,10 @@ def get(args, pkgname, arch, replace_subpkgnames=False, must_exist=True):
     ret = None
     pmaport = pmb.helpers.pmaports.get(args, pkgname, False)
     if pmaport:
-        ret = {"arch": pmaport["arch"],
+        ret = {"arch": list(pmaport["arch"]),
                "depends": pmb.build._package.get_depends(args, pmaport),
                "pkgname": pmaport["pkgname"],
-               "provides": pmaport["provides"],
+               "provides": list(pmaport["provides"]),
                "version": pmaport["pkgver"] + "-r" + pmaport["pkgrel"]}
 
     # Find in APKINDEX (given arch)
@@ -82,10 +83,11 @@ def get(args, pkgname, arch, replace_subpkgnames=False, must_exist=True):
             if ret:
                 break
 
-    # Copy ret (it might have references to caches of the APKINDEX or APKBUILDs
-    # and we don't want to modify those!)
+    # Copy ret (it might be a read-only APKINDEX block, or have references to
+    # the cached APKBUILDs and we don't want to modify those!). The lists of
+    # APKINDEX blocks are copies already, see pmb.parse.apkindex.Block.
     if ret:
-        ret = copy.deepcopy(ret)
+        ret = dict(ret)
 
     # Make sure ret["arch"] is a list (APKINDEX code puts a string there)
     if ret and isinstance(ret["arch"], str):
@@ -1,11 +1,18 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import json
 import logging
 
+import pmb.config
 import pmb.helpers.file
+import pmb.helpers.other
+import pmb.helpers.package
 import pmb.helpers.pmaports
 import pmb.helpers.repo
+import pmb.helpers.repo_missing
 import pmb.parse
+import pmb.parse.apkindex
+import pmb.parse.version
 
 
 def package(args, pkgname, reason="", dry=False):
@@ -43,88 +50,117 @@ def package(args, pkgname, reason="", dry=False):
                            path)
 
 
-def auto_apkindex_package(args, arch, aport, apk, dry=False):
+def get_providers(args, arch):
     """
-    Bump the pkgrel of a specific package if it is outdated in the given
-    APKINDEX.
+    Get everything that is provided in the APKINDEX files of one arch.
 
     :param arch: the architecture, e.g. "armhf"
-    :param aport: parsed APKBUILD of the binary package's origin:
-                  {"pkgname": ..., "pkgver": ..., "pkgrel": ..., ...}
-    :param apk: information about the binary package from the APKINDEX:
-                {"version": ..., "depends": [...], ...}
-    :param dry: don't modify the APKBUILD, just print the message
-    :returns: True when there was an APKBUILD that needed to be changed.
+    :returns: set of pkgnames and provides of all packages in the APKINDEX
+              files of the arch (including Alpine's), e.g.
+              {"hello-world", "so:libc.musl-armhf.so.1", ...}
     """
-    version_aport = aport["pkgver"] + "-r" + aport["pkgrel"]
-    version_apk = apk["version"]
-    pkgname = aport["pkgname"]
-
-    # Skip when aport version != binary package version
-    compare = pmb.parse.version.compare(version_aport, version_apk)
-    if compare == -1:
-        logging.warning("{}: skipping, because the aport version {} is lower"
-                        " than the binary version {}".format(pkgname,
-                                                             version_aport,
-                                                             version_apk))
-        return
-    if compare == 1:
-        logging.verbose("{}: skipping, because the aport version {} is higher"
-                        " than the binary version {}".format(pkgname,
-                                                             version_aport,
-                                                             version_apk))
-        return
+    ret = set()
+    for path in pmb.helpers.repo.apkindex_files(args, arch):
+        ret.update(pmb.parse.apkindex.parse(path))
+    return ret
+
+
+def auto_arch(args, arch, index):
+    """
+    Find the binary packages of one arch, that depend on something which is
+    not provided anymore (e.g. a library which had a soname bump). Everything
+    the APKINDEX files provide gets collected into one set first, so the
+    depends of each package can be checked with one set difference.
+
+    :param arch: the architecture, e.g. "armhf"
+    :param index: pmb.helpers.repo_missing.get_pmaports_index()
+    :returns: list of packages with missing depends, e.g.
+              [{"pkgname": "testapp", "origin": "testapp",
+                "version": "1.0-r0", "missing": ["so:libtestlib.so.1"]}, ...]
+    """
+    providers = get_providers(args, arch)
+    ret = []
+    for path in pmb.helpers.repo.apkindex_files(args, arch, alpine=False):
+        logging.info(f"scan {path}")
+        apkindex = pmb.parse.apkindex.parse(path, False)
+        for pkgname, apk in apkindex.items():
+            # Skip provides, they point to the same block as the pkgname
+            if pkgname != apk["pkgname"]:
+                continue
+
+            origin = apk["origin"]
+            aport = pmb.helpers.repo_missing.find_aport(args, index, origin)
+            if not aport:
+                logging.warning(f"{pkgname}: origin '{origin}' aport not"
+                                " found")
+                continue
+
+            # Skip when aport version != binary package version
+            apkbuild = index["apkbuilds"][aport]
+            version_aport = f"{apkbuild['pkgver']}-r{apkbuild['pkgrel']}"
+            version_apk = apk["version"]
+            compare = pmb.parse.version.compare(version_aport, version_apk)
+            if compare == -1:
+                logging.warning(f"{pkgname}: skipping, because the aport"
+                                f" version {version_aport} is lower than the"
+                                f" binary version {version_apk}")
+                continue
+            if compare == 1:
+                logging.verbose(f"{pkgname}: skipping, because the aport"
+                                f" version {version_aport} is higher than the"
+                                f" binary version {version_apk}")
+                continue
+
+            # Find missing depends. We're only interested in missing depends
+            # starting with "so:" (which means dynamic libraries that the
+            # package was linked against) and packages for which no aport
+            # exists. Conflict-dependencies are ignored.
+            depends = {pmb.helpers.package.remove_operators(depend): depend
+                       for depend in apk["depends"]
+                       if not depend.startswith("!")}
+            missing = [depends[name] for name in
+                       sorted(depends.keys() - providers)
+                       if name.startswith("so:") or
+                       not pmb.helpers.repo_missing.find_aport(args, index,
+                                                               name)]
+            if missing:
+                ret.append({"pkgname": pkgname, "origin": aport,
+                            "version": version_apk, "missing": missing})
+    return ret
 
-    # Find missing depends
-    depends = apk["depends"]
-    logging.verbose("{}: checking depends: {}".format(pkgname,
-                                                      ", ".join(depends)))
-    missing = []
-    for depend in depends:
-        if depend.startswith("!"):
-            # Ignore conflict-dependencies
-            continue
-
-        providers = pmb.parse.apkindex.providers(args, depend, arch,
-                                                 must_exist=False)
-        if providers == {}:
-            # We're only interested in missing depends starting with "so:"
-            # (which means dynamic libraries that the package was linked
-            # against) and packages for which no aport exists.
-            if (depend.startswith("so:") or
-                    not pmb.helpers.pmaports.find(args, depend, False)):
-                missing.append(depend)
-
-    # Increase pkgrel
-    if len(missing):
-        package(args, pkgname, reason=", missing depend(s): " +
-                ", ".join(missing), dry=dry)
-        return True
-
-
-def auto(args, dry=False):
+
+def auto(args, dry=False, report=None):
     """
+    Increase the pkgrel of all aports, whose binary packages depend on
+    something that is not provided anymore. All arches get scanned at the
+    same time, in one process per arch.
+
+    :param dry: don't modify the APKBUILDs, just print the messages
+    :param report: path to a file where the missing depends get written to
+                   as JSON: {"armhf": auto_arch() of armhf, ...}
     :returns: list of aport names, where the pkgrel needed to be changed
     """
+    # Parse pmaports before forking, so each process has it in its cache
+    index = pmb.helpers.repo_missing.get_pmaports_index(args)
+    arches = pmb.config.build_device_architectures
+    missing = pmb.helpers.other.run_forked(
+        lambda arch: auto_arch(args, arch, index), arches)
+
+    if report:
+        with open(report, "w") as handle:
+            json.dump(missing, handle, indent=4)
+            handle.write("\n")
+
     ret = []
-    for arch in pmb.config.build_device_architectures:
-        paths = pmb.helpers.repo.apkindex_files(args, arch, alpine=False)
-        for path in paths:
-            logging.info("scan " + path)
-            index = pmb.parse.apkindex.parse(path, False)
-            for pkgname, apk in index.items():
-                origin = apk["origin"]
-                # Only increase once!
-                if origin in ret:
-                    logging.verbose(
-                        f"{pkgname}: origin '{origin}' found again")
-                    continue
-                aport_path = pmb.helpers.pmaports.find(args, origin, False)
-                if not aport_path:
-                    logging.warning("{}: origin '{}' aport not found".format(
-                                    pkgname, origin))
-                    continue
-                aport = pmb.parse.apkbuild(f"{aport_path}/APKBUILD")
-                if auto_apkindex_package(args, arch, aport, apk, dry):
-                    ret.append(pkgname)
+    for arch in arches:
+        for apk in missing[arch]:
+            # Only increase once!
+            origin = apk["origin"]
+            if origin in ret:
+                logging.verbose(f"{apk['pkgname']}: origin '{origin}' found"
+                                " again")
+                continue
+            package(args, origin, reason=", missing depend(s): " +
+                    ", ".join(apk["missing"]), dry=dry)
+            ret.append(origin)
     return ret
@@ -9,6 +9,8 @@ import glob
 import logging
 import os
 
+import pmb.helpers.completion
+import pmb.helpers.other
 import pmb.parse
 
 
@@ -33,6 +35,7 @@ def _find_apkbuilds(args):
 
     # Save result in cache
     pmb.helpers.other.cache["pmb.helpers.pmaports.apkbuilds"] = apkbuilds
+    pmb.helpers.completion.update(args, apkbuilds)
     return apkbuilds
 
 
@@ -208,6 +211,8 @@ def get(args, pkgname, must_exist=True, subpackages=True):
                     "options": [],
                     ... }
     """
+    # Imported here to keep parsing arguments fast (see pmb/__init__.py)
+    import pmb.helpers.package
     pkgname = pmb.helpers.package.remove_operators(pkgname)
     if subpackages:
         aport = find(args, pkgname, must_exist)
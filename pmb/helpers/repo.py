@@ -9,7 +9,11 @@ import os
 import hashlib
 import logging
 import pmb.config.pmaports
+import pmb.helpers.cli
+import pmb.helpers.file
 import pmb.helpers.http
+import pmb.helpers.mirror
+import pmb.helpers.other
 import pmb.helpers.run
 
 
@@ -51,6 +55,9 @@ def urls(args, user_repository=True, postmarketos_mirror=True, alpine=True):
     """
     ret = []
 
+    # Select the mirrors, if "auto" is set
+    pmb.helpers.mirror.resolve(args)
+
     # Get mirrordirs from channels.cfg (postmarketOS mirrordir is the same as
     # the pmaports branch of the channel, no need to make it more complicated)
     channel_cfg = pmb.config.pmaports.read_config_channel(args)
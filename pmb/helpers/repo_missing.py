@@ -1,10 +1,132 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import json
 import logging
+import os
 
 import pmb.build
+import pmb.helpers.other
 import pmb.helpers.package
 import pmb.helpers.pmaports
+import pmb.helpers.repo
+import pmb.parse
+import pmb.parse.version
+
+# Format of $WORK/cache_pmaports/index.json, increase it when the format or
+# the output of pmb.parse.apkbuild() changes, so old files get ignored
+pmaports_index_version = 1
+
+
+def get_pmaports_index(args):
+    """ Parse all APKBUILDs of pmaports at once. The result gets stored in
+        $WORK/cache_pmaports/index.json, so the next call only needs to parse
+        the APKBUILDs that changed since then. The parsed APKBUILDs are put
+        into the cache of pmb.parse.apkbuild(), and the aports of all
+        pkgnames into the cache of pmb.helpers.pmaports.find(). The filter
+        functions below look at all aports of the index at once.
+
+        :returns: {"apkbuilds": {"hello-world": apkbuild, ...},
+                   "paths": {"hello-world": "/.../main/hello-world", ...},
+                   "providers": {"hello-world-doc": ["hello-world"], ...}}
+                  with providers containing the aports for all subpackages
+                  and provides (with version) of the APKBUILDs """
+    cache_key = "pmb.helpers.repo_missing.pmaports_index"
+    if pmb.helpers.other.cache[cache_key]:
+        return pmb.helpers.other.cache[cache_key]
+
+    path_index = f"{args.work}/cache_pmaports/index.json"
+    try:
+        with open(path_index) as handle:
+            index_old = json.load(handle)
+    except (OSError, ValueError):
+        index_old = {}
+    files_old = {}
+    if index_old.get("version") == pmaports_index_version:
+        files_old = index_old["files"]
+
+    ret = {"apkbuilds": {}, "paths": {}, "providers": {}}
+    files = {}
+    for pkgname in pmb.helpers.pmaports.get_list(args):
+        aport = pmb.helpers.pmaports.find(args, pkgname)
+        path = f"{aport}/APKBUILD"
+        stat = os.stat(path)
+        entry = files_old.get(path)
+        if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            apkbuild = pmb.helpers.other.cache["apkbuild"].setdefault(
+                path, entry[2])
+        else:
+            apkbuild = pmb.parse.apkbuild(path)
+        files[path] = [stat.st_mtime_ns, stat.st_size, apkbuild]
+        ret["apkbuilds"][pkgname] = apkbuild
+        ret["paths"][pkgname] = aport
+
+        # Same as pmb.helpers.pmaports._find_package_in_apkbuild()
+        provided = list(apkbuild["subpackages"].keys())
+        for apkbuild_pkg in [apkbuild, *apkbuild["subpackages"].values()]:
+            for provides in (apkbuild_pkg or {}).get("provides", []):
+                if "=" in provides:
+                    provided.append(provides.split("=", 1)[0])
+        for name in provided:
+            ret["providers"].setdefault(name, [])
+            if pkgname not in ret["providers"][name]:
+                ret["providers"][name].append(pkgname)
+
+    if files != files_old:
+        logging.verbose(f"Writing pmaports index: {path_index}")
+        os.makedirs(os.path.dirname(path_index), exist_ok=True)
+        with open(f"{path_index}.new", "w") as handle:
+            json.dump({"version": pmaports_index_version, "files": files},
+                      handle)
+        os.replace(f"{path_index}.new", path_index)
+
+    # Subpackages and dependencies get looked up by
+    # pmb.helpers.pmaports.find() only when needed, the APKBUILDs it parses
+    # for that are in the cache already
+    pmb.helpers.other.cache["find_aport"].update(ret["paths"])
+
+    pmb.helpers.other.cache[cache_key] = ret
+    return ret
+
+
+def find_aport(args, index, name):
+    """ Same as pmb.helpers.pmaports.find(args, name, False), but with the
+        subpackages and provides looked up in the pmaports index instead of
+        parsing all APKBUILDs.
+
+        :param index: return value of get_pmaports_index()
+        :returns: pkgname of the aport, e.g. "hello-world", or None """
+    if name in index["apkbuilds"]:
+        return name
+
+    guess = pmb.helpers.pmaports.guess_main(args, name)
+    if not guess:
+        return None
+    guess = os.path.basename(guess)
+    providers = index["providers"].get(name, [])
+    if guess in providers or not providers:
+        return guess
+    return providers[0]
+
+
+def get_binary_versions(args, arch):
+    """ Get the versions of all binary packages of an arch at once.
+
+        :param arch: architecture (e.g. "armhf")
+        :returns: {"hello-world": "1-r4", ...} with the highest version of
+                  each pkgname in all APKINDEX files of the arch, like
+                  pmb.parse.apkindex.package() would find it """
+    ret = {}
+    for path in pmb.helpers.repo.apkindex_files(args, arch):
+        for pkgname, providers in pmb.parse.apkindex.parse(path).items():
+            block = providers.get(pkgname)
+            if not block:
+                continue
+            version = block["version"]
+            if pkgname in ret and \
+                    pmb.parse.version.compare(version, ret[pkgname]) == -1:
+                continue
+            ret[pkgname] = version
+    return ret
 
 
 def filter_missing_packages(args, arch, pkgnames):
@@ -13,6 +135,18 @@ def filter_missing_packages(args, arch, pkgnames):
         :param arch: architecture (e.g. "armhf")
         :param pkgnames: list of package names (e.g. ["hello-world", "test12"])
         :returns: subset of pkgnames (e.g. ["hello-world"]) """
+    # Aports from the index, that have a binary package with the same
+    # version, are up to date. Look at the others one by one.
+    index = pmb.helpers.other.cache["pmb.helpers.repo_missing.pmaports_index"]
+    if index:
+        versions = get_binary_versions(args, arch)
+        up_to_date = {pkgname for pkgname, apkbuild
+                      in index["apkbuilds"].items()
+                      if versions.get(pkgname) ==
+                      f"{apkbuild['pkgver']}-r{apkbuild['pkgrel']}"}
+        pkgnames = [pkgname for pkgname in pkgnames
+                    if pkgname not in up_to_date]
+
     ret = []
     for pkgname in pkgnames:
         binary = pmb.parse.apkindex.package(args, pkgname, arch, False)
@@ -43,9 +177,20 @@ def filter_arch_packages(args, arch, pkgnames):
         :param arch: architecture (e.g. "armhf")
         :param pkgnames: list of package names (e.g. ["hello-world", "test12"])
         :returns: subset of pkgnames (e.g. ["hello-world"]) """
+    # Aports from the index get checked at once, others one by one
+    apkbuilds = {}
+    index = pmb.helpers.other.cache["pmb.helpers.repo_missing.pmaports_index"]
+    if index:
+        apkbuilds = index["apkbuilds"]
+    buildable = {pkgname for pkgname, apkbuild in apkbuilds.items()
+                 if pmb.helpers.pmaports.check_arches(apkbuild["arch"], arch)}
+
     ret = []
     for pkgname in pkgnames:
-        if pmb.helpers.package.check_arch(args, pkgname, arch, False):
+        if pkgname in apkbuilds:
+            if pkgname in buildable:
+                ret += [pkgname]
+        elif pmb.helpers.package.check_arch(args, pkgname, arch, False):
             ret += [pkgname]
     return ret
 
@@ -125,6 +270,7 @@ def generate(args, arch, overview, pkgname=None, built=False):
     packages_str = pkgname if pkgname else "all packages"
     logging.info("Calculate packages that need to be built ({}, {})"
                  "".format(packages_str, arch))
+    get_pmaports_index(args)
 
     # Order relevant packages
     ret = get_relevant_packages(args, arch, pkgname, built)
@@ -133,3 +279,27 @@ def generate(args, arch, overview, pkgname=None, built=False):
     if overview:
         return ret
     return generate_output_format(args, arch, ret)
+
+
+def generate_arches(args, arches, overview, pkgname=None, built=False,
+                    parallel=False):
+    """ Get packages that need to be built for multiple arches. The pmaports
+        index gets built and the APKINDEX files get updated once for all
+        arches first.
+
+        :param arches: list of architectures (e.g. ["armhf", "aarch64"])
+        :param parallel: run generate() for all arches at the same time, in
+                         one process per arch (forked after the pmaports
+                         index was built, so they don't need to parse
+                         anything again)
+        :returns: {"armhf": generate() of armhf, ...} """
+    get_pmaports_index(args)
+    for arch in arches:
+        pmb.helpers.repo.update(args, arch)
+
+    if not parallel:
+        return {arch: generate(args, arch, overview, pkgname, built)
+                for arch in arches}
+    return pmb.helpers.other.run_forked(
+        lambda arch: generate(args, arch, overview, pkgname, built), arches)
+
@@ -0,0 +1,239 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Publish the locally built packages as a static repository, so they can be
+shared with other people. The layout is the same as on the postmarketOS
+mirrors: {dest}/{branch}/{arch}/APKINDEX.tar.gz, so the published repository
+can be used as additional mirror with -mp (see pmb.helpers.repo.urls()). The
+public key of the local signing key gets published in {dest}, users of the
+repository need to add it to /etc/apk/keys.
+
+Only new or changed packages get uploaded, based on the checksums in the
+remote APKINDEX. Everything gets uploaded into {arch}/.publish first, then
+the packages get moved into place and the APKINDEX last, so users never see
+an index that references packages that are not there yet.
+"""
+import glob
+import hashlib
+import logging
+import os
+import shlex
+import shutil
+import time
+
+import pmb.config.pmaports
+import pmb.helpers.manifest
+import pmb.helpers.run
+import pmb.parse.apkindex
+import pmb.sideload
+
+
+def parse_dest(dest):
+    """ :param dest: local path or ssh target, e.g. "/srv/repo" or
+                     "user@host:/srv/repo" (like scp and rsync)
+        :returns: (target, path), target is None for local paths, e.g.
+                  (None, "/srv/repo") or ("user@host", "/srv/repo") """
+    target, sep, path = dest.partition(":")
+    if not sep or "/" in target:
+        return (None, os.path.abspath(dest))
+    if not path.startswith("/"):
+        raise ValueError(f"Invalid destination: {dest} (the path on the ssh"
+                         " target must be absolute)")
+    return (target, path.rstrip("/") or "/")
+
+
+def quote_join(words):
+    """ Like shlex.join(), which needs Python 3.8. """
+    return " ".join(shlex.quote(word) for word in words)
+
+
+def ssh(args, target, port, remote_cmd):
+    """ Run a shell command on the ssh target. """
+    command = ["ssh"] + pmb.sideload.ssh_options(args, True)
+    command += ["-p", port, target, remote_cmd]
+    pmb.helpers.run.user(args, command, output="interactive")
+
+
+def scp(args, port, paths, target_path):
+    """ Copy files with scp, from or to the ssh target.
+        :param paths: list of source paths
+        :param target_path: destination path """
+    command = ["scp"] + pmb.sideload.ssh_options(args, True) + ["-P", port]
+    pmb.helpers.run.user(args, command + paths + [target_path],
+                         output="interactive")
+
+
+def get_remote_index(args, target, port, path_arch):
+    """ Get the APKINDEX of an arch from the published repository.
+
+        :param path_arch: folder of the arch in the published repository
+        :returns: path to a local copy of the APKINDEX.tar.gz, or None if it
+                  does not exist yet """
+    if not target:
+        path = f"{path_arch}/APKINDEX.tar.gz"
+        return path if os.path.exists(path) else None
+
+    # Only a missing APKINDEX means that nothing was published yet. ssh
+    # itself fails with 255, e.g. if the connection or authentication fails.
+    path_remote = f"{path_arch}/APKINDEX.tar.gz"
+    command = ["ssh"] + pmb.sideload.ssh_options(args, True)
+    command += ["-p", port, target, f"test -e {shlex.quote(path_remote)}"]
+    code = pmb.helpers.run.user(args, command, output="interactive",
+                                check=False)
+    if code == 1:
+        return None
+    if code != 0:
+        raise RuntimeError(f"Failed to check for {path_remote} on {target}"
+                           f" (exit code {code}), see the log for details.")
+
+    name = hashlib.sha256(f"{target}:{path_arch}".encode()).hexdigest()
+    path = f"{args.work}/ssh/publish_APKINDEX_{name[:8]}.tar.gz"
+    if os.path.exists(path):
+        os.remove(path)
+    scp(args, port, [f"{target}:{path_remote}"], path)
+    return path
+
+
+def get_upload(packages, blocks_remote):
+    """ Find the packages that need to be uploaded and removed.
+
+        :param packages: pmb.helpers.manifest.packages() of one arch
+        :param blocks_remote: pmb.parse.apkindex.parse_blocks() of the
+                              published APKINDEX
+        :returns: (upload, remove), upload is the list of packages from the
+                  manifest that are not published with the same checksum yet,
+                  remove the list of file names that the new APKINDEX does
+                  not reference anymore """
+    remote = {f"{block['pkgname']}-{block['version']}.apk":
+              block.get("checksum") for block in blocks_remote}
+    local = {f"{package['pkgname']}-{package['version']}.apk": package
+             for package in packages}
+    upload = [package for name, package in local.items()
+              if remote.get(name) != package["checksum"]]
+    remove = sorted(name for name in remote if name not in local)
+    return (upload, remove)
+
+
+def publish_arch(args, target, port, path_arch, path_repo, packages,
+                 dry=False):
+    """ Publish the packages of one arch.
+
+        :param path_arch: folder of the arch in the published repository
+        :param path_repo: folder of the arch in the local repository
+        :param packages: pmb.helpers.manifest.packages() of the arch
+        :returns: (upload, remove), see get_upload() """
+    index = get_remote_index(args, target, port, path_arch)
+    blocks_remote = pmb.parse.apkindex.parse_blocks(index) if index else []
+    upload, remove = get_upload(packages, blocks_remote)
+    if index and not upload and not remove and \
+            pmb.helpers.manifest.get_sha256(index) == \
+            pmb.helpers.manifest.get_sha256(f"{path_repo}/APKINDEX.tar.gz"):
+        return (upload, remove)
+
+    names = [f"{package['pkgname']}-{package['version']}.apk"
+             for package in upload]
+    for name in names:
+        logging.info(f"Upload: {os.path.basename(path_arch)}/{name}")
+    for name in remove:
+        logging.info(f"Remove: {os.path.basename(path_arch)}/{name}")
+    if dry:
+        return (upload, remove)
+
+    # Upload into .publish, then move everything into place, the APKINDEX
+    # last
+    paths = [f"{path_repo}/{name}" for name in names]
+    paths += [f"{path_repo}/APKINDEX.tar.gz"]
+    staging = f"{path_arch}/.publish"
+    if target:
+        ssh(args, target, port, f"mkdir -p {shlex.quote(staging)}")
+        scp(args, port, paths, f"{target}:{staging}/")
+        remote_cmd = f"cd {shlex.quote(path_arch)}"
+        if names:
+            staged = [f".publish/{name}" for name in names]
+            remote_cmd += f" && mv -f {quote_join(staged)} ."
+        remote_cmd += " && mv -f .publish/APKINDEX.tar.gz ."
+        if remove:
+            remote_cmd += f" && rm -f {quote_join(remove)}"
+        remote_cmd += " && rm -rf .publish"
+        ssh(args, target, port, remote_cmd)
+    else:
+        os.makedirs(staging, exist_ok=True)
+        for path in paths:
+            shutil.copyfile(path, f"{staging}/{os.path.basename(path)}")
+        for name in names + ["APKINDEX.tar.gz"]:
+            os.replace(f"{staging}/{name}", f"{path_arch}/{name}")
+        for name in remove:
+            if os.path.exists(f"{path_arch}/{name}"):
+                os.remove(f"{path_arch}/{name}")
+        shutil.rmtree(staging)
+    return (upload, remove)
+
+
+def publish(args, dest, arches=None, port="22", dry=False):
+    """ Publish the locally built packages of the current channel.
+
+        :param dest: local path or ssh target, see parse_dest()
+        :param arches: list of arches to publish (default: all arches of the
+                       local repository)
+        :param port: ssh port
+        :param dry: only show what would be uploaded and removed """
+    target, path = parse_dest(dest)
+    channel = pmb.config.pmaports.read_config(args)["channel"]
+    branch = pmb.config.pmaports.read_config_channel(args)["branch_pmaports"]
+    if not arches:
+        arches = sorted(os.path.basename(os.path.dirname(index)) for index in
+                        glob.glob(f"{args.work}/packages/{channel}/*/"
+                                  "APKINDEX.tar.gz"))
+    if not arches:
+        raise RuntimeError("There are no locally built packages to publish"
+                           f" for channel '{channel}'.")
+
+    keys = glob.glob(f"{args.work}/config_abuild/*.pub")
+    logging.info(f"Publishing {', '.join(arches)} to: {dest}")
+    time_start = time.monotonic()
+    os.makedirs(f"{args.work}/ssh", exist_ok=True)
+    try:
+        # Public keys and folders
+        path_arches = [f"{path}/{branch}/{arch}" for arch in arches]
+        if dry:
+            pass
+        elif target:
+            ssh(args, target, port, f"mkdir -p {quote_join(path_arches)}")
+            if keys:
+                scp(args, port, keys, f"{target}:{path}/")
+        else:
+            for path_arch in path_arches:
+                os.makedirs(path_arch, exist_ok=True)
+            for key in keys:
+                shutil.copyfile(key, f"{path}/{os.path.basename(key)}")
+
+        # Packages
+        stats = {"packages": 0, "upload": 0, "size": 0, "remove": 0}
+        for arch, path_arch in zip(arches, path_arches):
+            packages = pmb.helpers.manifest.packages(args, arch)
+            path_repo = f"{args.work}/packages/{channel}/{arch}"
+            upload, remove = publish_arch(args, target, port, path_arch,
+                                          path_repo, packages, dry)
+            stats["packages"] += len(packages)
+            stats["upload"] += len(upload)
+            stats["size"] += sum(package["size"] for package in upload)
+            stats["remove"] += len(remove)
+    finally:
+        if target:
+            command = ["ssh"] + pmb.sideload.ssh_options(args, False)
+            command += ["-p", port, "-O", "exit", target]
+            pmb.helpers.run.user(args, command, check=False)
+
+    duration = time.monotonic() - time_start
+    size = stats["size"] / 1024 / 1024
+    logging.info(f"{'Dry run: would upload' if dry else 'Uploaded'}"
+                 f" {stats['upload']} of {stats['packages']} packages"
+                 f" ({size:.1f} MiB, {size / max(duration, 0.001):.1f} MiB/s),"
+                 f" removed {stats['remove']} outdated packages, took"
+                 f" {duration:.1f}s")
+    if keys and not dry:
+        logging.info("Users of the repository need to copy this key to"
+                     f" /etc/apk/keys: {path}/{os.path.basename(keys[0])}")
+        logging.info("Use it as additional mirror with: pmbootstrap -mp"
+                     " <URL of the published folder>/ -mp"
+                     f" {pmb.config.defaults['mirrors_postmarketos']}")
@@ -9,12 +9,19 @@ import subprocess
 import sys
 import threading
 import time
+import pmb.helpers.logging
+import pmb.helpers.other
 import pmb.helpers.run
 
 """ For a detailed description of all output modes, read the description of
     core() at the bottom. All other functions in this file get (indirectly)
     called by core(). """
 
+# foreground_pipe(): bytes to read from the pipe at once, and seconds between
+# flushing the log file
+pipe_read_size = 64 * 1024
+log_flush_interval = 1
+
 
 def flat_cmd(cmd, working_dir=None, env={}):
     """
@@ -65,11 +72,35 @@ def sanity_checks(output="log", output_return=False, check=None):
         raise RuntimeError("Can't use output_return with output: " + output)
 
 
-def background(cmd, working_dir=None):
+def new_session(cmd, sudo=False):
+    """
+    Prepare a command to run in its own session, so kill_command() can kill
+    it together with all its child processes by killing its process group.
+
+    :param cmd: command as list, e.g. ["echo", "string with spaces"]
+    :param sudo: the command runs with sudo or doas (see pmb.config.sudo()).
+                 The new session gets created after sudo, so sudo can still
+                 ask for the password in the terminal.
+    :returns: (cmd, start_new_session): the command to run and the value for
+              the start_new_session parameter of subprocess.Popen
+    """
+    sudo_cmd = pmb.config.which_sudo()
+    if sudo and sudo_cmd and cmd[0] == sudo_cmd:
+        # -w: setsid forks if it is a process group leader already (e.g. sudo
+        # with use_pty), wait for the child then
+        return ([cmd[0], "setsid", "-w"] + cmd[1:], False)
+    return (cmd, True)
+
+
+def background(cmd, working_dir=None, sudo=False):
     """ Run a subprocess in background and redirect its output to the log. """
+    (cmd, start_new_session) = new_session(cmd, sudo)
     ret = subprocess.Popen(cmd, stdout=pmb.helpers.logging.logfd,
-                           stderr=pmb.helpers.logging.logfd, cwd=working_dir)
+                           stderr=pmb.helpers.logging.logfd, cwd=working_dir,
+                           start_new_session=start_new_session)
     logging.debug(f"New background process: pid={ret.pid}, output=background")
+    pmb.helpers.other.cache["pmb.helpers.run_core.background"].append(
+        (ret, sudo))
     return ret
 
 
@@ -89,74 +120,125 @@ def pipe_read(process, output_to_stdout=False, output_return=False,
     optionally stdout and a buffer variable. This is only meant to be called by
     foreground_pipe() below.
 
+    The output is read in big chunks instead of line by line, so programs
+    with lots of output (e.g. compilers) don't compete with pmbootstrap for
+    CPU time. The log is not flushed here, foreground_pipe() does that.
+
     :param process: subprocess.Popen instance
     :param output_to_stdout: copy all output to pmbootstrap's stdout
     :param output_return: when set to True, output_return_buffer will be
                           extended
     :param output_return_buffer: list of bytes that gets extended with the
                                  current output in case output_return is True.
+    :returns: amount of bytes read
     """
+    handle = process.stdout.fileno()
+    ret = 0
     while True:
-        # Copy available output
-        out = process.stdout.readline()
-        if len(out):
-            pmb.helpers.logging.logfd.buffer.write(out)
+        try:
+            chunk = os.read(handle, pipe_read_size)
+        except BlockingIOError:
+            chunk = b""
+        if chunk:
+            ret += len(chunk)
+            pmb.helpers.logging.logfd.buffer.write(chunk)
             if output_to_stdout:
-                sys.stdout.buffer.write(out)
+                sys.stdout.buffer.write(chunk)
             if output_return:
-                output_return_buffer.append(out)
-            continue
+                output_return_buffer.append(chunk)
 
-        # No more output (flush buffers)
-        pmb.helpers.logging.logfd.flush()
-        if output_to_stdout:
-            sys.stdout.flush()
-        return
+        # Pipe is empty (or the process closed it)
+        if len(chunk) < pipe_read_size:
+            break
+
+    if output_to_stdout and ret:
+        sys.stdout.flush()
+    return ret
 
 
-def kill_process_tree(args, pid, ppids, sudo):
+def get_process_tree(pid):
     """
-    Recursively kill a pid and its child processes
+    Get the child processes of a process recursively from /proc, without
+    looking at all processes of the system.
 
-    :param pid: process id that will be killed
-    :param ppids: list of process id and parent process id tuples (pid, ppid)
-    :param sudo: use sudo to kill the process
+    :param pid: process id
+    :returns: list of process ids: pid and all its child processes
     """
-    if sudo:
-        pmb.helpers.run.root(args, ["kill", "-9", str(pid)],
-                             check=False)
-    else:
-        pmb.helpers.run.user(args, ["kill", "-9", str(pid)],
-                             check=False)
+    ret = [pid]
+    i = 0
+    while i < len(ret):
+        try:
+            with open(f"/proc/{ret[i]}/task/{ret[i]}/children") as handle:
+                ret += [int(child) for child in handle.read().split()]
+        except OSError:
+            pass
+        i += 1
+    return ret
 
-    for (child_pid, child_ppid) in ppids:
-        if child_ppid == str(pid):
-            kill_process_tree(args, child_pid, ppids, sudo)
+
+def get_process_group(pid):
+    """
+    :param pid: process id
+    :returns: process group id of the process, or None if it is gone
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as handle:
+            stat = handle.read()
+    except OSError:
+        return None
+    # The command name in parentheses may contain spaces, the fields after it
+    # are: state, ppid, pgrp, ...
+    return int(stat.rsplit(")", 1)[1].split()[2])
 
 
 def kill_command(args, pid, sudo):
     """
-    Kill a command process and recursively kill its child processes
+    Kill a command process and its child processes with one kill call. The
+    process groups created with new_session() get killed as whole, which
+    includes processes that were forked while this function runs. Other
+    processes (e.g. sudo itself) get killed individually.
 
     :param pid: process id that will be killed
     :param sudo: use sudo to kill the process
     """
-    cmd = ["ps", "-e", "-o", "pid,ppid"]
-    ret = subprocess.run(cmd, check=True, stdout=subprocess.PIPE)
-    ppids = []
-    proc_entries = ret.stdout.decode("utf-8").rstrip().split('\n')[1:]
-    for row in proc_entries:
-        items = row.split()
-        if len(items) != 2:
-            raise RuntimeError("Unexpected ps output: " + row)
-        ppids.append(items)
+    own_group = os.getpgrp()
+    groups = []
+    pids = []
+    for child_pid in get_process_tree(pid):
+        group = get_process_group(child_pid)
+        if group is None:
+            continue
+        if group == own_group:
+            pids.append(str(child_pid))
+        elif f"-{group}" not in groups:
+            groups.append(f"-{group}")
+
+    if not groups and not pids:
+        return
+    cmd = ["kill", "-9", "--"] + groups + pids
+    if sudo:
+        pmb.helpers.run.root(args, cmd, check=False)
+    else:
+        pmb.helpers.run.user(args, cmd, check=False)
 
-    kill_process_tree(args, pid, ppids, sudo)
+
+def kill_background(args):
+    """
+    Kill all processes started with output="background", that are still
+    running, together with their child processes.
+    """
+    processes = pmb.helpers.other.cache["pmb.helpers.run_core.background"]
+    for process, sudo in processes:
+        if process.poll() is None:
+            logging.debug(f"Kill background process: pid={process.pid}")
+            kill_command(args, process.pid, sudo)
+            process.wait()
+    processes.clear()
 
 
 def foreground_pipe(args, cmd, working_dir=None, output_to_stdout=False,
                     output_return=False, output_timeout=True,
-                    sudo=False, stdin=None):
+                    sudo=False, stdin=None, log_json=None):
     """
     Run a subprocess in foreground with redirected output and optionally kill
     it after being silent for too long.
@@ -169,15 +251,30 @@ def foreground_pipe(args, cmd, working_dir=None, output_to_stdout=False,
                            after a certain time (configured with --timeout)
                            and raise a RuntimeError exception
     :param sudo: use sudo to kill the process when it hits the timeout
+    :param log_json: fields for the JSON lines log of the command (see
+                     get_log_json_fields()), the pid of the process gets
+                     added to it
     :returns: (code, output)
               * code: return code of the program
               * output: ""
               * output: full program output string (output_return is True)
     """
-    # Start process in background (stdout and stderr combined)
+    # Start process in background (stdout and stderr combined). Root commands
+    # that may get killed on timeout run in their own session, so they can be
+    # killed together with all child processes (e.g. daemons started in a
+    # chroot). Other commands (git, ssh, scp) keep the terminal, so they can
+    # still ask for passwords. kill_command() finds their child processes in
+    # pmbootstrap's own process group.
+    own_session = output_timeout and sudo
+    start_new_session = False
+    if own_session:
+        (cmd, start_new_session) = new_session(cmd, sudo)
     process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                stderr=subprocess.STDOUT, cwd=working_dir,
-                               stdin=stdin)
+                               stdin=stdin,
+                               start_new_session=start_new_session)
+    if log_json is not None:
+        log_json["pid"] = process.pid
 
     # Make process.stdout non-blocking
     handle = process.stdout.fileno()
@@ -188,30 +285,51 @@ def foreground_pipe(args, cmd, working_dir=None, output_to_stdout=False,
     output_buffer = []
     sel = selectors.DefaultSelector()
     sel.register(process.stdout, selectors.EVENT_READ)
-    timeout = args.timeout if output_timeout else None
-    while process.poll() is None:
-        wait_start = time.perf_counter() if output_timeout else None
-        sel.select(timeout)
-
-        # On timeout raise error (we need to measure time on our own, because
-        # select() may exit early even if there is no data to read and the
-        # timeout was not reached.)
-        if output_timeout:
-            wait_end = time.perf_counter()
-            if wait_end - wait_start >= args.timeout:
+    logfd = pmb.helpers.logging.logfd
+    last_output = time.perf_counter()
+    last_flush = last_output
+    try:
+        while process.poll() is None:
+            # Wait until the timeout is reached, counting from the last output
+            timeout = None
+            if output_timeout:
+                timeout = max(0, args.timeout -
+                              (time.perf_counter() - last_output))
+            sel.select(timeout)
+
+            # Read all currently available output
+            now = time.perf_counter()
+            if pipe_read(process, output_to_stdout, output_return,
+                         output_buffer):
+                last_output = now
+                # Flush the log from time to time, so it can be followed with
+                # 'pmbootstrap log' without flushing for each chunk
+                if now - last_flush >= log_flush_interval:
+                    logfd.flush()
+                    last_flush = now
+                continue
+
+            # On timeout raise error (we need to measure time on our own,
+            # because select() may exit early even if there is no data to
+            # read and the timeout was not reached.)
+            if output_timeout and now - last_output >= args.timeout:
+                logfd.flush()
                 logging.info("Process did not write any output for " +
                              str(args.timeout) + " seconds. Killing it.")
                 logging.info("NOTE: The timeout can be increased with"
                              " 'pmbootstrap -t'.")
                 kill_command(args, process.pid, sudo)
-                continue
-
-        # Read all currently available output
-        pipe_read(process, output_to_stdout, output_return,
-                  output_buffer)
+                last_output = now
+    except BaseException:
+        # Commands in their own session don't get the SIGINT from the
+        # terminal when pressing ^C, kill them before leaving
+        if own_session:
+            kill_command(args, process.pid, sudo)
+        raise
 
     # There may still be output after the process quit
     pipe_read(process, output_to_stdout, output_return, output_buffer)
+    logfd.flush()
 
     # Return the return code and output (the output gets built as list of
     # output chunks and combined at the end, this is faster than extending the
@@ -219,17 +337,21 @@ def foreground_pipe(args, cmd, working_dir=None, output_to_stdout=False,
     return (process.returncode, b"".join(output_buffer).decode("utf-8"))
 
 
-def foreground_tui(cmd, working_dir=None):
+def foreground_tui(cmd, working_dir=None, log_json=None):
     """
     Run a subprocess in foreground without redirecting any of its output.
 
     This is the only way text-based user interfaces (ncurses programs like
     vim, nano or the kernel's menuconfig) work properly.
+
+    :param log_json: see foreground_pipe()
     """
 
     logging.debug("*** output passed to pmbootstrap stdout, not to this log"
                   " ***")
     process = subprocess.Popen(cmd, cwd=working_dir)
+    if log_json is not None:
+        log_json["pid"] = process.pid
     return process.wait()
 
 
@@ -252,6 +374,24 @@ def check_return_code(args, code, log_message):
                            log_message)
 
 
+def get_log_json_fields(log_message):
+    """
+    Get the fields for the JSON lines log (pmbootstrap --log-json) from the
+    simplified command that core() logs.
+
+    :param log_message: e.g. "(native) % echo test" or "% echo test"
+    :returns: dict, e.g. {"suffix": "native", "command": "echo test"}. The
+              suffix is None for commands running on the host system.
+    """
+    suffix = None
+    command = log_message
+    if command.startswith("(") and ") " in command:
+        suffix, command = command[1:].split(") ", 1)
+    if command.startswith("% "):
+        command = command[2:]
+    return {"suffix": suffix, "command": command}
+
+
 def sudo_timer_iterate():
     """
     Run sudo -v and schedule a new timer to repeat the same.
@@ -366,12 +506,17 @@ def core(args, log_message, cmd, working_dir=None, output="log",
         sudo_timer_start()
 
     # Log simplified and full command (pmbootstrap -v)
-    logging.debug(log_message)
+    log_json = get_log_json_fields(log_message) \
+        if pmb.helpers.logging.log_json_path else {}
+    logging.debug(log_message, extra={"log_json": log_json})
     logging.verbose("run: " + str(cmd))
 
+    # The command writes to the log file directly
+    pmb.helpers.logging.flush()
+
     # Background
     if output == "background":
-        return background(cmd, working_dir)
+        return background(cmd, working_dir, sudo)
 
     # Pipe
     if output == "pipe":
@@ -379,9 +524,10 @@ def core(args, log_message, cmd, working_dir=None, output="log",
 
     # Foreground
     output_after_run = ""
+    time_start = time.perf_counter()
     if output == "tui":
         # Foreground TUI
-        code = foreground_tui(cmd, working_dir)
+        code = foreground_tui(cmd, working_dir, log_json or None)
     else:
         # Foreground pipe (always redirects to the error log file)
         output_to_stdout = False
@@ -396,7 +542,14 @@ def core(args, log_message, cmd, working_dir=None, output="log",
                                                    output_to_stdout,
                                                    output_return,
                                                    output_timeout,
-                                                   sudo, stdin)
+                                                   sudo, stdin,
+                                                   log_json or None)
+
+    if log_json:
+        log_json["exit_code"] = code
+        log_json["duration"] = round(time.perf_counter() - time_start, 3)
+        logging.debug(f"{log_message}: exit code {code}",
+                      extra={"log_json": log_json, "log_json_only": True})
 
     # Check the return code
     if check is not False:
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import os
 import glob
+import pmb.helpers.package
 import pmb.parse
 
 
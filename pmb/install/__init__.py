@@ -6,4 +6,6 @@ from pmb.install.partition import partition
 from pmb.install.partition import partition_cgpt
 from pmb.install.format import format
 from pmb.install.format import get_root_filesystem
+from pmb.install.format import get_populate_uuids
+from pmb.install.format import populate
 from pmb.install.partition import partitions_mount
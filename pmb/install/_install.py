@@ -1,5 +1,6 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import concurrent.futures
 import logging
 import os
 import re
@@ -16,6 +17,7 @@ import pmb.config.pmaports
 import pmb.helpers.devices
 import pmb.helpers.run
 import pmb.install.blockdevice
+import pmb.install.incremental
 import pmb.install.recovery
 import pmb.install.ui
 import pmb.install
@@ -40,6 +42,68 @@ def mount_device_rootfs(args, suffix_rootfs, suffix_mount="native"):
     return mountpoint
 
 
+def get_rootfs_size(args, chroot):
+    """
+    Estimate the size of the rootfs chroot without reading the metadata of
+    all files: sum up the installed size of all packages from apk's
+    installed packages database, then add the files that are not owned by
+    any package. These are in the folders with files that were generated
+    after installing the packages (initramfs, configs, ...) and in the
+    folders watched by apk triggers (icon caches, compiled schemas, ...). The
+    package files in these folders are subtracted again, as they are part of
+    the installed size already. If there is no database, fall back to
+    scanning the whole chroot. Folders that only root can read get measured
+    with du as root.
+
+    :param chroot: path to the chroot on the host system
+    :returns: size in kilobytes
+    """
+    installed = f"{chroot}/lib/apk/db/installed"
+    if not os.path.exists(installed):
+        return pmb.helpers.other.folder_size_scandir(chroot, args=args)
+
+    (size, files) = pmb.parse.apkindex.installed_size(installed)
+    # The installed size does not include the unused space in the last
+    # block of each file, assume half a block on average
+    size += files * 2048
+    ret = size // 1024
+
+    # Scan each folder once, also if it is inside another one of the list
+    folders = ["boot", "etc", "home", "root", "var"]
+    folders += pmb.install.incremental.get_trigger_folders(chroot)
+    scan = []
+    for folder in sorted(set(folders)):
+        if os.path.isdir(f"{chroot}/{folder}") and \
+                not any(f"{folder}/".startswith(f"{other}/")
+                        for other in scan):
+            scan.append(folder)
+
+    hardlinks_seen = set()
+    for folder in scan:
+        ret += pmb.helpers.other.folder_size_scandir(
+            f"{chroot}/{folder}", args=args, hardlinks_seen=hardlinks_seen)
+
+    # Subtract the package files that were scanned
+    prefixes = tuple(f"{folder}/" for folder in scan)
+    owned = 0
+    packages = pmb.install.incremental.parse_installed_files(installed)
+    for package in packages.values():
+        for path in package["files"]:
+            if not path.startswith(prefixes):
+                continue
+            try:
+                st = os.lstat(f"{chroot}/{path}")
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                inode = (st.st_dev, st.st_ino)
+                if inode not in hardlinks_seen:
+                    continue
+                hardlinks_seen.remove(inode)
+            owned += st.st_blocks * 512
+    return ret - owned // 1024
+
+
 def get_subpartitions_size(args, suffix):
     """
     Calculate the size of the boot and root subpartition.
@@ -54,7 +118,7 @@ def get_subpartitions_size(args, suffix):
     # calculation is not as trivial as one may think, and depending on the
     # file system etc it seems to be just impossible to get it right.
     chroot = f"{args.work}/chroot_{suffix}"
-    root = pmb.helpers.other.folder_size(args, chroot) / 1024
+    root = get_rootfs_size(args, chroot) / 1024
     root *= 1.20
     root += 50 + int(args.extra_space)
     return (boot, root)
@@ -107,22 +171,17 @@ def get_kernel_package(args, device):
     return ["device-" + device + "-kernel-" + args.kernel]
 
 
-def copy_files_from_chroot(args, suffix):
+def remove_chroot_leftovers(args, suffix):
     """
-    Copy all files from the rootfs chroot to /mnt/install, except
-    for the home folder (because /home will contain some empty
-    mountpoint folders).
+    Remove files from the rootfs chroot, that pmbootstrap only needed while
+    running commands inside it and that must not end up in the image.
 
     :param suffix: the chroot suffix, e.g. "rootfs_qemu-amd64"
     """
-    # Mount the device rootfs
-    logging.info(f"(native) copy {suffix} to /mnt/install/")
-    mountpoint = mount_device_rootfs(args, suffix)
-    mountpoint_outside = args.work + "/chroot_native" + mountpoint
-
     # Remove empty qemu-user binary stub (where the binary was bind-mounted)
     arch_qemu = pmb.parse.arch.alpine_to_qemu(args.deviceinfo["arch"])
-    qemu_binary = mountpoint_outside + "/usr/bin/qemu-" + arch_qemu + "-static"
+    qemu_binary = (f"{args.work}/chroot_{suffix}/usr/bin/qemu-{arch_qemu}"
+                   "-static")
     if os.path.exists(qemu_binary):
         pmb.helpers.run.root(args, ["rm", qemu_binary])
 
@@ -131,6 +190,42 @@ def copy_files_from_chroot(args, suffix):
     if os.path.exists(fifo):
         pmb.helpers.run.root(args, ["rm", fifo])
 
+
+def populate_files_from_chroot(args, layout, suffix, boot_label, root_label,
+                               disk, uuids):
+    """
+    Create the boot and root filesystems directly from the rootfs chroot
+    (--mkfs-populate), instead of formatting them first and copying all files
+    with copy_files_from_chroot().
+
+    :param layout: partition layout from get_partition_layout()
+    :param suffix: the chroot suffix, e.g. "rootfs_qemu-amd64"
+    :param boot_label: label of the boot partition (e.g. "pmOS_boot")
+    :param root_label: label of the root partition (e.g. "pmOS_root")
+    :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
+    :param uuids: filesystem UUIDs from get_populate_uuids()
+    """
+    mountpoint = mount_device_rootfs(args, suffix)
+    remove_chroot_leftovers(args, suffix)
+    pmb.install.populate(args, layout, boot_label, root_label, disk,
+                         mountpoint, uuids)
+
+
+def copy_files_from_chroot(args, suffix, disk=None):
+    """
+    Copy all files from the rootfs chroot to /mnt/install, except
+    for the home folder (because /home will contain some empty
+    mountpoint folders).
+
+    :param suffix: the chroot suffix, e.g. "rootfs_qemu-amd64"
+    :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
+    """
+    # Mount the device rootfs
+    logging.info(f"(native) copy {suffix} to /mnt/install/")
+    mountpoint = mount_device_rootfs(args, suffix)
+    mountpoint_outside = args.work + "/chroot_native" + mountpoint
+    remove_chroot_leftovers(args, suffix)
+
     # Get all folders inside the device rootfs (except for home)
     folders = []
     for path in glob.glob(mountpoint_outside + "/*"):
@@ -139,7 +234,10 @@ def copy_files_from_chroot(args, suffix):
         folders += [os.path.basename(path)]
 
     # Update or copy all files
-    if args.rsync:
+    if args.rsync and not disk and \
+            pmb.install.incremental.rsync(args, suffix, mountpoint):
+        pmb.chroot.root(args, ["rm", "-rf", "/mnt/install/home"])
+    elif args.rsync:
         pmb.chroot.apk.install(args, ["rsync"])
         rsync_flags = "-a"
         if args.verbose:
@@ -760,12 +858,14 @@ def create_crypttab(args, layout, suffix):
     pmb.chroot.root(args, ["mv", "/tmp/crypttab", "/etc/crypttab"], suffix)
 
 
-def create_fstab(args, layout, suffix):
+def create_fstab(args, layout, suffix, uuids=None):
     """
     Create /etc/fstab config
 
     :param layout: partition layout from get_partition_layout()
     :param suffix: of the chroot, which fstab will be created to
+    :param uuids: filesystem UUIDs from get_populate_uuids(), if the
+                  filesystems have not been created yet (--mkfs-populate)
     """
 
     # Do not install fstab into target rootfs when using on-device
@@ -776,9 +876,13 @@ def create_fstab(args, layout, suffix):
     boot_dev = f"/dev/installp{layout['boot']}"
     root_dev = f"/dev/installp{layout['root']}"
 
-    boot_mount_point = f"UUID={get_uuid(args, boot_dev)}"
-    root_mount_point = "/dev/mapper/root" if args.full_disk_encryption \
-        else f"UUID={get_uuid(args, root_dev)}"
+    if uuids:
+        boot_mount_point = f"UUID={uuids['boot']}"
+        root_mount_point = f"UUID={uuids['root']}"
+    else:
+        boot_mount_point = f"UUID={get_uuid(args, boot_dev)}"
+        root_mount_point = "/dev/mapper/root" if args.full_disk_encryption \
+            else f"UUID={get_uuid(args, root_dev)}"
 
     boot_filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
     root_filesystem = pmb.install.get_root_filesystem(args)
@@ -829,6 +933,18 @@ def install_system_image(args, size_reserve, suffix, step, steps,
     (size_boot, size_root) = get_subpartitions_size(args, suffix)
     layout = get_partition_layout(size_reserve, args.deviceinfo["cgpt_kpart"] \
              and args.install_cgpt)
+
+    # Update the image file(s) of the previous installation with --rsync, if
+    # they are still big enough
+    if args.rsync and not disk:
+        if pmb.install.blockdevice.image_fits(args, layout, size_boot,
+                                              size_root, split):
+            pmb.install.blockdevice.update(args, split)
+        else:
+            logging.info("NOTE: no image of a previous installation found or"
+                         " it is too small, creating a new one")
+            args.rsync = False
+
     if not args.rsync:
         pmb.install.blockdevice.create(args, size_boot, size_root,
                                        size_reserve, split, disk)
@@ -841,11 +957,18 @@ def install_system_image(args, size_reserve, suffix, step, steps,
     if not split:
         pmb.install.partitions_mount(args, layout, disk)
 
-    pmb.install.format(args, layout, boot_label, root_label, disk)
+    # With --mkfs-populate, the filesystems get created together with their
+    # contents after mkinitfs ran. Decide on their UUIDs now, so they can be
+    # written to /etc/fstab already.
+    uuids = None
+    if args.mkfs_populate:
+        uuids = pmb.install.get_populate_uuids(args)
+    else:
+        pmb.install.format(args, layout, boot_label, root_label, disk)
 
     # Create /etc/fstab and /etc/crypttab
     logging.info("(native) create /etc/fstab")
-    create_fstab(args, layout, suffix)
+    create_fstab(args, layout, suffix, uuids)
     if args.full_disk_encryption:
         logging.info("(native) create /etc/crypttab")
         create_crypttab(args, layout, suffix)
@@ -861,7 +984,11 @@ def install_system_image(args, size_reserve, suffix, step, steps,
 
     # Just copy all the files
     logging.info(f"*** ({step + 1}/{steps}) FILL INSTALL BLOCKDEVICE ***")
-    copy_files_from_chroot(args, suffix)
+    if args.mkfs_populate:
+        populate_files_from_chroot(args, layout, suffix, boot_label,
+                                   root_label, disk, uuids)
+    else:
+        copy_files_from_chroot(args, suffix, disk)
     create_home_from_skel(args)
     configure_apk(args)
     copy_ssh_keys(args)
@@ -1004,6 +1131,44 @@ def install_recovery_zip(args, steps):
     logging.info("https://postmarketos.org/recoveryzip")
 
 
+def get_installer_packages(args):
+    """ :returns: packages to install in the on-device installer chroot """
+    return ([f"device-{args.device}",
+             "postmarketos-ondev"] +
+            get_kernel_package(args, args.device) +
+            get_nonfree_packages(args, args.device))
+
+
+def build_installer_packages(args):
+    """
+    Build the packages for the on-device installer chroot and their
+    dependencies where necessary, so install_installer_packages() does not
+    need to build anything while running in parallel to other steps.
+
+    :returns: list of packages to install in the installer chroot
+    """
+    packages = get_installer_packages(args)
+    suffix_installer = f"installer_{args.device}"
+    arch = args.deviceinfo["arch"]
+    for package in pmb.parse.depends.recurse(args, packages, suffix_installer):
+        if not package.startswith("!"):
+            pmb.chroot.apk.install_build(args, package, arch)
+    return packages
+
+
+def install_installer_packages(args, packages):
+    """
+    Install the packages of the on-device installer chroot. Installing the
+    kernel also generates the installer's initramfs. This runs in a separate
+    thread, in parallel to configuring the device rootfs chroot, and must
+    only touch the installer chroot.
+
+    :param packages: return value of build_installer_packages()
+    """
+    suffix_installer = f"installer_{args.device}"
+    pmb.chroot.apk.install(args, packages, suffix_installer, build=False)
+
+
 def install_on_device_installer(args, step, steps):
     # Generate the rootfs image
     if not args.ondev_no_rootfs:
@@ -1012,16 +1177,14 @@ def install_on_device_installer(args, step, steps):
                              split=True)
         step += 2
 
-    # Prepare the installer chroot
+    # Prepare the installer chroot (its packages were installed together
+    # with the device rootfs already, unless there is no rootfs)
     logging.info(f"*** ({step}/{steps}) CREATE ON-DEVICE INSTALLER ROOTFS ***")
     step += 1
-    packages = ([f"device-{args.device}",
-                 "postmarketos-ondev"] +
-                get_kernel_package(args, args.device) +
-                get_nonfree_packages(args, args.device))
-
     suffix_installer = f"installer_{args.device}"
-    pmb.chroot.apk.install(args, packages, suffix_installer)
+    if args.ondev_no_rootfs:
+        pmb.chroot.apk.install(args, get_installer_packages(args),
+                               suffix_installer)
 
     # Move rootfs image into installer chroot
     img_path_dest = f"{args.work}/chroot_{suffix_installer}/var/lib/rootfs.img"
@@ -1252,6 +1415,34 @@ def create_device_rootfs(args, step, steps):
     # because that doesn't always happen automatically yet, e.g. when the user
     # installed a hook without pmbootstrap - see #69 for more info)
     pmb.chroot.apk.install(args, install_packages, suffix)
+
+    # The on-device installer chroot is independent of the device rootfs
+    # chroot until the rootfs image gets embedded, so install its packages
+    # while the rootfs chroot gets configured (e.g. mkinitfs for the rootfs
+    # runs while apk installs the installer packages). Each chroot has its
+    # own lock for initializing it, see pmb.chroot.apk.get_lock(). Leaving
+    # the "with" block waits for the installer thread, also if configuring
+    # the rootfs failed.
+    installer = None
+    if args.on_device_installer:
+        packages_installer = build_installer_packages(args)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        if args.on_device_installer:
+            installer = executor.submit(install_installer_packages, args,
+                                        packages_installer)
+        configure_device_rootfs(args, suffix, locale_is_set)
+    if installer:
+        installer.result()
+
+
+def configure_device_rootfs(args, suffix, locale_is_set):
+    """
+    Build the initramfs and configure the device rootfs chroot after all
+    packages were installed.
+
+    :param suffix: the chroot suffix, e.g. "rootfs_qemu-amd64"
+    :param locale_is_set: the user selected a locale other than the default
+    """
     flavor = pmb.chroot.other.kernel_flavor_installed(args, suffix)
     pmb.chroot.initfs.build(args, flavor, suffix)
 
@@ -111,13 +111,31 @@ def create_and_mount_image(args, size_boot, size_root, size_reserve,
                      f"({size_mb})")
         pmb.chroot.root(args, ["truncate", "-s", size_mb, img_path])
 
-    # Mount to /dev/install
-    mount_image_paths = {img_path_full: "/dev/install"}
+    mount_image(args, split)
+
+
+def get_image_paths(args, split=False):
+    """
+    :param split: separate images for boot and root partitions
+    :returns: dict of image paths inside the native chroot and where they get
+              mounted, e.g. {"/home/pmos/rootfs/qemu-amd64.img":
+                             "/dev/install"}
+    """
+    img_path_prefix = "/home/pmos/rootfs/" + args.device
     if split:
-        mount_image_paths = {img_path_boot: "/dev/installp1",
-                             img_path_root: "/dev/installp2"}
+        return {img_path_prefix + "-boot.img": "/dev/installp1",
+                img_path_prefix + "-root.img": "/dev/installp2"}
+    return {img_path_prefix + ".img": "/dev/install"}
+
+
+def mount_image(args, split=False):
+    """
+    Mount existing image file(s) as /dev/install (or /dev/installp1 and
+    /dev/installp2 with split).
 
-    for img_path, mount_point in mount_image_paths.items():
+    :param split: separate images for boot and root partitions
+    """
+    for img_path, mount_point in get_image_paths(args, split).items():
         logging.info("(native) mount " + mount_point +
                      " (" + os.path.basename(img_path) + ")")
         pmb.install.losetup.mount(args, img_path)
@@ -126,6 +144,74 @@ def create_and_mount_image(args, size_boot, size_root, size_reserve,
                                     args.work + "/chroot_native" + mount_point)
 
 
+def get_partition_sizes(args, img_path):
+    """
+    Read the partition table of an image file.
+
+    :param img_path: path to the image file inside the native chroot
+    :returns: list of (start, end) tuples in MiB, ordered by partition number
+    """
+    output = pmb.chroot.root(args, ["parted", "-s", "-m", img_path, "unit",
+                                    "MiB", "print"], output_return=True,
+                             check=False)
+    ret = []
+    for line in output.splitlines():
+        # Example: "1:1.00MiB:128MiB:127MiB:ext2::boot, esp;"
+        fields = line.split(":")
+        if len(fields) < 4 or not fields[0].isdigit():
+            continue
+        ret.append((float(fields[1].replace("MiB", "")),
+                    float(fields[2].replace("MiB", ""))))
+    return ret
+
+
+def image_fits(args, layout, size_boot, size_root, split=False):
+    """
+    Check if the image file(s) from a previous installation exist and are big
+    enough for the new installation, so they can be updated instead of
+    getting created from scratch.
+
+    :param layout: partition layout from get_partition_layout()
+    :param size_boot: required size of the boot partition in MiB
+    :param size_root: required size of the root partition in MiB
+    :param split: separate images for boot and root partitions
+    :returns: True if the image(s) can be updated in place
+    """
+    chroot = args.work + "/chroot_native"
+    img_paths = list(get_image_paths(args, split).keys())
+    for img_path in img_paths:
+        if not os.path.exists(chroot + img_path):
+            logging.debug(f"Previous image not found: {img_path}")
+            return False
+
+    if split:
+        sizes = [os.path.getsize(chroot + img_path) / 1024**2
+                 for img_path in img_paths]
+        return sizes[0] >= size_boot and sizes[1] >= size_root
+
+    partitions = get_partition_sizes(args, img_paths[0])
+    partition_count = max(p for p in layout.values() if p)
+    if len(partitions) != partition_count:
+        logging.debug(f"Previous image has {len(partitions)} partitions,"
+                      f" expected {partition_count}")
+        return False
+
+    # The boot partition ends at size_boot (see pmb.install.partition()), the
+    # root partition takes the rest of the image
+    boot_end = partitions[layout["boot"] - 1][1]
+    root_start, root_end = partitions[layout["root"] - 1]
+    if round(boot_end) < round(size_boot):
+        logging.debug(f"Previous image: boot partition is too small (ends at"
+                      f" {round(boot_end)}M, expected {round(size_boot)}M)")
+        return False
+    if round(root_end - root_start) + 1 < round(size_root):
+        logging.debug("Previous image: root partition is too small"
+                      f" ({round(root_end - root_start)}M <"
+                      f" {round(size_root)}M)")
+        return False
+    return True
+
+
 def create(args, size_boot, size_root, size_reserve, split, disk):
     """
     Create /dev/install (the "install blockdevice").
@@ -143,3 +229,23 @@ def create(args, size_boot, size_root, size_reserve, split, disk):
     else:
         create_and_mount_image(args, size_boot, size_root, size_reserve,
                                split)
+
+
+def update(args, split):
+    """
+    Mount the image file(s) of a previous installation as /dev/install, so
+    the files can be updated with rsync (pmbootstrap install --rsync).
+
+    :param split: separate images for boot and root partitions
+    """
+    pmb.helpers.mount.umount_all(
+        args, args.work + "/chroot_native/dev/install")
+    pmb.helpers.mount.umount_all(args, args.work + "/chroot_native/mnt")
+    for img_path in get_image_paths(args, split):
+        pmb.install.losetup.umount(args, img_path)
+    mount_image(args, split)
+
+    # Let the kernel scan the partition table of the already partitioned
+    # image (check=False: fails if the partitions are known already)
+    if not split:
+        pmb.chroot.root(args, ["partx", "-a", "/dev/install"], check=False)
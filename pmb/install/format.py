@@ -2,7 +2,9 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import os
 import logging
+import uuid
 import pmb.chroot
+import pmb.helpers.mount
 
 
 def install_fsprogs(args, filesystem):
@@ -13,19 +15,36 @@ def install_fsprogs(args, filesystem):
     pmb.chroot.apk.install(args, [fsprogs])
 
 
-def format_and_mount_boot(args, device, boot_label):
+def format_and_mount_boot(args, device, boot_label, disk=None):
     """
     :param device: boot partition on install block device (e.g. /dev/installp1)
     :param boot_label: label of the root partition (e.g. "pmOS_boot")
+    :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
 
     When adjusting this function, make sure to also adjust
     ondev-prepare-internal-storage.sh in postmarketos-ondev.git!
     """
     mountpoint = "/mnt/install/boot"
     filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
-    install_fsprogs(args, filesystem)
-    logging.info(f"(native) format {device} (boot, {filesystem}), mount to"
-                 f" {mountpoint}")
+    if args.rsync and not disk:
+        # Updating the image of the previous installation (not with --disk):
+        # keep its files, they get updated
+        logging.info(f"(native) mount {device} (boot) to {mountpoint}")
+    else:
+        install_fsprogs(args, filesystem)
+        logging.info(f"(native) format {device} (boot, {filesystem}), mount"
+                     f" to {mountpoint}")
+        format_boot(args, device, boot_label, filesystem)
+    pmb.chroot.root(args, ["mkdir", "-p", mountpoint])
+    pmb.chroot.root(args, ["mount", device, mountpoint])
+
+
+def format_boot(args, device, boot_label, filesystem):
+    """
+    :param device: boot partition on install block device (e.g. /dev/installp1)
+    :param boot_label: label of the boot partition (e.g. "pmOS_boot")
+    :param filesystem: filesystem of the boot partition (e.g. "ext2")
+    """
     if filesystem == "fat16":
         pmb.chroot.root(args, ["mkfs.fat", "-F", "16", "-n", boot_label,
                                device])
@@ -40,8 +59,6 @@ def format_and_mount_boot(args, device, boot_label):
                                device])
     else:
         raise RuntimeError("Filesystem " + filesystem + " is not supported!")
-    pmb.chroot.root(args, ["mkdir", "-p", mountpoint])
-    pmb.chroot.root(args, ["mount", device, mountpoint])
 
 
 def format_luks_root(args, device):
@@ -157,10 +174,10 @@ def format_and_mount_root(args, device, root_label, disk):
     :param root_label: label of the root partition (e.g. "pmOS_root")
     :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
     """
-    # Format
+    # Format (not with --rsync, the files of the previous installation get
+    # updated)
+    filesystem = get_root_filesystem(args)
     if not args.rsync:
-        filesystem = get_root_filesystem(args)
-
         if filesystem == "ext4":
             # Some downstream kernels don't support metadata_csum (#1364).
             # When changing the options of mkfs.ext4, also change them in the
@@ -209,4 +226,172 @@ def format(args, layout, boot_label, root_label, disk):
         root_dev = "/dev/mapper/pm_crypt"
 
     format_and_mount_root(args, root_dev, root_label, disk)
-    format_and_mount_boot(args, boot_dev, boot_label)
+    format_and_mount_boot(args, boot_dev, boot_label, disk)
+
+
+def get_populate_uuids(args):
+    """
+    Generate the UUIDs of the boot and root filesystem in advance. With
+    --mkfs-populate, the filesystems get created from the rootfs chroot after
+    mkinitfs ran, but /etc/fstab needs to reference them before that.
+
+    :returns: {"boot": "1A2B-3C4D", "root": "3f0c...-..."} in the same
+              format as blkid prints them
+    """
+    boot_filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
+    boot = str(uuid.uuid4())
+    if boot_filesystem.startswith("fat"):
+        volume_id = uuid.uuid4().hex[:8].upper()
+        boot = f"{volume_id[:4]}-{volume_id[4:]}"
+    return {"boot": boot, "root": str(uuid.uuid4())}
+
+
+def populate_boot(args, device, boot_label, uuid_boot, source):
+    """
+    Create the boot filesystem and fill it with the files from source in the
+    same step, without mounting it first.
+
+    :param device: boot partition on install block device (e.g. /dev/installp1)
+    :param boot_label: label of the boot partition (e.g. "pmOS_boot")
+    :param uuid_boot: UUID from get_populate_uuids()
+    :param source: directory inside the native chroot with the files for the
+                   boot partition (e.g. /mnt/rootfs_qemu-amd64/boot)
+    """
+    filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
+    install_fsprogs(args, filesystem)
+    logging.info(f"(native) format {device} (boot, {filesystem}) from"
+                 f" {source}")
+    if filesystem in ["fat16", "fat32"]:
+        # mkfs.fat can't populate the filesystem, but mcopy can write to it
+        # without mounting
+        pmb.chroot.apk.install(args, ["mtools"])
+        volume_id = uuid_boot.replace("-", "")
+        pmb.chroot.root(args, ["mkfs.fat", "-F", filesystem[3:], "-i",
+                               volume_id, "-n", boot_label, device])
+        source_outside = f"{args.work}/chroot_native{source}"
+        files = [f"{source}/{name}" for name in
+                 sorted(os.listdir(source_outside))]
+        if files:
+            pmb.chroot.root(args, ["mcopy", "-s", "-p", "-Q", "-i", device] +
+                            files + ["::"])
+    elif filesystem == "ext2":
+        pmb.chroot.root(args, ["mkfs.ext2", "-F", "-q", "-L", boot_label,
+                               "-U", uuid_boot, "-d", source, device])
+    elif filesystem == "btrfs":
+        pmb.chroot.root(args, ["mkfs.btrfs", "-f", "-q", "-L", boot_label,
+                               "-U", uuid_boot, "--rootdir", source, device])
+    else:
+        raise RuntimeError("Filesystem " + filesystem + " is not supported!")
+
+
+def populate_root(args, device, root_label, uuid_root, source, disk):
+    """
+    Create the root filesystem and fill it with the files from source in the
+    same step. mkfs.ext4 writes the files directly to the block device, so
+    they don't go through a mounted filesystem.
+
+    :param device: root partition on install block device (e.g. /dev/installp2)
+    :param root_label: label of the root partition (e.g. "pmOS_root")
+    :param uuid_root: UUID from get_populate_uuids()
+    :param source: directory inside the native chroot with the files for the
+                   root partition (e.g. /mnt/rootfs_qemu-amd64)
+    :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
+    """
+    filesystem = get_root_filesystem(args)
+    if filesystem != "ext4":
+        raise RuntimeError(f"Can't create {filesystem} filesystems from a"
+                           " directory, use ext4 or don't use"
+                           " --mkfs-populate.")
+
+    # Same options as in format_and_mount_root()
+    mkfs_root_args = ["mkfs.ext4", "-O", "^metadata_csum", "-F", "-q", "-L",
+                      root_label, "-U", uuid_root, "-d", source]
+    if not disk:
+        mkfs_root_args += ["-N", "100000"]
+
+    install_fsprogs(args, filesystem)
+    logging.info(f"(native) format {device} (root, {filesystem}) from"
+                 f" {source}")
+    pmb.chroot.root(args, mkfs_root_args + [device])
+
+
+def populate_stage(args, source):
+    """
+    Create a staging folder with everything from source, except for the
+    contents of /boot (it is on its own partition) and /home (it gets created
+    from /etc/skel later, the chroot's /home has mountpoint folders). The
+    folders get bind mounted, so nothing needs to be copied and mkfs doesn't
+    write files into the root filesystem that would need to be deleted again.
+
+    :param source: directory inside the native chroot with the rootfs (e.g.
+                   /mnt/rootfs_qemu-amd64)
+    :returns: path to the staging folder inside the native chroot
+    """
+    staging = "/mnt/populate_root"
+    staging_outside = f"{args.work}/chroot_native{staging}"
+    source_outside = f"{args.work}/chroot_native{source}"
+    pmb.chroot.root(args, ["mkdir", "-p", f"{staging}/boot"])
+    for name in sorted(os.listdir(source_outside)):
+        path_outside = f"{source_outside}/{name}"
+        if name in ["boot", "home"]:
+            continue
+        if os.path.isdir(path_outside) and not os.path.islink(path_outside):
+            pmb.helpers.mount.bind(args, path_outside,
+                                   f"{staging_outside}/{name}")
+        else:
+            pmb.chroot.root(args, ["cp", "-a", f"{source}/{name}",
+                                   f"{staging}/"])
+    return staging
+
+
+def populate_stage_remove(args, staging):
+    """
+    Umount and remove the staging folder from populate_stage().
+
+    :param staging: return value of populate_stage()
+    """
+    staging_outside = f"{args.work}/chroot_native{staging}"
+    pmb.helpers.mount.umount_all(args, staging_outside)
+
+    # Only remove what populate_stage() created, not the bind mounted
+    # folders' contents if something went wrong
+    for name in sorted(os.listdir(staging_outside)):
+        path_outside = f"{staging_outside}/{name}"
+        if os.path.isdir(path_outside) and not os.path.islink(path_outside):
+            pmb.chroot.root(args, ["rmdir", f"{staging}/{name}"])
+        else:
+            pmb.chroot.root(args, ["rm", f"{staging}/{name}"])
+    pmb.chroot.root(args, ["rmdir", staging])
+
+
+def populate(args, layout, boot_label, root_label, disk, source, uuids):
+    """
+    Create boot and root filesystem from the rootfs chroot with mkfs instead
+    of copying the files into freshly formatted partitions, then mount them
+    to /mnt/install just like format() does.
+
+    :param layout: partition layout from get_partition_layout()
+    :param boot_label: label of the boot partition (e.g. "pmOS_boot")
+    :param root_label: label of the root partition (e.g. "pmOS_root")
+    :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
+    :param source: path to the mounted rootfs chroot inside the native chroot
+                   (e.g. /mnt/rootfs_qemu-amd64)
+    :param uuids: filesystem UUIDs from get_populate_uuids()
+    """
+    root_dev = f"/dev/installp{layout['root']}"
+    boot_dev = f"/dev/installp{layout['boot']}"
+
+    staging = populate_stage(args, source)
+    try:
+        populate_root(args, root_dev, root_label, uuids["root"], staging,
+                      disk)
+    finally:
+        populate_stage_remove(args, staging)
+    populate_boot(args, boot_dev, boot_label, uuids["boot"], f"{source}/boot")
+
+    mountpoint = "/mnt/install"
+    logging.info(f"(native) mount {root_dev} to {mountpoint}")
+    pmb.chroot.root(args, ["mkdir", "-p", mountpoint])
+    pmb.chroot.root(args, ["mount", root_dev, mountpoint])
+    logging.info(f"(native) mount {boot_dev} to {mountpoint}/boot")
+    pmb.chroot.root(args, ["mount", boot_dev, f"{mountpoint}/boot"])
@@ -0,0 +1,197 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import glob
+import logging
+import os
+
+import pmb.chroot
+import pmb.chroot.apk
+
+# Folders that always get synced completely with 'pmbootstrap install --rsync',
+# because they contain files that are not owned by any package (configs
+# written by pmbootstrap and post-install scripts, the initramfs, ...)
+sync_always = ["boot", "etc", "lib/apk", "root", "var"]
+
+
+def parse_installed_files(path):
+    """
+    Parse the packages and the files they own from apk's installed packages
+    database.
+
+    :param path: path to lib/apk/db/installed
+    :returns: dict of pkgname and package information, e.g.:
+              {"busybox": {"version": "1.36.1-r5",
+                           "checksum": "Q1...=",
+                           "folders": ["bin", ...],
+                           "files": ["bin/busybox", ...]}, ...}
+              Paths are relative to the root of the filesystem.
+    """
+    ret = {}
+    if not os.path.exists(path):
+        return ret
+
+    with open(path, encoding="utf-8") as handle:
+        lines = handle.readlines()
+    lines.append("\n")
+
+    package = {}
+    folder = None
+    for line in lines:
+        if line == "\n":
+            if "pkgname" in package:
+                ret[package.pop("pkgname")] = package
+            package = {}
+            folder = None
+            continue
+        if not package:
+            package = {"version": None, "checksum": None, "folders": [],
+                       "files": []}
+
+        key, value = line[0], line[2:-1]
+        if key == "P":
+            package["pkgname"] = value
+        elif key == "V":
+            package["version"] = value
+        elif key == "C":
+            package["checksum"] = value
+        elif key == "F":
+            folder = value
+            package["folders"].append(folder)
+        elif key == "R":
+            package["files"].append(f"{folder}/{value}" if folder else value)
+    return ret
+
+
+def get_changes(installed_old, installed_new):
+    """
+    Compare two installed packages databases.
+
+    :param installed_old: parse_installed_files() of the previous install
+    :param installed_new: parse_installed_files() of the new rootfs
+    :returns: (update, delete)
+              * update: sorted list of files and folders from packages that
+                were added or changed (different version or checksum)
+              * delete: sorted list of files from packages that were removed
+                or changed, which are not owned by any package anymore
+                (folders are kept, they may have files not owned by the
+                package)
+    """
+    update = set()
+    delete = set()
+    for pkgname, package in installed_new.items():
+        package_old = installed_old.get(pkgname)
+        if package_old and \
+                package_old["version"] == package["version"] and \
+                package_old["checksum"] == package["checksum"]:
+            continue
+        update.update(package["folders"])
+        update.update(package["files"])
+
+    for pkgname, package_old in installed_old.items():
+        package = installed_new.get(pkgname)
+        if package and package_old["version"] == package["version"] and \
+                package_old["checksum"] == package["checksum"]:
+            continue
+        delete.update(package_old["files"])
+
+    owned = set()
+    for package in installed_new.values():
+        owned.update(package["files"])
+    return (sorted(update), sorted(delete - owned))
+
+
+def get_trigger_folders(rootfs):
+    """
+    Get the folders watched by apk triggers. The trigger scripts generate
+    files in there (icon caches, compiled schemas, ...) that are not owned
+    by any package.
+
+    :param rootfs: path to the rootfs chroot on the host system
+    :returns: sorted list of paths relative to rootfs
+    """
+    ret = set()
+    path = f"{rootfs}/lib/apk/db/triggers"
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            # Format: "<checksum> /folder1 /folder2/* ..."
+            for pattern in line.split()[1:]:
+                for folder in glob.glob(f"{rootfs}{pattern}"):
+                    if os.path.isdir(folder):
+                        ret.add(os.path.relpath(folder, rootfs))
+    return sorted(ret)
+
+
+def write_list(args, name, paths):
+    """
+    Write a NUL separated list of paths to /tmp in the native chroot.
+
+    :returns: path to the list inside the native chroot
+    """
+    path = f"/tmp/{name}"
+    with open(f"{args.work}/chroot_native{path}", "w") as handle:
+        handle.write("\0".join(paths))
+    return path
+
+
+def rsync(args, suffix, mountpoint, target="/mnt/install"):
+    """
+    Update the previous installation in target with the changes from the
+    rootfs chroot. Instead of letting rsync compare all files, only copy the
+    files of packages that changed according to apk's installed packages
+    database and the folders that have files not owned by any package.
+
+    :param suffix: the chroot suffix, e.g. "rootfs_qemu-amd64"
+    :param mountpoint: where the rootfs chroot is mounted inside the native
+                       chroot (see mount_device_rootfs())
+    :param target: path inside the native chroot, where the previous
+                   installation is mounted
+    :returns: False if the previous installation has no installed packages
+              database, so the caller needs to sync everything instead
+    """
+    rootfs = f"{args.work}/chroot_{suffix}"
+    target_outside = f"{args.work}/chroot_native{target}"
+    db = "lib/apk/db/installed"
+    if not os.path.exists(f"{target_outside}/{db}"):
+        logging.info("NOTE: no installed packages database found in previous"
+                     " installation, updating all files")
+        return False
+
+    installed_old = parse_installed_files(f"{target_outside}/{db}")
+    installed_new = parse_installed_files(f"{rootfs}/{db}")
+    (update, delete) = get_changes(installed_old, installed_new)
+    folders = [folder for folder in sync_always
+               if os.path.exists(f"{rootfs}/{folder}")]
+    folders += get_trigger_folders(rootfs)
+    logging.info(f"(native) update {target}: {len(update)} paths of changed"
+                 f" packages, delete {len(delete)} paths")
+
+    pmb.chroot.apk.install(args, ["rsync"])
+    rsync_flags = "-a"
+    if args.verbose:
+        rsync_flags += "v"
+
+    # Delete files of removed packages first
+    if delete:
+        list_delete = write_list(args, "pmb_rsync_delete", delete)
+        pmb.chroot.root(args, ["sh", "-c", "xargs -0 -r rm -f --"
+                               f" < {list_delete}"], working_dir=target)
+
+    # Files from new and changed packages (--files-from does not recurse)
+    if update:
+        list_update = write_list(args, "pmb_rsync_update", update)
+        pmb.chroot.root(args, ["rsync", rsync_flags, "--from0",
+                               f"--files-from={list_update}", ".",
+                               f"{target}/"], working_dir=mountpoint)
+
+    # Folders with files that are not owned by packages
+    pmb.chroot.root(args, ["rsync", rsync_flags, "--relative", "--delete"] +
+                    [f"{folder}/" for folder in folders] + [f"{target}/"],
+                    working_dir=mountpoint)
+
+    for name in ["pmb_rsync_delete", "pmb_rsync_update"]:
+        path = f"{args.work}/chroot_native/tmp/{name}"
+        if os.path.exists(path):
+            os.unlink(path)
+    return True
@@ -8,6 +8,7 @@ from collections import OrderedDict
 
 import pmb.config
 import pmb.helpers.devices
+import pmb.helpers.other
 import pmb.parse.version
 
 # sh variable name regex: https://stackoverflow.com/a/2821201/3527128
@@ -1,15 +1,80 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import collections
+import collections.abc
 import logging
 import os
+import sys
 import tarfile
-import pmb.chroot.apk
+import pmb.helpers.other
 import pmb.helpers.package
 import pmb.helpers.repo
 import pmb.parse.version
 
 
+# Keys of APKINDEX blocks that get parsed, all other keys are ignored
+block_keys = {
+    "A": "arch",
+    "C": "checksum",
+    "D": "depends",
+    "o": "origin",
+    "P": "pkgname",
+    "p": "provides",
+    "k": "provider_priority",
+    "t": "timestamp",
+    "V": "version",
+}
+
+
+# Keys of APKINDEX blocks with values that are the same in many blocks (e.g.
+# the same package for multiple arches), these get interned with sys.intern()
+block_keys_interned = ["arch", "depends", "origin", "pkgname", "provides",
+                       "version"]
+
+
+class Block(collections.abc.Mapping):
+    """
+    One parsed APKINDEX block. It behaves like a read-only dict with the
+    keys from block_keys, but stores the values in slots instead of a dict
+    per block, "depends" and "provides" as tuples and the names interned, to
+    keep the memory usage low when parsing many APKINDEX files. Keys that
+    are not set in the APKINDEX (e.g. "origin" for virtual packages) are
+    missing like in a dict. The lists returned for "depends" and "provides"
+    are copies, so they can be modified without changing the cached block.
+    """
+    __slots__ = tuple(block_keys.values())
+
+    def __init__(self, values):
+        """ :param values: dict with keys from block_keys """
+        for key in self.__slots__:
+            value = values.get(key)
+            if isinstance(value, list):
+                value = tuple(sys.intern(item) for item in value)
+            elif value is not None and key in block_keys_interned:
+                value = sys.intern(value)
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        if isinstance(value, tuple):
+            return list(value)
+        return value
+
+    def __iter__(self):
+        return (key for key in self.__slots__
+                if getattr(self, key) is not None)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 def parse_next_block(path, lines, start):
     """
     Parse the next block in an APKINDEX.
@@ -19,8 +84,10 @@ def parse_next_block(path, lines, start):
                   function. Wrapped into a list, so it can be modified
                   "by reference". Example: [5]
     :param lines: all lines from the "APKINDEX" file inside the archive
-    :returns: a dictionary with the following structure:
+    :returns: a Block, which can be used like a dict with the following
+              structure:
               { "arch": "noarch",
+                "checksum": "Q1XaZzCVZ9mvH8djPyEb5aUYhG3r4=",
                 "depends": ["busybox-extras", "lddtree", ... ],
                 "origin": "postmarketos-mkinitfs",
                 "pkgname": "postmarketos-mkinitfs",
@@ -37,16 +104,6 @@ def parse_next_block(path, lines, start):
 
     # Parse until we hit an empty line or end of file
     ret = {}
-    mapping = {
-        "A": "arch",
-        "D": "depends",
-        "o": "origin",
-        "P": "pkgname",
-        "p": "provides",
-        "k": "provider_priority",
-        "t": "timestamp",
-        "V": "version",
-    }
     end_of_block_found = False
     for i in range(start[0], len(lines)):
         # Check for empty line
@@ -59,7 +116,7 @@ def parse_next_block(path, lines, start):
             break
 
         # Parse keys from the mapping
-        for letter, key in mapping.items():
+        for letter, key in block_keys.items():
             if line.startswith(letter + ":"):
                 if key in ret:
                     raise RuntimeError(
@@ -89,7 +146,7 @@ def parse_next_block(path, lines, start):
                     ret[key].append(value)
             else:
                 ret[key] = []
-        return ret
+        return Block(ret)
 
     # No more blocks
     elif ret != {}:
@@ -222,6 +279,62 @@ def parse(path, multiple_providers=True):
     return ret
 
 
+def parse_db(path):
+    """
+    Parse apk's installed packages database (lib/apk/db/installed) like
+    parse(path, False), but incrementally: the database changes after every
+    apk transaction, so it would need to be parsed again each time. Instead,
+    blocks that did not change since the last call are taken from the
+    cache, and only new or changed blocks get parsed. Lines with keys that
+    are not in block_keys (e.g. the file lists) are skipped before parsing,
+    they make up most of the database.
+
+    :param path: path to lib/apk/db/installed
+    :returns: same as parse(path, False)
+    """
+    if not os.path.isfile(path):
+        logging.verbose(f"NOTE: apk database not found: {path}")
+        return {}
+
+    # Cache by modification time, like parse()
+    lastmod = os.stat(path).st_mtime_ns
+    cache = pmb.helpers.other.cache["pmb.parse.apkindex.parse_db"]
+    cache_path = cache.get(path, {"lastmod": None, "blocks": {}})
+    if cache_path["lastmod"] == lastmod:
+        return cache_path["ret"]
+
+    with open(path, encoding="utf-8") as handle:
+        content = handle.read()
+
+    keys = [f"{letter}:" for letter in block_keys]
+    blocks = {}
+    ret = collections.OrderedDict()
+    for text in content.split("\n\n"):
+        if not text.strip("\n"):
+            continue
+
+        # Reuse blocks that did not change
+        block = cache_path["blocks"].get(text)
+        if not block:
+            lines = [f"{line}\n" for line in text.split("\n")
+                     if line[:2] in keys]
+            block = parse_next_block(path, lines + ["\n"], [0])
+        blocks[text] = block
+
+        # Skip virtual packages, add the package and all aliases
+        if "timestamp" not in block:
+            logging.verbose(f"Skipped virtual package {block} in file: {path}")
+            continue
+        parse_add_block(ret, block, None, False)
+        for alias in block["provides"]:
+            parse_add_block(ret, block, alias, False)
+
+    count = len(blocks.keys() - cache_path["blocks"].keys())
+    logging.verbose(f"Parsed {count} new or changed block(s) in: {path}")
+    cache[path] = {"lastmod": lastmod, "blocks": blocks, "ret": ret}
+    return ret
+
+
 def parse_blocks(path):
     """
     Read all blocks from an APKINDEX.tar.gz into a list.
@@ -249,6 +362,27 @@ def parse_blocks(path):
         ret.append(block)
 
 
+def installed_size(path):
+    """
+    Sum up the installed size of all packages in apk's installed packages
+    database, without parsing the blocks.
+
+    :param path: to lib/apk/db/installed
+    :returns: (size, files)
+              * size: sum of all "I:" fields in bytes
+              * files: amount of files owned by the packages ("R:" fields)
+    """
+    size = 0
+    files = 0
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            if line.startswith("I:"):
+                size += int(line[2:])
+            elif line.startswith("R:"):
+                files += 1
+    return (size, files)
+
+
 def clear_cache(path):
     """
     Clear the APKINDEX parsing cache.
@@ -11,8 +11,10 @@ except ImportError:
     pass
 
 import pmb.config
+import pmb.helpers.other
 import pmb.parse.arch
 import pmb.helpers.args
+import pmb.helpers.completion
 import pmb.helpers.pmaports
 
 """ This file is about parsing command line arguments passed to pmbootstrap, as
@@ -111,10 +113,13 @@ def arguments_install(subparser):
     group.add_argument("--no-image", help="do not generate an image",
                        action="store_true", dest="no_image")
 
-    # Image type "--disk" related
-    group = ret.add_argument_group("optional image type 'disk' arguments")
-    group.add_argument("--rsync", help="update the disk using rsync",
-                       action="store_true")
+    # Image type "--disk" and image file related
+    group = ret.add_argument_group("optional image type 'disk' and image file"
+                                   " arguments")
+    group.add_argument("--rsync", help="update the disk using rsync, or update"
+                       " the image file(s) of the previous installation with"
+                       " the files of changed packages (if they are still"
+                       " big enough)", action="store_true")
 
     # Image type "--android-recovery-zip" related
     group = ret.add_argument_group("optional image type 'android-recovery-zip'"
@@ -190,6 +195,12 @@ def arguments_install(subparser):
     group = ret.add_argument_group("other optional arguments")
     group.add_argument("--filesystem", help="root filesystem type",
                        choices=["ext4", "f2fs", "btrfs"])
+    group.add_argument("--mkfs-populate", dest="mkfs_populate",
+                       action="store_true",
+                       help="create the boot and root filesystems directly"
+                            " from the rootfs chroot (mkfs.ext4 -d) instead"
+                            " of mounting them and copying all files (faster,"
+                            " only for ext4 root filesystems)")
 
 
 def arguments_export(subparser):
@@ -205,6 +216,21 @@ def arguments_export(subparser):
                      action="store_true", dest="odin_flashable_tar")
     ret.add_argument("--no-install", dest="autoinstall", default=True,
                      help="skip updating kernel/initfs", action="store_false")
+
+    # Rootfs image files
+    group = ret.add_argument_group(
+        "optional rootfs image arguments",
+        "Write the rootfs image files to the export folder in other formats,"
+        " instead of only linking to them. All formats are generated in one"
+        " pass over the image, holes of the image are not read.")
+    group.add_argument("--compress", dest="export_compress",
+                       choices=["zstd", "xz"],
+                       help="compress the rootfs images with all CPU cores")
+    group.add_argument("--sparse", dest="export_sparse", action="store_true",
+                       help="write rootfs images in Android sparse image"
+                            " format (like img2simg)")
+    group.add_argument("--bmap", dest="export_bmap", action="store_true",
+                       help="write block maps for flashing with bmaptool")
     return ret
 
 
@@ -213,8 +239,11 @@ def arguments_sideload(subparser):
                                " phone connected over usb or wifi")
     add_packages_arg(ret, nargs="+")
     ret.add_argument("--host", help="ip of the device over wifi"
-                                    " (defaults to 172.16.42.1)",
-                     default="172.16.42.1")
+                                    " (defaults to 172.16.42.1). Specify"
+                                    " multiple times to install on multiple"
+                                    " devices at once (ssh and sudo must not"
+                                    " ask for passwords then)",
+                     action="append", dest="hosts")
     ret.add_argument("--port", help="SSH port of the device over wifi"
                                     " (defaults to 22)",
                      default="22")
@@ -398,6 +427,8 @@ def arguments_pkgrel_bump(subparser):
     ret.add_argument("--dry", action="store_true", help="instead of modifying"
                      " APKBUILDs, exit with >0 when a package would have been"
                      " bumped")
+    ret.add_argument("--report", metavar="FILE", help="with --auto, write"
+                     " the packages with missing depends as JSON to FILE")
 
     # Mutually exclusive: "--auto" or package names
     mode = ret.add_mutually_exclusive_group(required=True)
@@ -468,6 +499,32 @@ def arguments_newapkbuild(subparser):
                      " download link to the source archive")
 
 
+def arguments_repo(subparser):
+    arch_choices = set(pmb.config.build_device_architectures +
+                       [pmb.config.arch_native])
+
+    # Repo subparser
+    ret = subparser.add_parser("repo", help="manage the repository of locally"
+                               " built packages")
+    sub = ret.add_subparsers(dest="action_repo")
+    sub.required = True
+
+    # "pmbootstrap repo publish"
+    publish = sub.add_parser("publish", help="upload the locally built"
+                             " packages as static repository, which can be"
+                             " used as additional mirror with -mp (only new"
+                             " and changed packages get uploaded)")
+    publish.add_argument("dest", help="local folder or ssh target, e.g."
+                         " user@host:/srv/postmarketos")
+    publish.add_argument("--arch", choices=arch_choices, action="append",
+                         dest="arches", help="only publish this arch (can be"
+                         " specified multiple times, default: all arches)")
+    publish.add_argument("--port", default="22", help="ssh port (default:"
+                         " %(default)s)")
+    publish.add_argument("--dry", action="store_true", help="only print what"
+                         " would be uploaded and removed")
+
+
 def arguments_kconfig(subparser):
     # Allowed architectures
     arch_native = pmb.config.arch_native
@@ -529,6 +586,12 @@ def arguments_repo_missing(subparser):
                      help="include packages which exist in the binary repos")
     ret.add_argument("--overview", action="store_true",
                      help="only print the pkgnames without any details")
+    ret.add_argument("--all-arches", action="store_true", dest="all_arches",
+                     help="look at all architectures (instead of --arch), the"
+                     " output is a dict with the results of each arch")
+    ret.add_argument("--parallel", action="store_true",
+                     help="with --all-arches, look at all architectures at the"
+                     " same time in multiple processes")
     return ret
 
 
@@ -546,6 +609,15 @@ def arguments_status(subparser):
     return ret
 
 
+def arguments_mirror(subparser):
+    ret = subparser.add_parser("mirror", help="show the fastest mirrors"
+                               " (used with -m=auto and -mp=auto)")
+    ret.add_argument("--probe", action="store_true",
+                     help="measure latency and throughput of all mirrors"
+                          " again, instead of showing the cached results")
+    return ret
+
+
 def arguments_netboot(subparser):
     ret = subparser.add_parser("netboot",
                                help="launch nbd server with pmOS rootfs")
@@ -574,34 +646,57 @@ def arguments_ci(subparser):
     return ret
 
 
-def package_completer(prefix, action, parser=None, parsed_args=None):
+def init_completer_args(parsed_args):
+    """ Prepare the arguments for a completer (argparse did not run
+        pmb.helpers.args.init(), as the command line is incomplete). """
     args = parsed_args
     pmb.config.merge_with_args(args)
     pmb.helpers.args.replace_placeholders(args)
     pmb.helpers.other.init_cache()
+    return args
+
+
+def package_completer(prefix, action, parser=None, parsed_args=None):
+    args = init_completer_args(parsed_args)
     packages = set(
-        package for package in pmb.helpers.pmaports.get_list(args)
+        package for package in pmb.helpers.completion.get(args, "packages")
         if package.startswith(prefix))
     return packages
 
 
 def kernel_completer(prefix, action, parser=None, parsed_args=None):
     """ :returns: matched linux-* packages, with linux-* prefix and without """
+    args = init_completer_args(parsed_args)
     ret = []
+    for package in pmb.helpers.completion.get(args, "kernels"):
+        # Full package name, starting with "linux-"
+        if package.startswith(prefix):
+            ret += [package]
 
-    # Full package name, starting with "linux-"
-    if (len("linux-") < len(prefix) and prefix.startswith("linux-") or
-            "linux-".startswith(prefix)):
-        ret += package_completer(prefix, action, parser, parsed_args)
-
-    # Kernel name without "linux-"
-    packages = package_completer(f"linux-{prefix}", action, parser,
-                                 parsed_args)
-    ret += [package.replace("linux-", "", 1) for package in packages]
+        # Kernel name without "linux-"
+        if package.startswith(f"linux-{prefix}"):
+            ret += [package.replace("linux-", "", 1)]
 
     return ret
 
 
+def device_completer(prefix, action, parser=None, parsed_args=None):
+    args = init_completer_args(parsed_args)
+    return [device for device in pmb.helpers.completion.get(args, "devices")
+            if device.startswith(prefix)]
+
+
+def config_value_completer(prefix, action, parser=None, parsed_args=None):
+    """ :returns: matched devices or UIs for 'pmbootstrap config device/ui'
+    """
+    if parsed_args.name not in ["device", "ui"]:
+        return []
+    args = init_completer_args(parsed_args)
+    key = "devices" if parsed_args.name == "device" else "uis"
+    return [value for value in pmb.helpers.completion.get(args, key)
+            if value.startswith(prefix)]
+
+
 def add_packages_arg(subparser, name="packages", *args, **kwargs):
     arg = subparser.add_argument(name, *args, **kwargs)
     if "argcomplete" in sys.modules:
@@ -634,10 +729,12 @@ def arguments():
     parser.add_argument("-mp", "--mirror-pmOS", dest="mirrors_postmarketos",
                         help="postmarketOS mirror, disable with: -mp='',"
                              " specify multiple with: -mp='one' -mp='two',"
+                             " select the fastest with: -mp=auto,"
                              f" default: {mirrors_pmos_default}",
                         metavar="URL", action="append", default=[])
     parser.add_argument("-m", "--mirror-alpine", dest="mirror_alpine",
-                        help="Alpine Linux mirror, default: " +
+                        help="Alpine Linux mirror, select the fastest"
+                             " with: -m=auto, default: " +
                              pmb.config.defaults["mirror_alpine"],
                         metavar="URL")
     parser.add_argument("-j", "--jobs", help="parallel jobs when compiling")
@@ -678,6 +775,10 @@ def arguments():
     # Logging
     parser.add_argument("-l", "--log", dest="log", default=None,
                         help="path to log file")
+    parser.add_argument("--log-json", dest="log_json", action="store_true",
+                        help="additionally write the log as JSON lines, to"
+                             " the path of the log file with the extension"
+                             " .jsonl (e.g. log.jsonl)")
     parser.add_argument("--details-to-stdout", dest="details_to_stdout",
                         help="print details (e.g. build output) to stdout,"
                              " instead of writing to the log",
@@ -698,6 +799,7 @@ def arguments():
                                         " non-interactively to migrate the"
                                         " work folder version on demand")
     arguments_repo_missing(sub)
+    arguments_repo(sub)
     arguments_kconfig(sub)
     arguments_export(sub)
     arguments_sideload(sub)
@@ -710,6 +812,7 @@ def arguments():
     arguments_newapkbuild(sub)
     arguments_lint(sub)
     arguments_status(sub)
+    arguments_mirror(sub)
     arguments_ci(sub)
 
     # Action: log
@@ -734,7 +837,8 @@ def arguments():
     zap.add_argument("-m", "--pkgs-local-mismatch", action="store_true",
                      dest="pkgs_local_mismatch",
                      help="also delete locally compiled packages without"
-                     " existing aport of same version")
+                     " existing aport of same version, or whose aport"
+                     " changed since they were built")
     zap.add_argument("-n", "--netboot", action="store_true",
                      help="also delete stored images for netboot")
     zap.add_argument("-o", "--pkgs-online-mismatch", action="store_true",
@@ -743,6 +847,14 @@ def arguments():
                      " (that have been downloaded to the apk cache)")
     zap.add_argument("-r", "--rust", action="store_true",
                      help="also delete rust related caches")
+    zap.add_argument("--gc", action="store_true",
+                     help="also delete locally compiled packages that are"
+                     " older than the newest versions (see --gc-keep), or not"
+                     " needed by the configured device or any chroot")
+    zap.add_argument("--gc-keep", type=int, dest="gc_keep",
+                     default=pmb.config.zap_gc_keep, metavar="N",
+                     help="with --gc, keep the N newest versions of each"
+                     " package (default: %(default)s)")
 
     zap_all_delete_args = ["http", "distfiles", "pkgs_local",
                            "pkgs_local_mismatch", "netboot", "pkgs_online_mismatch",
@@ -872,7 +984,9 @@ def arguments():
 
     # Action: deviceinfo_parse
     deviceinfo_parse = sub.add_parser("deviceinfo_parse")
-    deviceinfo_parse.add_argument("devices", nargs="*")
+    devices = deviceinfo_parse.add_argument("devices", nargs="*")
+    if "argcomplete" in sys.modules:
+        devices.completer = device_completer
     deviceinfo_parse.add_argument("--kernel", help="the kernel to select (for"
                                   " device packages with multiple kernels),"
                                   " e.g. 'downstream', 'mainline'",
@@ -897,7 +1011,10 @@ def arguments():
     config.add_argument("name", nargs="?", help="variable name, one of: " +
                         ", ".join(sorted(pmb.config.config_keys)),
                         choices=pmb.config.config_keys, metavar="name")
-    config.add_argument("value", nargs="?", help="set variable to value")
+    value = config.add_argument("value", nargs="?",
+                                help="set variable to value")
+    if "argcomplete" in sys.modules:
+        value.completer = config_value_completer
 
     # Action: bootimg_analyze
     bootimg_analyze = sub.add_parser("bootimg_analyze", help="Extract all the"
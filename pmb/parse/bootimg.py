@@ -45,6 +45,11 @@ def get_mtk_label(path):
 
 
 def bootimg(args, path):
+    # Imported here to keep parsing arguments fast (see pmb/__init__.py)
+    import pmb.chroot
+    import pmb.chroot.apk
+    import pmb.chroot.other
+
     if not os.path.exists(path):
         raise RuntimeError("Could not find file '" + path + "'")
 
@@ -5,7 +5,6 @@ import logging
 import re
 import os
 
-import pmb.build
 import pmb.config
 import pmb.parse
 import pmb.helpers.pmaports
@@ -1,17 +1,91 @@
 # Copyright 2023 Martijn Braam
 # SPDX-License-Identifier: GPL-3.0-or-later
+import concurrent.futures
 import glob
 import os
 import logging
+import time
 
+import pmb.helpers.manifest
 import pmb.helpers.run
 import pmb.helpers.run_core
 import pmb.parse.apkindex
 import pmb.config.pmaports
 import pmb.build
 
+# Packages get copied to this folder on the target device, and it gets removed
+# after installing them. If installing fails, the packages stay there, so
+# they only need to be copied again if they changed.
+remote_dir = "/tmp/pmbootstrap-sideload"
 
-def scp_abuild_key(args, user, host, port):
+
+def ssh_options(args, interactive):
+    """ :param interactive: allow asking for passwords and host key
+                            confirmation (only when sideloading to one host)
+        :returns: options for ssh and scp, to open one multiplexed connection
+                  per host and reuse it for all commands """
+    ret = ["-o", "ControlMaster=auto",
+           "-o", f"ControlPath={args.work}/ssh/%C",
+           "-o", "ControlPersist=60"]
+    if not interactive:
+        ret += ["-o", "BatchMode=yes"]
+    return ret
+
+
+def ssh(args, user, host, port, remote_cmd, interactive, tty=False,
+        output_return=False):
+    """ Run a command on the target device.
+        :param user: target device ssh username
+        :param host: target device ssh hostname
+        :param port: target device ssh port
+        :param remote_cmd: shell command to run on the target device
+        :param interactive: see ssh_options()
+        :param tty: allocate a tty, e.g. for sudo's password prompt (only
+                    with interactive)
+        :param output_return: return the output of remote_cmd """
+    command = ["ssh"] + ssh_options(args, interactive) + ["-p", port]
+    output = "log"
+    if tty and interactive:
+        command += ["-t"]
+        output = "tui"
+    command += [f"{user}@{host}", remote_cmd]
+    return pmb.helpers.run.user(args, command, output=output,
+                                output_return=output_return)
+
+
+def ssh_connect(args, user, host, port):
+    """ Open the multiplexed connection to the target device in the
+        background, so ssh can ask for passwords and host key confirmation
+        in the terminal. The following ssh and scp commands reuse it, also
+        the ones that write their output only to the log. """
+    command = ["ssh"] + ssh_options(args, True)
+    command += ["-p", port, "-M", "-N", "-f", f"{user}@{host}"]
+    pmb.helpers.run.user(args, command, output="interactive")
+
+
+def scp(args, user, host, port, paths, target, interactive):
+    """ Copy files to the target device.
+        :param paths: list of absolute paths to local files
+        :param target: folder on the target device """
+    command = ["scp"] + ssh_options(args, interactive) + ["-P", port]
+    command += paths + [f"{user}@{host}:{target}/"]
+    output = "interactive" if interactive else "log"
+    pmb.helpers.run.user(args, command, output=output)
+
+
+def sudo(remote_cmd, interactive):
+    """ :param remote_cmd: list of the command and its arguments
+        :returns: remote_cmd as flat string, running with sudo on the target
+                  device. Without interactive, sudo must not ask for a
+                  password. """
+    if interactive:
+        ret = ["sudo", "-p", pmb.config.sideload_sudo_prompt, "-S"]
+    else:
+        ret = ["sudo", "-n"]
+    return pmb.helpers.run_core.flat_cmd(ret + remote_cmd)
+
+
+def scp_abuild_key(args, user, host, port, interactive=True):
     """ Copy the building key of the local installation to the target device,
         so it trusts the apks that were signed here.
         :param user: target device ssh username
@@ -23,56 +97,219 @@ def scp_abuild_key(args, user, host, port):
     key_name = os.path.basename(key)
 
     logging.info(f"Copying signing key ({key_name}) to {user}@{host}")
-    command = ['scp', '-P', port, key, f'{user}@{host}:/tmp']
-    pmb.helpers.run.user(args, command, output="interactive")
+    scp(args, user, host, port, [key], "/tmp", interactive)
 
     logging.info(f"Installing signing key at {user}@{host}")
     keyname = os.path.join("/tmp", os.path.basename(key))
-    remote_cmd = ['sudo', '-p', pmb.config.sideload_sudo_prompt,
-                  '-S', 'mv', '-n', keyname, "/etc/apk/keys/"]
-    remote_cmd = pmb.helpers.run_core.flat_cmd(remote_cmd)
-    command = ['ssh', '-t', '-p', port, f'{user}@{host}', remote_cmd]
-    pmb.helpers.run.user(args, command, output="tui")
+    remote_cmd = sudo(['mv', '-n', keyname, "/etc/apk/keys/"], interactive)
+    ssh(args, user, host, port, remote_cmd, interactive, tty=True)
 
 
-def ssh_install_apks(args, user, host, port, paths):
-    """ Copy binary packages via SCP and install them via SSH.
+def get_checksums(paths):
+    """ :param paths: list of absolute paths to locally stored apks
+        :returns: dict of file names and their sha256 checksums """
+    return {os.path.basename(path): pmb.helpers.manifest.get_sha256(path)
+            for path in paths}
+
+
+def get_remote_checksums(args, user, host, port, interactive):
+    """ Create remote_dir on the target device if it does not exist, and get
+        the checksums of the packages that are already in there.
+        :returns: dict of file names and their sha256 checksums """
+    remote_cmd = (f"mkdir -p {remote_dir} && cd {remote_dir} &&"
+                  " { sha256sum -- *.apk 2>/dev/null || true; }")
+    output = ssh(args, user, host, port, remote_cmd, interactive,
+                 output_return=True)
+    ret = {}
+    for line in output.splitlines():
+        # Format: "<checksum>  <file name>"
+        fields = line.split(None, 1)
+        if len(fields) == 2 and len(fields[0]) == 64:
+            ret[fields[1]] = fields[0]
+    return ret
+
+
+def ssh_install_apks(args, user, host, port, paths, checksums,
+                     interactive=True):
+    """ Copy binary packages via SCP (only the ones that are not on the target
+        device already) and install them via SSH.
         :param user: target device ssh username
         :param host: target device ssh hostname
         :param port: target device ssh port
         :param paths: list of absolute paths to locally stored apks
-        :type paths: list """
-
-    remote_paths = []
-    for path in paths:
-        remote_paths.append(os.path.join('/tmp', os.path.basename(path)))
+        :param checksums: get_checksums() of paths
+        :param interactive: see ssh_options()
+        :returns: list of the paths that were copied """
+    remote = get_remote_checksums(args, user, host, port, interactive)
+    copy = [path for path in paths
+            if remote.get(os.path.basename(path)) !=
+            checksums[os.path.basename(path)]]
 
-    logging.info(f"Copying packages to {user}@{host}")
-    command = ['scp', '-P', port] + paths + [f'{user}@{host}:/tmp']
-    pmb.helpers.run.user(args, command, output="interactive")
+    if copy:
+        logging.info(f"Copying {len(copy)} of {len(paths)} packages to"
+                     f" {user}@{host}")
+        scp(args, user, host, port, copy, remote_dir, interactive)
+    else:
+        logging.info(f"All {len(paths)} packages are on {user}@{host}"
+                     " already")
 
     logging.info(f"Installing packages at {user}@{host}")
-    add_cmd = ['sudo', '-p', pmb.config.sideload_sudo_prompt,
-               '-S', 'apk', '--wait', '30', 'add'] + remote_paths
-    add_cmd = pmb.helpers.run_core.flat_cmd(add_cmd)
-    clean_cmd = pmb.helpers.run_core.flat_cmd(['rm'] + remote_paths)
-    command = ['ssh', '-t', '-p', port, f'{user}@{host}',
-               f'{add_cmd}; rc=$?; {clean_cmd}; exit $rc']
-    pmb.helpers.run.user(args, command, output="tui")
+    remote_paths = [f"{remote_dir}/{os.path.basename(path)}"
+                    for path in paths]
+    add_cmd = sudo(['apk', '--wait', '30', 'add'] + remote_paths, interactive)
+    remove_cmd = pmb.helpers.run_core.flat_cmd(['rm', '-rf', remote_dir])
+    remote_cmd = f"{add_cmd} && {remove_cmd}"
+
+    # Remove packages from failed previous sideloads that are not needed
+    # anymore
+    outdated = [f"{remote_dir}/{name}" for name in sorted(remote)
+                if name not in checksums]
+    if outdated:
+        clean_cmd = pmb.helpers.run_core.flat_cmd(['rm', '-f'] + outdated)
+        remote_cmd = f"{clean_cmd}; {remote_cmd}"
+    ssh(args, user, host, port, remote_cmd, interactive, tty=True)
+    return copy
+
+
+def scp_get(args, user, host, port, remote_path, path, interactive):
+    """ Copy a file from the target device.
+        :param remote_path: file on the target device
+        :param path: local path to store it """
+    command = ["scp"] + ssh_options(args, interactive) + ["-P", port]
+    command += [f"{user}@{host}:{remote_path}", path]
+    pmb.helpers.run.user(args, command)
+
+
+def get_installed(args, user, host, port, interactive):
+    """ Download and parse apk's installed packages database of the target
+        device.
+        :returns: see pmb.parse.apkindex.parse() without multiple_providers,
+                  e.g. {"hello-world": block, "cmd:hello-world": block} """
+    path = f"{args.work}/ssh/installed_{user}@{host}_{port}"
+    scp_get(args, user, host, port, "/lib/apk/db/installed", path,
+            interactive)
+    return pmb.parse.apkindex.parse(path, False)
+
+
+def get_install_blocks(args, installed, pkgnames, arch, index):
+    """ Find the packages that need to be copied to and installed on the
+        target device.
+
+        :param installed: get_installed() of the target device
+        :param pkgnames: list of pkgnames to sideload
+        :param arch: target device architecture
+        :param index: path to the APKINDEX.tar.gz of the local repository
+        :returns: list of blocks (see pmb.parse.apkindex.parse_next_block())
+                  from the local repository: the packages from pkgnames that
+                  are not installed with the same version and checksum, and
+                  their dependencies from the local repository that are not
+                  installed on the target device. Other dependencies get
+                  installed by apk from the binary repositories that the
+                  target device is configured to use. """
+    ret = []
+    todo = [(pkgname, True) for pkgname in pkgnames]
+    done = set()
+    while todo:
+        name, requested = todo.pop(0)
+        if name in done or name.startswith("!"):
+            continue
+        done.add(name)
+
+        block = pmb.parse.apkindex.package(args, name, arch, False, [index])
+        if not block:
+            if requested:
+                raise RuntimeError(f"Package '{name}' not found in the local"
+                                   f" repository: {index}")
+            continue
 
+        block_installed = installed.get(name)
+        if block_installed:
+            # Dependency is satisfied by an installed package
+            if not requested:
+                continue
 
-def sideload(args, user, host, port, arch, copy_key, pkgnames):
-    """ Build packages if necessary and install them via SSH.
+            if block_installed["version"] == block["version"] and \
+                    block_installed.get("checksum") == block["checksum"]:
+                logging.verbose(f"{name}: {block['version']} is installed"
+                                " already, skipping")
+                continue
+
+        if block not in ret:
+            ret.append(block)
+        todo += [(depend, False) for depend in block["depends"]]
+    return ret
+
+
+def sideload_host(args, user, host, port, copy_key, pkgnames, arch, index,
+                  checksums, interactive):
+    """ Install the packages on one target device, and close the SSH
+        connection afterwards.
+        :param index: see get_install_blocks()
+        :param checksums: dict of already known checksums, see
+                          get_checksums()
+        :returns: dict with statistics for the summary, e.g.
+                  {"installed": 3, "copied": 2, "size": 1048576,
+                   "duration": 4.2} """
+    time_start = time.monotonic()
+    copied = []
+    try:
+        if interactive:
+            ssh_connect(args, user, host, port)
+        installed = get_installed(args, user, host, port, interactive)
+        blocks = get_install_blocks(args, installed, pkgnames, arch, index)
+        paths = [os.path.join(os.path.dirname(index),
+                              f"{block['pkgname']}-{block['version']}.apk")
+                 for block in blocks]
+        if paths:
+            for path in paths:
+                if os.path.basename(path) not in checksums:
+                    checksums.update(get_checksums([path]))
+
+            if copy_key:
+                scp_abuild_key(args, user, host, port, interactive)
+            copied = ssh_install_apks(args, user, host, port, paths,
+                                      checksums, interactive)
+        else:
+            logging.info(f"All packages are installed at {user}@{host}"
+                         " already")
+    finally:
+        command = ["ssh"] + ssh_options(args, False)
+        command += ["-p", port, "-O", "exit", f"{user}@{host}"]
+        pmb.helpers.run.user(args, command, check=False)
+
+    return {"installed": len(paths),
+            "copied": len(copied),
+            "size": sum(os.path.getsize(path) for path in copied),
+            "duration": time.monotonic() - time_start}
+
+
+def log_result(host, result):
+    """ :param result: return value of sideload_host() """
+    logging.info(f"{host}: installed {result['installed']} packages,"
+                 f" copied {result['copied']}"
+                 f" ({result['size'] / 1024 / 1024:.1f} MiB),"
+                 f" took {result['duration']:.1f}s")
+
+
+def sideload(args, user, hosts, port, arch, copy_key, pkgnames):
+    """ Build packages if necessary and install them via SSH. Only packages
+        that are not installed on the target device already get copied and
+        installed, together with their dependencies from the local
+        repository. With multiple hosts, the packages get copied and
+        installed on all of them at the same time. Then ssh must not ask for
+        passwords (use key authentication) and sudo on the target devices
+        must not ask for a password either.
 
         :param user: target device ssh username
-        :param host: target device ssh hostname
+        :param hosts: list of target device ssh hostnames
         :param port: target device ssh port
         :param arch: target device architecture
         :param copy_key: copy the abuild key too
         :param pkgnames: list of pkgnames to be built """
 
-    paths = []
     channel = pmb.config.pmaports.read_config(args)["channel"]
+    index = os.path.join(args.work, "packages", channel, arch,
+                         "APKINDEX.tar.gz")
 
     for pkgname in pkgnames:
         data_repo = pmb.parse.apkindex.package(args, pkgname, arch, True)
@@ -85,9 +322,43 @@ def sideload(args, user, host, port, arch, copy_key, pkgnames):
         if not os.path.isfile(host_path):
             raise RuntimeError(f"The package '{pkgname}' could not be built")
 
-        paths.append(host_path)
+    # The manifest knows the checksums of the local packages already
+    checksums = {f"{row['pkgname']}-{row['version']}.apk": row["sha256"]
+                 for row in pmb.helpers.manifest.packages(args, arch)}
+    os.makedirs(f"{args.work}/ssh", exist_ok=True)
+    interactive = len(hosts) == 1
+    if interactive:
+        result = sideload_host(args, user, hosts[0], port, copy_key,
+                               pkgnames, arch, index, checksums, True)
+        log_result(hosts[0], result)
+        return
 
-    if copy_key:
-        scp_abuild_key(args, user, host, port)
+    logging.info(f"Sideloading {len(pkgnames)} packages to {len(hosts)}"
+                 " hosts")
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(len(hosts)) as executor:
+        futures = {executor.submit(sideload_host, args, user, host, port,
+                                   copy_key, pkgnames, arch, index,
+                                   checksums, False): host
+                   for host in hosts}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
 
-    ssh_install_apks(args, user, host, port, paths)
+    # Summary
+    failed = []
+    for host in hosts:
+        result = results[host]
+        if isinstance(result, Exception):
+            logging.info(f"{host}: FAILED: {result}")
+            failed.append(host)
+            continue
+        log_result(host, result)
+    if failed:
+        raise RuntimeError(f"Sideloading failed for {len(failed)} of"
+                           f" {len(hosts)} hosts: {', '.join(failed)} (see"
+                           " log for details). Note that ssh and sudo must"
+                           " not ask for passwords when sideloading to"
+                           " multiple hosts.")
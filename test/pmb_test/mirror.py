@@ -0,0 +1,76 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Local stand-in for postmarketOS and Alpine mirrors """
+import http.server
+import threading
+import time
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """ Stand-in for a mirror. Set on the server object:
+        - files: dict of URL paths and their content
+        - delay: seconds to wait before responding
+        - errors: how many requests fail with 503 before one succeeds
+        - truncate: send only half of the body, then close the connection
+        - requests: list of (path, Range header) for each request """
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get("Range")))
+        time.sleep(server.delay)
+        if server.errors:
+            server.errors -= 1
+            return self.send_error(503)
+        if self.path not in server.files:
+            return self.send_error(404)
+
+        data = server.files[self.path]
+        offset = 0
+        end = len(data)
+        if self.headers.get("Range"):
+            first, last = self.headers["Range"][len("bytes="):].split("-")
+            offset = int(first)
+            if last:
+                end = min(end, int(last) + 1)
+            if offset >= len(data):
+                return self.send_error(416)
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - offset))
+        self.end_headers()
+
+        body = data[offset:end]
+        if server.truncate:
+            server.truncate = False
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start(count):
+    """ Start mirrors in background threads.
+
+        :param count: how many mirrors to start
+        :returns: list of http.server.ThreadingHTTPServer objects, with the
+                  attributes described in Handler and their URL in url """
+    ret = []
+    for _ in range(count):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.files = {}
+        server.delay = 0
+        server.errors = 0
+        server.truncate = False
+        server.requests = []
+        server.url = f"http://127.0.0.1:{server.server_address[1]}/"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        ret.append(server)
+    return ret
+
+
+def stop(servers):
+    for server in servers:
+        server.shutdown()
+        server.server_close()
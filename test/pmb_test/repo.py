@@ -0,0 +1,35 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Common code for tests with a local package repository """
+import io
+import os
+import tarfile
+
+
+def write(path, packages, mtime):
+    """ Create a local repository with an APKINDEX.tar.gz and apk files.
+
+        :param path: arch folder of the repository
+        :param packages: list of (pkgname, version, origin, apk content) or
+                         (pkgname, version, origin, apk content, depends),
+                         origin can be None
+        :param mtime: modification time of the APKINDEX.tar.gz in ns """
+    os.makedirs(path, exist_ok=True)
+    index = ""
+    for pkgname, version, origin, content, *depends in packages:
+        index += (f"C:Q1{pkgname}{version}=\nP:{pkgname}\nV:{version}\n"
+                  "A:x86_64\nt:1700000000\n")
+        if origin:
+            index += f"o:{origin}\n"
+        if depends and depends[0]:
+            index += f"D:{' '.join(depends[0])}\n"
+        index += "\n"
+        with open(f"{path}/{pkgname}-{version}.apk", "wb") as handle:
+            handle.write(content)
+
+    data = index.encode()
+    info = tarfile.TarInfo("APKINDEX")
+    info.size = len(data)
+    with tarfile.open(f"{path}/APKINDEX.tar.gz", "w:gz") as tar:
+        tar.addfile(info, io.BytesIO(data))
+    os.utime(f"{path}/APKINDEX.tar.gz", ns=(0, mtime))
@@ -1,12 +1,23 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import concurrent.futures
 import fnmatch
+import os
 import pytest
 import sys
+import threading
 
 import pmb_test  # noqa
 import pmb.build
 import pmb.chroot.apk
+import pmb.chroot.apk_fetch
+import pmb.chroot.apk_store
+import pmb.config.pmaports
+import pmb.helpers.logging
+import pmb.helpers.manifest
+import pmb.parse.arch
+import pmb.parse.depends
 
 
 @pytest.fixture
@@ -83,6 +94,36 @@ def test_packages_get_locally_built_apks(monkeypatch, args):
     assert fnmatch.fnmatch(ret[0], "*/hello-world-*.apk")
 
 
+def test_packages_get_locally_built_apks_removed(monkeypatch, tmpdir):
+    """ Packages in the cached manifest whose apk was removed are skipped """
+    args = argparse.Namespace(work=str(tmpdir))
+    monkeypatch.setattr(pmb.config.pmaports, "read_config",
+                        lambda args: {"channel": "edge"})
+    monkeypatch.setattr(pmb.helpers.manifest, "packages",
+                        lambda args, arch: [
+                            {"pkgname": "hello-world", "version": "1-r0"},
+                            {"pkgname": "removed", "version": "1-r0"}])
+    monkeypatch.setattr(pmb.parse.apkindex, "package",
+                        lambda args, pkgname, arch, must_exist:
+                        {"pkgname": pkgname, "version": "1-r0"})
+    os.makedirs(f"{tmpdir}/packages/edge/x86_64")
+    with open(f"{tmpdir}/packages/edge/x86_64/hello-world-1-r0.apk", "w"):
+        pass
+
+    func = pmb.chroot.apk.packages_get_locally_built_apks
+    assert func(args, ["hello-world", "removed", "other"], "x86_64") == [
+        "/mnt/pmbootstrap/packages/x86_64/hello-world-1-r0.apk"]
+
+
+def test_world_name():
+    func = pmb.chroot.apk.world_name
+    assert func("hello-world") == "hello-world"
+    assert func("!osk-sdl") == "osk-sdl"
+    assert func("hello-world>=1.0") == "hello-world"
+    assert func("hello-world><Q1XaZzCVZ9mvH8djPyEb5aUYhG3r4=") == \
+        "hello-world"
+
+
 def test_install_run_apk(monkeypatch, args):
     global cmds_progress
     global cmds
@@ -115,29 +156,33 @@ def test_install_run_apk(monkeypatch, args):
                               "--no-interactive"]]
     assert cmds == []
 
-    # Add and delete
+    # Add and delete, keep other packages in world
     reset_cmds()
+    monkeypatch.setattr(pmb.chroot.apk, "world_read",
+                        lambda args, suffix: ["alpine-base", "osk-sdl"])
     to_add = ["postmarketos-base", "device-ppp"]
     to_add_local = []
     to_del = ["osk-sdl"]
     func(args, to_add, to_add_local, to_del, suffix)
     assert cmds_progress == [["apk", "add", "postmarketos-base", "device-ppp",
-                              "--no-interactive"]]
-    assert cmds == [["apk", "--no-progress", "del", "osk-sdl",
-                     "--no-interactive"]]
+                              "!osk-sdl", "--no-interactive"]]
+    assert cmds == [["sh", "-c", "printf '%s\\n' alpine-base device-ppp"
+                     " postmarketos-base > /etc/apk/world"]]
+    monkeypatch.setattr(pmb.chroot.apk, "world_read", lambda args, suffix: [])
 
-    # Add with local package
+    # Add with local package (only upgrade the local package, then fix up
+    # world)
     reset_cmds()
     to_add = ["postmarketos-base", "device-ppp"]
     to_add_local = ["/tmp/device-ppp.apk"]
     to_del = []
     func(args, to_add, to_add_local, to_del, suffix)
-    assert cmds_progress == [["apk", "add", "postmarketos-base", "device-ppp",
+    assert cmds_progress == [["apk", "add", "postmarketos-base",
+                              "device-ppp", "--no-interactive"],
+                             ["apk", "add", "-u", "/tmp/device-ppp.apk",
                               "--no-interactive"]]
-    assert cmds == [["apk", "--no-progress", "add", "-u", "--virtual",
-                     ".pmbootstrap", "/tmp/device-ppp.apk", "--no-interactive"],
-                    ["apk", "--no-progress", "del", ".pmbootstrap",
-                     "--no-interactive"]]
+    assert cmds == [["sh", "-c", "printf '%s\\n' device-ppp"
+                     " postmarketos-base > /etc/apk/world"]]
 
     # Add with --no-network
     reset_cmds()
@@ -158,3 +203,112 @@ def test_install_run_apk(monkeypatch, args):
     with pytest.raises(ValueError) as e:
         func(args, to_add, to_add_local, to_del, suffix)
     assert "Invalid package name" in str(e.value)
+
+
+def test_install_lock(monkeypatch):
+    """ Other threads can't initialize the same chroot while it gets
+        initialized, but other chroots """
+    acquired = []
+
+    def try_acquire(suffix):
+        lock = pmb.chroot.apk.get_lock(suffix)
+        acquired.append(lock.acquire(blocking=False))
+        if acquired[-1]:
+            lock.release()
+
+    def fake_check_min_version(args, suffix):
+        for suffix_other in [suffix, "rootfs_qemu-amd64"]:
+            thread = threading.Thread(target=try_acquire,
+                                      args=(suffix_other,))
+            thread.start()
+            thread.join()
+        raise RuntimeError("stop")
+    monkeypatch.setattr(pmb.chroot.apk, "check_min_version",
+                        fake_check_min_version)
+    monkeypatch.setattr(pmb.parse.arch, "from_chroot_suffix",
+                        lambda args, suffix: "x86_64")
+
+    with pytest.raises(RuntimeError, match="stop"):
+        pmb.chroot.apk.install(argparse.Namespace(), ["hello-world"])
+    assert acquired == [False, True]
+
+    # Released afterwards
+    lock = pmb.chroot.apk.get_lock("native")
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+def test_install_parallel(monkeypatch):
+    """ Two threads initialize their chroots and run apk at the same time """
+    module = pmb.chroot.apk
+    barrier = threading.Barrier(2, timeout=10)
+    steps = []
+
+    def step(name, suffix):
+        barrier.wait()
+        steps.append((name, suffix))
+    monkeypatch.setattr(module, "check_min_version", lambda args, suffix:
+                        step("init", suffix))
+    monkeypatch.setattr(module, "install_run_apk",
+                        lambda args, to_add, to_add_local, to_del, suffix:
+                        step("apk", suffix))
+    monkeypatch.setattr(pmb.chroot, "init", lambda args, suffix: None)
+    monkeypatch.setattr(pmb.parse.arch, "from_chroot_suffix",
+                        lambda args, suffix: "x86_64")
+    monkeypatch.setattr(pmb.parse.depends, "recurse",
+                        lambda args, packages, suffix: packages)
+    monkeypatch.setattr(module, "packages_get_locally_built_apks",
+                        lambda args, packages, arch: [])
+    monkeypatch.setattr(module, "world_read", lambda args, suffix: [])
+    monkeypatch.setattr(module, "installed", lambda args, suffix: {})
+    monkeypatch.setattr(pmb.chroot.apk_store, "link_to_cache",
+                        lambda args, arch, packages: None)
+    monkeypatch.setattr(pmb.chroot.apk_fetch, "download",
+                        lambda args, packages, suffix, installed: None)
+    monkeypatch.setattr(pmb.chroot.apk_store, "add_from_cache",
+                        lambda args, arch: None)
+
+    # The barrier raises BrokenBarrierError if one thread waits for the other
+    args = argparse.Namespace()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(module.install, args, ["postmarketos-ondev"],
+                                 "installer_qemu-amd64", False)
+        module.install(args, ["postmarketos-base"], "rootfs_qemu-amd64",
+                       False)
+    future.result()
+    assert sorted(steps) == [("apk", "installer_qemu-amd64"),
+                             ("apk", "rootfs_qemu-amd64"),
+                             ("init", "installer_qemu-amd64"),
+                             ("init", "rootfs_qemu-amd64")]
+
+
+def test_install_already_installed(monkeypatch):
+    """ Only skip apk if the packages are in the world file and installed """
+    pmb.helpers.logging.add_verbose_log_level()
+    module = pmb.chroot.apk
+    monkeypatch.setattr(module, "check_min_version", lambda args, suffix: None)
+    monkeypatch.setattr(pmb.chroot, "init", lambda args, suffix: None)
+    monkeypatch.setattr(pmb.parse.arch, "from_chroot_suffix",
+                        lambda args, suffix: "x86_64")
+    monkeypatch.setattr(pmb.parse.depends, "recurse",
+                        lambda args, packages, suffix: ["hello-world",
+                                                        "musl"])
+    monkeypatch.setattr(module, "packages_get_locally_built_apks",
+                        lambda args, packages, arch: [])
+    monkeypatch.setattr(module, "world_read",
+                        lambda args, suffix: ["hello-world"])
+
+    def fake_link_to_cache(args, arch, packages):
+        raise RuntimeError("apk called")
+    monkeypatch.setattr(pmb.chroot.apk_store, "link_to_cache",
+                        fake_link_to_cache)
+
+    # In world and installed
+    installed = {"hello-world": {}, "musl": {}}
+    monkeypatch.setattr(module, "installed", lambda args, suffix: installed)
+    module.install(argparse.Namespace(), ["hello-world"], build=False)
+
+    # In world, but a dependency is missing in the installed db
+    del installed["musl"]
+    with pytest.raises(RuntimeError, match="apk called"):
+        module.install(argparse.Namespace(), ["hello-world"], build=False)
@@ -5,6 +5,7 @@ import sys
 import pytest
 
 import pmb_test  # noqa
+import pmb.build
 import pmb.helpers.logging
 import pmb.helpers.pmaports
 
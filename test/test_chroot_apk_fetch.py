@@ -0,0 +1,124 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import base64
+import gzip
+import hashlib
+import os
+import subprocess
+
+import pmb_test  # noqa
+import pmb_test.mirror
+import pmb.chroot.apk_fetch
+import pmb.chroot.apk_store
+import pmb.helpers.http
+import pmb.helpers.logging
+import pmb.helpers.other
+import pmb.helpers.repo
+import pmb.helpers.run
+import pmb.parse.apkindex
+import pmb.parse.arch
+
+
+def create_apk(name, signed=True):
+    """ :returns: (content, checksum) of a fake apk file with gzip streams
+                  like a real one """
+    control = gzip.compress(f"pkgname = {name}\n".encode())
+    data = gzip.compress(b"data" * 100)
+    content = control + data
+    if signed:
+        content = gzip.compress(b"signature") + content
+    checksum = base64.b64encode(hashlib.sha1(control).digest()).decode()
+    return (content, f"Q1{checksum}")
+
+
+def test_verify(tmpdir):
+    func = pmb.chroot.apk_fetch.verify
+    path = f"{tmpdir}/test.apk"
+    for signed in [True, False]:
+        content, checksum = create_apk("hello-world", signed)
+        with open(path, "wb") as handle:
+            handle.write(content)
+        assert func(path, checksum)
+        assert not func(path, create_apk("other")[1])
+
+    with open(path, "wb") as handle:
+        handle.write(content[:20])
+    assert not func(path, checksum)
+
+    # Control segment after a signature that is bigger than the chunks the
+    # file gets read in
+    content, checksum = create_apk("hello-world", False)
+    with open(path, "wb") as handle:
+        handle.write(gzip.compress(os.urandom(3 * 1024 * 1024)) + content)
+    assert func(path, checksum)
+
+
+def test_download(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    args = argparse.Namespace(work=str(tmpdir), offline=False,
+                              details_to_stdout=False,
+                              mirrors_postmarketos=[],
+                              mirror_alpine="http://alpine.invalid/")
+    monkeypatch.setattr(pmb.helpers.run, "root",
+                        lambda args, cmd: subprocess.run(cmd, check=True))
+    monkeypatch.setattr(pmb.helpers.run, "user",
+                        lambda args, cmd: subprocess.run(cmd, check=True))
+    monkeypatch.setattr(pmb.parse.arch, "from_chroot_suffix",
+                        lambda args, suffix: "aarch64")
+
+    server = pmb_test.mirror.start(1)[0]
+    repo = f"{server.url}main"
+    monkeypatch.setattr(pmb.helpers.repo, "urls", lambda args, user: [repo])
+
+    # Repository with: a (installed already), b (to download), c (broken)
+    packages = {}
+    index = ""
+    for pkgname in ["a", "b", "c"]:
+        content, checksum = create_apk(pkgname)
+        packages[pkgname] = content
+        server.files[f"/main/aarch64/{pkgname}-1-r0.apk"] = content
+        index += (f"C:{checksum}\nP:{pkgname}\nV:1-r0\nA:aarch64\n"
+                  "t:1700000000\n\n")
+    server.files["/main/aarch64/c-1-r0.apk"] = b"broken"
+    cache = f"{tmpdir}/cache_apk_aarch64"
+    os.makedirs(cache)
+    path_index = f"{cache}/APKINDEX.{pmb.helpers.repo.hash(repo)}.tar.gz"
+    with open(path_index, "w") as handle:
+        handle.write(index)
+    blocks = pmb.parse.apkindex.parse(path_index, False)
+    monkeypatch.setattr(pmb.parse.apkindex, "package",
+                        lambda args, pkgname, arch, must_exist:
+                        blocks.get(pkgname))
+    installed = {"a": blocks["a"]}
+
+    # The download statistics get written once, after all downloads
+    written = []
+    write_stats = pmb.helpers.http.write_stats
+    monkeypatch.setattr(pmb.helpers.http, "write_stats", lambda args:
+                        written.append(True) or write_stats(args))
+
+    try:
+        downloads = pmb.chroot.apk_fetch.get_downloads(
+            args, ["a", "b", "c", "not-in-repo"], "aarch64", installed)
+        assert [d[0] for d in downloads] == [f"{repo}/aarch64/b-1-r0.apk",
+                                             f"{repo}/aarch64/c-1-r0.apk"]
+
+        pmb.chroot.apk_fetch.download(args, ["a", "b", "c"], "native",
+                                      installed)
+    finally:
+        pmb_test.mirror.stop([server])
+
+    name_b = pmb.chroot.apk_store.get_cache_name(blocks["b"])
+    assert sorted(os.listdir(cache)) == [os.path.basename(path_index),
+                                         name_b]
+    with open(f"{cache}/{name_b}", "rb") as handle:
+        assert handle.read() == packages["b"]
+
+    assert written == [True]
+    assert os.path.exists(f"{tmpdir}/cache_http/stats.json")
+
+    # Nothing to do anymore (c is left to apk)
+    assert pmb.chroot.apk_fetch.get_downloads(
+        args, ["a", "b"], "aarch64", installed) == []
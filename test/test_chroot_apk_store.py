@@ -0,0 +1,97 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import json
+import os
+import subprocess
+
+import pytest
+
+import pmb_test  # noqa
+import pmb.chroot.apk_store
+import pmb.helpers.logging
+import pmb.helpers.other
+import pmb.helpers.run
+import pmb.parse.apkindex
+
+
+def test_parse_size():
+    func = pmb.chroot.apk_store.parse_size
+    assert func("20G") == 20 * 1024 ** 3
+    assert func("1.5m") == 1536 * 1024
+    assert func("1024") == 1024
+    with pytest.raises(ValueError) as e:
+        func("lots")
+    assert "Invalid apk_store_size" in str(e.value)
+
+
+def test_get_cache_name():
+    block = {"pkgname": "hello-world", "version": "1-r6",
+             "checksum": "Q1XaZzCVZ9mvH8djPyEb5aUYhG3r4="}
+    assert pmb.chroot.apk_store.get_cache_name(block) == \
+        "hello-world-1-r6.5da67309.apk"
+
+
+def write(path, size):
+    with open(path, "wb") as handle:
+        handle.write(b"x" * size)
+
+
+def test_apk_store(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    store = f"{tmpdir}/store"
+    args = argparse.Namespace(work=f"{tmpdir}/work1", apk_store=store,
+                              apk_store_size="10K")
+    monkeypatch.setattr(pmb.helpers.run, "root",
+                        lambda args, cmd: subprocess.run(cmd, check=True))
+    monkeypatch.setattr(pmb.helpers.run, "user",
+                        lambda args, cmd: subprocess.run(cmd, check=True))
+
+    # First work dir downloaded two packages
+    cache1 = f"{args.work}/cache_apk_aarch64"
+    os.makedirs(cache1)
+    write(f"{cache1}/APKINDEX.12345678.tar.gz", 100)
+    write(f"{cache1}/a-1-r0.00000001.apk", 4096)
+    write(f"{cache1}/b-1-r0.00000002.apk", 4096)
+    pmb.chroot.apk_store.add_from_cache(args, "aarch64")
+    assert sorted(os.listdir(f"{store}/aarch64")) == [
+        "a-1-r0.00000001.apk", "b-1-r0.00000002.apk"]
+    assert os.stat(f"{store}/aarch64/a-1-r0.00000001.apk").st_nlink == 2
+
+    # Second work dir installs a, b and c: a and b get linked from the store
+    blocks = {}
+    for pkgname, checksum in [("a", "Q1AAAAAQ=="), ("b", "Q1AAAAAg=="),
+                              ("c", "Q1AAAAAw==")]:
+        blocks[pkgname] = {"pkgname": pkgname, "version": "1-r0",
+                           "checksum": checksum}
+    monkeypatch.setattr(pmb.parse.apkindex, "package",
+                        lambda args, pkgname, arch, must_exist:
+                        blocks[pkgname])
+    args.work = f"{tmpdir}/work2"
+    cache2 = f"{args.work}/cache_apk_aarch64"
+    pmb.chroot.apk_store.link_to_cache(args, "aarch64", ["a", "b", "c"])
+    assert sorted(os.listdir(cache2)) == ["a-1-r0.00000001.apk",
+                                          "b-1-r0.00000002.apk"]
+    assert os.stat(f"{cache2}/a-1-r0.00000001.apk").st_nlink == 3
+
+    # Next pmbootstrap run downloads c: the store is too big now, b is the
+    # least recently used package
+    pmb.helpers.other.init_cache()
+    with open(f"{store}/last_used.json", "w") as handle:
+        json.dump({"aarch64/a-1-r0.00000001.apk": 2,
+                   "aarch64/b-1-r0.00000002.apk": 1}, handle)
+    write(f"{cache2}/c-1-r0.00000003.apk", 4096)
+    pmb.chroot.apk_store.add_from_cache(args, "aarch64")
+    assert sorted(os.listdir(f"{store}/aarch64")) == [
+        "a-1-r0.00000001.apk", "c-1-r0.00000003.apk"]
+    assert "aarch64/b-1-r0.00000002.apk" not in \
+        pmb.chroot.apk_store.update_last_used(store)
+
+    # The store only gets cleaned up once per run (b gets added again, as it
+    # is still in the cache of the second work dir)
+    write(f"{cache2}/d-1-r0.00000004.apk", 4096)
+    pmb.chroot.apk_store.add_from_cache(args, "aarch64")
+    assert sorted(os.listdir(f"{store}/aarch64")) == [
+        "a-1-r0.00000001.apk", "b-1-r0.00000002.apk", "c-1-r0.00000003.apk",
+        "d-1-r0.00000004.apk"]
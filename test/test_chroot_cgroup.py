@@ -0,0 +1,31 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import pmb_test  # noqa
+import pmb.chroot.cgroup
+
+
+def test_read_stats(tmpdir):
+    func = pmb.chroot.cgroup.read_stats
+    assert func(str(tmpdir)) == {}
+
+    with open(f"{tmpdir}/cpu.stat", "w") as handle:
+        handle.write("usage_usec 3500000\nuser_usec 3000000\n"
+                     "system_usec 500000\nnr_periods 0\n"
+                     "throttled_usec 0\n")
+    with open(f"{tmpdir}/memory.peak", "w") as handle:
+        handle.write("104857600\n")
+    with open(f"{tmpdir}/io.stat", "w") as handle:
+        handle.write("8:0 rbytes=1048576 wbytes=2097152 rios=1 wios=2\n"
+                     "8:16 rbytes=1048576 wbytes=0 rios=1 wios=0\n")
+
+    stats = func(str(tmpdir))
+    assert stats == {"usage_usec": 3500000,
+                     "user_usec": 3000000,
+                     "system_usec": 500000,
+                     "throttled_usec": 0,
+                     "memory_peak": 104857600,
+                     "rbytes": 2097152,
+                     "wbytes": 2097152}
+    assert pmb.chroot.cgroup.format_stats(stats) == (
+        "CPU: 3.5s (user: 3.0s, system: 0.5s, throttled: 0.0s), memory"
+        " peak: 100 MiB, I/O: 2 MiB read, 2 MiB written")
@@ -0,0 +1,172 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import os
+import subprocess
+import sys
+
+import pmb_test  # noqa
+import pmb_test.repo
+import pmb.build.other
+import pmb.chroot.apk
+import pmb.chroot.zap
+import pmb.config
+import pmb.config.pmaports
+import pmb.helpers.logging
+import pmb.helpers.manifest
+import pmb.helpers.mirror
+import pmb.helpers.other
+import pmb.helpers.run
+import pmb.parse.apkindex
+
+
+def test_zap_pkgs_gc(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    arch = pmb.config.arch_native
+    args = argparse.Namespace(work=str(tmpdir), device="qemu-amd64",
+                              kernel="virt", ui="none",
+                              extra_packages="hello-world",
+                              deviceinfo={"arch": arch})
+    path = f"{tmpdir}/packages/edge/{arch}"
+    index = f"{path}/APKINDEX.tar.gz"
+    package = pmb.parse.apkindex.package
+    reindexed = []
+    monkeypatch.setattr(pmb.config.pmaports, "read_config",
+                        lambda args: {"channel": "edge"})
+    monkeypatch.setattr(pmb.parse.apkindex, "package",
+                        lambda args, pkgname, arch, must_exist:
+                        package(args, pkgname, arch, must_exist, [index]))
+    monkeypatch.setattr(pmb.helpers.run, "root",
+                        lambda args, cmd: subprocess.run(cmd, check=True))
+    monkeypatch.setattr(pmb.build.other, "index_repo",
+                        lambda args: reindexed.append(True))
+
+    # hello-world is needed by the device, tool by the native chroot
+    pmb_test.repo.write(path, [
+        ("hello-world", "1-r0", "hello-world", b"a"),
+        ("hello-world", "1-r1", "hello-world", b"a"),
+        ("hello-world", "1-r2", "hello-world", b"a", ["dep>=1"]),
+        ("hello-world-doc", "1-r2", "hello-world", b"a"),
+        ("hello-world-doc", "1-r0", "hello-world", b"a"),
+        ("dep", "1-r0", "dep", b"a"),
+        ("tool", "1-r0", "tool", b"a"),
+        ("unused", "1-r0", "unused", b"aa"),
+        ("no-origin", "1-r0", None, b"a")], 1)
+    os.makedirs(f"{tmpdir}/chroot_native/etc/apk")
+    with open(f"{tmpdir}/chroot_native/etc/apk/world", "w") as handle:
+        handle.write("tool\n")
+
+    # pmb.chroot.zap is shadowed by the zap() function
+    func = sys.modules["pmb.chroot.zap"].zap_pkgs_gc
+    assert func(args, False, True) == 5
+    assert len(os.listdir(path)) == 10
+    assert not reindexed
+
+    assert func(args, False, False, 2) == 5
+    assert sorted(os.listdir(path)) == ["APKINDEX.tar.gz", "dep-1-r0.apk",
+                                        "hello-world-1-r1.apk",
+                                        "hello-world-1-r2.apk",
+                                        "hello-world-doc-1-r2.apk",
+                                        "tool-1-r0.apk"]
+    assert reindexed == [True]
+
+
+def test_zap_pkgs_gc_referenced_kernel(monkeypatch, tmpdir):
+    """ The kernel subpackage is only a root if a kernel is selected """
+    args = argparse.Namespace(work=str(tmpdir), device="qemu-amd64",
+                              kernel=None, ui="none", extra_packages="none",
+                              deviceinfo={"arch": "x86_64"})
+    looked_up = []
+    monkeypatch.setattr(pmb.parse.apkindex, "package",
+                        lambda args, pkgname, arch, must_exist:
+                        looked_up.append(pkgname))
+
+    func = sys.modules["pmb.chroot.zap"].zap_pkgs_gc_referenced
+    assert func(args) == set()
+    assert "device-qemu-amd64" in looked_up
+    assert not [pkgname for pkgname in looked_up if "-kernel-" in pkgname]
+
+    looked_up.clear()
+    args.kernel = "virt"
+    func(args)
+    assert "device-qemu-amd64-kernel-virt" in looked_up
+
+
+def test_zap_pkgs_local_mismatch(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    args = argparse.Namespace(work=f"{tmpdir}/work", aports=f"{tmpdir}/pma")
+    path = f"{args.work}/packages/edge/x86_64"
+    reindexed = []
+    monkeypatch.setattr(pmb.config.pmaports, "read_config",
+                        lambda args: {"channel": "edge"})
+    monkeypatch.setattr(pmb.helpers.run, "root",
+                        lambda args, cmd: subprocess.run(cmd, check=True))
+    monkeypatch.setattr(pmb.build.other, "index_repo",
+                        lambda args: reindexed.append(True))
+
+    for pkgname in ["hello-world", "changed", "old"]:
+        aport = f"{args.aports}/main/{pkgname}"
+        os.makedirs(aport)
+        with open(f"{aport}/APKBUILD", "w") as handle:
+            handle.write(f"pkgname={pkgname}\npkgver=1\npkgrel=1\n")
+    pmb_test.repo.write(path, [
+        ("hello-world", "1-r1", "hello-world", b"a"),
+        ("changed", "1-r1", "changed", b"a"),
+        ("old", "1-r0", "old", b"a"),
+        ("missing", "1-r0", "missing", b"a")], 1)
+    for pkgname in ["hello-world", "changed"]:
+        aport_hash = pmb.helpers.manifest.get_aport_hash(
+            f"{args.aports}/main/{pkgname}")
+        pmb.helpers.manifest.set_aport_hash(args, "x86_64", pkgname, "1-r1",
+                                            aport_hash)
+    with open(f"{args.aports}/main/changed/APKBUILD", "a") as handle:
+        handle.write("depends=foo\n")
+
+    # pmb.chroot.zap is shadowed by the zap() function
+    func = sys.modules["pmb.chroot.zap"].zap_pkgs_local_mismatch
+    func(args, False, True)
+    assert len(os.listdir(path)) == 5
+    assert not reindexed
+
+    func(args, False)
+    assert sorted(os.listdir(path)) == ["APKINDEX.tar.gz",
+                                        "hello-world-1-r1.apk"]
+    assert reindexed == [True]
+
+
+def test_zap_pkgs_online_mismatch_mirror_auto(monkeypatch, tmpdir):
+    """ zap -o with "auto" mirrors writes the selected mirrors into the
+        chroot's /etc/apk/repositories """
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    args = argparse.Namespace(work=str(tmpdir), apk_store="", offline=False,
+                              mirror_alpine="auto",
+                              mirrors_postmarketos=["auto"])
+    os.makedirs(f"{tmpdir}/cache_apk_{pmb.config.arch_native}")
+    monkeypatch.setattr(pmb.helpers.run, "root",
+                        lambda args, cmd: subprocess.run(cmd, check=True))
+    monkeypatch.setattr(pmb.config.pmaports, "read_config_channel",
+                        lambda args: {"branch_pmaports": "master",
+                                      "mirrordir_alpine": "edge"})
+    monkeypatch.setattr(pmb.helpers.mirror, "get_ranking",
+                        lambda args, kind: [{"url": f"http://{kind}/"}])
+
+    # Initializing the chroot updates the repository list
+    commands = []
+    monkeypatch.setattr(pmb.chroot, "root",
+                        lambda args, cmd, suffix: commands.append(cmd) or
+                        pmb.chroot.apk.update_repository_list(args, suffix))
+
+    # pmb.chroot.zap is shadowed by the zap() function
+    func = sys.modules["pmb.chroot.zap"].zap_pkgs_online_mismatch
+    func(args, False)
+    assert commands == [["apk", "-v", "cache", "clean"]]
+    with open(f"{tmpdir}/chroot_native/etc/apk/repositories") as handle:
+        assert handle.read().split() == [
+            "/mnt/pmbootstrap/packages",
+            "http://postmarketos/master",
+            "http://alpine/edge/main",
+            "http://alpine/edge/community",
+            "http://alpine/edge/testing"]
@@ -0,0 +1,124 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import io
+import os
+import pytest
+import struct
+import subprocess
+import sys
+
+import pmb_test  # noqa
+import pmb.export.compress
+from pmb.export.compress import get_extents, open_fifo, stream_image
+from pmb.export.compress import sparse_chunk_dont_care, sparse_chunk_raw
+from pmb.export.compress import sparse_magic
+
+
+def create_image(path):
+    """ Sparse file: 1 MiB hole, 5000 bytes data, 2 MiB hole, 4 KiB data at
+        the end. """
+    with open(path, "wb") as handle:
+        handle.truncate(4 * 1024 * 1024)
+        handle.seek(1024 * 1024)
+        handle.write(b"a" * 5000)
+        handle.seek(4 * 1024 * 1024 - 4096)
+        handle.write(b"b" * 4096)
+    with open(path, "rb") as handle:
+        return handle.read()
+
+
+def unsparse(data):
+    """ Convert an Android sparse image back to a raw image. """
+    (magic, _, _, hdr_size, chunk_hdr_size, blk_size, blocks,
+     chunks, _) = struct.unpack("<IHHHHIIII", data[:28])
+    assert magic == sparse_magic
+    ret = b""
+    offset = hdr_size
+    for _ in range(chunks):
+        chunk_type, _, chunk_blocks, total = struct.unpack(
+            "<HHII", data[offset:offset + chunk_hdr_size])
+        if chunk_type == sparse_chunk_raw:
+            ret += data[offset + chunk_hdr_size:offset + total]
+        else:
+            assert chunk_type == sparse_chunk_dont_care
+            ret += bytes(chunk_blocks * blk_size)
+        offset += total
+    assert offset == len(data)
+    assert len(ret) == blocks * blk_size
+    return ret
+
+
+def test_get_extents(tmpdir):
+    path = f"{tmpdir}/test.img"
+    create_image(path)
+
+    with open(path, "rb") as handle:
+        extents = get_extents(handle, 4 * 1024 * 1024)
+
+    # Filesystems may allocate more than was written, but all data must be in
+    # data extents and the extents must cover the whole file without gaps
+    assert extents[0][0] == 0
+    assert extents[-1][1] == 4 * 1024 * 1024
+    for i in range(1, len(extents)):
+        assert extents[i - 1][1] == extents[i][0]
+    for offset in [1024 * 1024, 1024 * 1024 + 4999, 4 * 1024 * 1024 - 1]:
+        assert [e for e in extents if e[0] <= offset < e[1]][0][2]
+
+
+def test_stream_image(tmpdir):
+    path = f"{tmpdir}/test.img"
+    content = create_image(path)
+
+    outputs = {"compress": io.BytesIO(),
+               "sparse": io.BytesIO(),
+               "bmap": io.StringIO()}
+    size_data = stream_image(path, outputs)
+    assert size_data >= 5000 + 4096
+
+    # Compressor input and unpacked sparse image are the original image
+    assert outputs["compress"].getvalue() == content
+    assert unsparse(outputs["sparse"].getvalue()) == content
+
+    # Block map checksum and ranges
+    bmap = outputs["bmap"].getvalue()
+    assert "<ImageSize> 4194304 </ImageSize>" in bmap
+    assert "<BlocksCount> 1024 </BlocksCount>" in bmap
+    checksum = bmap.split("<BmapFileChecksum> ")[1].split(" ")[0]
+    bmap_zeroed = bmap.replace(checksum, "0" * 64)
+    assert hashlib.sha256(bmap_zeroed.encode()).hexdigest() == checksum
+    last = hashlib.sha256(b"b" * 4096).hexdigest()
+    assert f'<Range chksum="{last}"> 1023 </Range>' in bmap or \
+        '-1023 </Range>' in bmap
+
+
+def test_stream_image_split_chunks(monkeypatch, tmpdir):
+    path = f"{tmpdir}/test.img"
+    content = create_image(path)
+
+    # Regions bigger than the maximum chunk size get split
+    module = sys.modules["pmb.export.compress"]
+    monkeypatch.setattr(module, "sparse_chunk_blocks_max", 2)
+    outputs = {"sparse": io.BytesIO()}
+    stream_image(path, outputs)
+    sparse = outputs["sparse"].getvalue()
+    assert struct.unpack("<I", sparse[20:24])[0] >= 1024 // 2
+    assert unsparse(sparse) == content
+
+
+def test_open_fifo(tmpdir):
+    path = f"{tmpdir}/fifo"
+    os.mkfifo(path)
+
+    # Reader exits without opening the fifo
+    process = subprocess.Popen(["true"])
+    with pytest.raises(RuntimeError) as e:
+        open_fifo(path, process)
+    assert "exited with 0" in str(e.value)
+
+    # Reader opens the fifo
+    process = subprocess.Popen(["sh", "-c", f"cat < {path}"],
+                               stdout=subprocess.PIPE)
+    with open_fifo(path, process) as handle:
+        handle.write(b"test")
+    assert process.communicate()[0] == b"test"
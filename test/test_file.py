@@ -6,6 +6,7 @@ import time
 import pytest
 
 import pmb_test  # noqa
+import pmb.helpers.file
 import pmb.helpers.git
 import pmb.helpers.logging
 import pmb.parse.version
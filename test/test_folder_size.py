@@ -1,5 +1,6 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import os
 import sys
 import pytest
 
@@ -7,6 +8,7 @@ import pmb_test  # noqa
 import pmb.helpers.logging
 import pmb.helpers.other
 import pmb.helpers.run
+import pmb.parse.apkindex
 
 
 @pytest.fixture
@@ -19,6 +21,10 @@ def args(request):
     return args
 
 
+def size_ok(result, size, tolerance):
+    return result < size + tolerance and result > size - tolerance
+
+
 def test_get_folder_size(args, tmpdir):
     # Write five 200 KB files to tmpdir
     tmpdir = str(tmpdir)
@@ -34,4 +40,69 @@ def test_get_folder_size(args, tmpdir):
     tolerance = 30
     size = 200 * files
     result = pmb.helpers.other.folder_size(args, tmpdir)
-    assert (result < size + tolerance and result > size - tolerance)
+    assert size_ok(result, size, tolerance)
+
+
+def test_folder_size_scandir(tmpdir):
+    pmb.helpers.other.init_cache()
+    tmpdir = str(tmpdir)
+    func = pmb.helpers.other.folder_size_scandir
+    os.makedirs(f"{tmpdir}/sub/dir")
+    for path in ["a", "sub/b", "sub/dir/c"]:
+        with open(f"{tmpdir}/{path}", "wb") as handle:
+            handle.write(os.urandom(200 * 1024))
+    # Hardlinks are counted once
+    os.link(f"{tmpdir}/a", f"{tmpdir}/sub/dir/a")
+
+    tolerance = 30
+    result = func(tmpdir)
+    assert size_ok(result, 600, tolerance)
+    assert size_ok(func(f"{tmpdir}/sub"), 600, tolerance)
+
+    # Cached folder sizes get updated when files are added or removed
+    os.unlink(f"{tmpdir}/sub/b")
+    assert size_ok(func(tmpdir), 400, tolerance)
+    with open(f"{tmpdir}/sub/dir/d", "wb") as handle:
+        handle.write(os.urandom(100 * 1024))
+    assert size_ok(func(tmpdir), 500, tolerance)
+    assert func(tmpdir) == func(tmpdir, False)
+
+
+def test_folder_size_scandir_hardlinks_unreadable(monkeypatch, tmpdir):
+    pmb.helpers.other.init_cache()
+    tmpdir = str(tmpdir)
+    func = pmb.helpers.other.folder_size_scandir
+    for folder in ["etc", "var/secret"]:
+        os.makedirs(f"{tmpdir}/{folder}")
+    with open(f"{tmpdir}/etc/a", "wb") as handle:
+        handle.write(os.urandom(200 * 1024))
+    os.link(f"{tmpdir}/etc/a", f"{tmpdir}/var/a")
+
+    # Hardlinks between folders are counted once with the same set
+    scandir = os.scandir
+
+    def scandir_unreadable(path):
+        if path.endswith("/secret"):
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+    monkeypatch.setattr(os, "scandir", scandir_unreadable)
+    hardlinks_seen = set()
+    assert size_ok(func(f"{tmpdir}/etc", False,
+                        hardlinks_seen=hardlinks_seen), 200, 30)
+    assert func(f"{tmpdir}/var", False, hardlinks_seen=hardlinks_seen) < 30
+
+    # Unreadable folders get measured as root with args
+    monkeypatch.setattr(pmb.helpers.other, "folder_size",
+                        lambda args, path: 1000 if path.endswith("/secret")
+                        else None)
+    assert func(f"{tmpdir}/var", False, "args") > 1000
+
+
+def test_installed_size(tmpdir):
+    path = f"{tmpdir}/installed"
+    with open(path, "w") as handle:
+        handle.write("C:Q1a=\nP:hello\nV:1-r0\nI:4096\nF:usr/bin\nR:hello\n"
+                     "\n"
+                     "C:Q1b=\nP:world\nV:1-r0\nI:1000\nF:usr/bin\nR:world\n"
+                     "R:world2\n\n")
+    assert pmb.parse.apkindex.installed_size(path) == (5096, 3)
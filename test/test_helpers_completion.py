@@ -0,0 +1,117 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import os
+import sys
+
+import pmb_test  # noqa
+import pmb.helpers.completion
+import pmb.helpers.git
+import pmb.helpers.other
+import pmb.helpers.pmaports
+from pmb.parse.arguments import kernel_completer
+
+
+def create_aports(path, head="a" * 40):
+    """ Create a fake pmaports.git with a few APKBUILDs """
+    for folder in ["main/hello-world", "main/postmarketos-ui-phosh",
+                   "device/main/device-qemu-amd64",
+                   "device/testing/linux-postmarketos-qcom-sdm845",
+                   "device/testing/device-oneplus-enchilada",
+                   "cross/gcc-armhf"]:
+        os.makedirs(f"{path}/{folder}")
+        open(f"{path}/{folder}/APKBUILD", "w").close()
+    set_head(path, head)
+
+
+def set_head(path, head):
+    os.makedirs(f"{path}/.git/refs/heads", exist_ok=True)
+    with open(f"{path}/.git/HEAD", "w") as handle:
+        handle.write("ref: refs/heads/master\n")
+    with open(f"{path}/.git/refs/heads/master", "w") as handle:
+        handle.write(f"{head}\n")
+
+
+def test_get_head(tmpdir):
+    func = pmb.helpers.git.get_head
+    path = str(tmpdir)
+    assert func(path) is None
+
+    # Loose ref
+    set_head(path, "a" * 40)
+    assert func(path) == "a" * 40
+
+    # Packed ref
+    os.unlink(f"{path}/.git/refs/heads/master")
+    assert func(path) is None
+    with open(f"{path}/.git/packed-refs", "w") as handle:
+        handle.write("# pack-refs with: peeled fully-peeled sorted\n"
+                     f"{'b' * 40} refs/heads/master\n"
+                     f"{'c' * 40} refs/heads/v23.06\n")
+    assert func(path) == "b" * 40
+
+    # Detached HEAD
+    with open(f"{path}/.git/HEAD", "w") as handle:
+        handle.write(f"{'d' * 40}\n")
+    assert func(path) == "d" * 40
+
+
+def test_completion_cache(tmpdir):
+    args = argparse.Namespace(aports=f"{tmpdir}/pmaports",
+                              work=f"{tmpdir}/work")
+    create_aports(args.aports)
+    os.makedirs(args.work)
+    pmb.helpers.other.init_cache()
+    path = pmb.helpers.completion.get_path(args)
+
+    # Scanning pmaports writes the cache
+    assert pmb.helpers.completion.read(args) is None
+    pmb.helpers.pmaports.get_list(args)
+    cache = pmb.helpers.completion.read(args)
+    assert cache["head"] == "a" * 40
+    assert cache["packages"] == ["device-oneplus-enchilada",
+                                 "device-qemu-amd64", "gcc-armhf",
+                                 "hello-world",
+                                 "linux-postmarketos-qcom-sdm845",
+                                 "postmarketos-ui-phosh"]
+    assert cache["devices"] == ["oneplus-enchilada", "qemu-amd64"]
+    assert cache["kernels"] == ["linux-postmarketos-qcom-sdm845"]
+    assert cache["uis"] == ["none", "phosh"]
+
+    # Completers only read the cache, as long as HEAD is the same
+    os.makedirs(f"{args.aports}/main/new-package")
+    open(f"{args.aports}/main/new-package/APKBUILD", "w").close()
+    pmb.helpers.other.init_cache()
+    assert pmb.helpers.completion.get(args, "devices") == [
+        "oneplus-enchilada", "qemu-amd64"]
+    assert "new-package" not in pmb.helpers.completion.get(args, "packages")
+
+    # Outdated after HEAD changed: scan again and update the cache
+    set_head(args.aports, "b" * 40)
+    assert pmb.helpers.completion.read(args) is None
+    assert "new-package" in pmb.helpers.completion.get(args, "packages")
+    assert pmb.helpers.completion.read(args)["head"] == "b" * 40
+
+    # Broken file
+    with open(path, "w") as handle:
+        handle.write("{")
+    assert pmb.helpers.completion.read(args) is None
+
+
+def test_kernel_completer(monkeypatch):
+    kernels = ["linux-postmarketos-allwinner",
+               "linux-postmarketos-qcom-sdm845", "linux-purism-librem5"]
+    # pmb.parse.arguments is shadowed by the function of the same name
+    monkeypatch.setattr(sys.modules["pmb.parse.arguments"],
+                        "init_completer_args",
+                        lambda parsed_args: parsed_args)
+    monkeypatch.setattr(pmb.helpers.completion, "get",
+                        lambda args, key: kernels if key == "kernels" else [])
+    func = kernel_completer
+
+    assert func("postmarketos-a", None) == ["postmarketos-allwinner"]
+    assert func("linux-pu", None) == ["linux-purism-librem5"]
+    assert func("", None) == [
+        "linux-postmarketos-allwinner", "postmarketos-allwinner",
+        "linux-postmarketos-qcom-sdm845", "postmarketos-qcom-sdm845",
+        "linux-purism-librem5", "purism-librem5"]
@@ -0,0 +1,115 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import os
+import urllib.error
+
+import pytest
+
+import pmb_test  # noqa
+import pmb_test.mirror
+import pmb.config
+import pmb.helpers.http
+import pmb.helpers.logging
+import pmb.helpers.other
+
+
+@pytest.fixture
+def mirrors(monkeypatch):
+    """ Start two local mirrors and make retries instant.
+
+        :returns: list of servers """
+    monkeypatch.setattr(pmb.config, "http_retry_delay", 0)
+    monkeypatch.setattr(pmb.config, "mirrors_alpine_fallback", [])
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+
+    servers = pmb_test.mirror.start(2)
+    yield servers
+    pmb_test.mirror.stop(servers)
+
+
+def get_args(tmpdir, mirrors):
+    os.makedirs(f"{tmpdir}/cache_http", exist_ok=True)
+    return argparse.Namespace(work=str(tmpdir), offline=False,
+                              mirrors_postmarketos=[m.url for m in mirrors],
+                              mirror_alpine="http://alpine.invalid/")
+
+
+def test_get_mirror_urls(tmpdir, mirrors):
+    args = get_args(tmpdir, mirrors)
+    func = pmb.helpers.http.get_mirror_urls
+    pmos = [m.url for m in mirrors]
+    assert func(args, f"{pmos[1]}master/x86_64/APKINDEX.tar.gz") == [
+        f"{pmos[1]}master/x86_64/APKINDEX.tar.gz",
+        f"{pmos[0]}master/x86_64/APKINDEX.tar.gz"]
+    assert func(args, "https://postmarketos.org/mirrors.json") == [
+        "https://postmarketos.org/mirrors.json"]
+
+    args.mirror_alpine = "http://localmirror/alpine/"
+    pmb.config.mirrors_alpine_fallback = ["http://dl-cdn.alpinelinux.org/"
+                                          "alpine/"]
+    assert func(args, "http://localmirror/alpine/edge/main/x86_64/a.apk") == [
+        "http://localmirror/alpine/edge/main/x86_64/a.apk",
+        "http://dl-cdn.alpinelinux.org/alpine/edge/main/x86_64/a.apk"]
+
+
+def test_download_retry_resume(tmpdir, mirrors):
+    args = get_args(tmpdir, mirrors)
+    data = os.urandom(300000)
+    server = mirrors[0]
+    server.files["/file"] = data
+
+    # Temporary error, then the connection breaks halfway: the download gets
+    # resumed instead of starting over
+    server.errors = 1
+    server.truncate = True
+    path = pmb.helpers.http.download(args, f"{server.url}file", "test")
+    with open(path, "rb") as handle:
+        assert handle.read() == data
+    assert [r[1] for r in server.requests] == [
+        None, None, f"bytes={len(data) // 2}-"]
+    assert not [f for f in os.listdir(f"{tmpdir}/cache_http")
+                if f.endswith(".part")]
+
+    # Cached
+    assert pmb.helpers.http.download(args, f"{server.url}file",
+                                     "test") == path
+    assert len(server.requests) == 3
+
+    # Statistics for the mirror selection
+    host = server.url.split("/")[2]
+    stats = pmb.helpers.http.get_stats(args)[host]
+    assert stats["downloads"] == 1
+    assert stats["failures"] == 2
+    assert stats["throughput"] > 0
+    pmb.helpers.other.init_cache()
+    assert pmb.helpers.http.get_stats(args)[host]["downloads"] == 1
+
+
+def test_download_failover(tmpdir, mirrors):
+    args = get_args(tmpdir, mirrors)
+    mirrors[0].errors = pmb.config.http_retries + 1
+    mirrors[1].files["/v23.06/file"] = b"hello"
+
+    url = f"{mirrors[0].url}v23.06/file"
+    path = pmb.helpers.http.download(args, url, "test", cache=False)
+    with open(path, "rb") as handle:
+        assert handle.read() == b"hello"
+    assert len(mirrors[0].requests) == pmb.config.http_retries + 1
+    assert mirrors[1].requests == [("/v23.06/file", None)]
+
+
+def test_download_404(tmpdir, mirrors):
+    args = get_args(tmpdir, mirrors)
+    url = f"{mirrors[0].url}missing"
+    assert pmb.helpers.http.download(args, url, "test",
+                                     allow_404=True) is None
+    with pytest.raises(urllib.error.HTTPError):
+        pmb.helpers.http.download(args, url, "test")
+
+    # Other errors are not hidden by a 404 on another mirror
+    mirrors[1].errors = pmb.config.http_retries + 1
+    with pytest.raises(urllib.error.HTTPError) as e:
+        pmb.helpers.http.download(args, url, "test", allow_404=True)
+    assert e.value.code == 503
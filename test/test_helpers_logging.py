@@ -0,0 +1,54 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import json
+import logging
+import os
+
+import pmb_test  # noqa
+import pmb.helpers.logging
+import pmb.helpers.run_core
+
+
+def test_log_json(tmpdir):
+    args = argparse.Namespace(details_to_stdout=False, quiet=True,
+                              verbose=True, log=f"{tmpdir}/log.txt",
+                              log_json=True, action="build", timeout=30,
+                              sudo_timer=False)
+    pmb.helpers.logging.init(args)
+    logging.verbose("lookup")
+    pmb.helpers.run_core.core(args, "(native) % echo test", ["echo", "test"])
+    pmb.helpers.logging.flush()
+    pmb.helpers.logging.logfd.close()
+
+    # Text log: command output comes after the command line
+    with open(f"{tmpdir}/log.txt") as handle:
+        lines = [line.split("] ", 1)[-1] for line in handle.readlines()]
+    assert lines == ["lookup\n",
+                     "(native) % echo test\n",
+                     "run: ['echo', 'test']\n",
+                     "test\n"]
+
+    with open(f"{tmpdir}/log.jsonl") as handle:
+        records = [json.loads(line) for line in handle]
+    assert [r["msg"] for r in records] == [
+        "lookup",
+        "(native) % echo test",
+        "run: ['echo', 'test']",
+        "(native) % echo test: exit code 0"]
+    assert records[0]["level"] == "VERBOSE"
+    assert records[1]["suffix"] == "native"
+    assert records[1]["command"] == "echo test"
+    assert records[3]["exit_code"] == 0
+    assert records[3]["duration"] >= 0
+
+    # The record after the command has the pid of the command
+    assert records[1]["pid"] == os.getpid()
+    assert records[3]["pid"] != os.getpid()
+
+
+def test_get_log_json_fields():
+    func = pmb.helpers.run_core.get_log_json_fields
+    assert func("(native) % cd /home; echo test") == {
+        "suffix": "native", "command": "cd /home; echo test"}
+    assert func("% echo test") == {"suffix": None, "command": "echo test"}
@@ -0,0 +1,84 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import os
+
+import pmb_test  # noqa
+import pmb_test.repo
+import pmb.config.pmaports
+import pmb.helpers.logging
+import pmb.helpers.manifest
+import pmb.helpers.other
+
+
+def test_manifest(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    args = argparse.Namespace(work=str(tmpdir))
+    monkeypatch.setattr(pmb.config.pmaports, "read_config",
+                        lambda args: {"channel": "edge"})
+    func = pmb.helpers.manifest.packages
+    path = f"{tmpdir}/packages/edge/x86_64"
+    assert func(args) == []
+
+    hashed = []
+    get_sha256 = pmb.helpers.manifest.get_sha256
+    monkeypatch.setattr(pmb.helpers.manifest, "get_sha256",
+                        lambda path: hashed.append(path) or get_sha256(path))
+
+    # New packages get hashed
+    pmb_test.repo.write(path, [
+        ("hello-world", "1-r0", "hello-world", b"a"),
+        ("hello-world-doc", "1-r0", "hello-world", b"b")], 1)
+    pmb.helpers.manifest.clear_cache()
+    ret = func(args)
+    assert [(row["arch"], row["pkgname"], row["version"], row["size"])
+            for row in ret] == [("x86_64", "hello-world", "1-r0", 1),
+                                ("x86_64", "hello-world-doc", "1-r0", 1)]
+    assert ret[0]["sha256"] == get_sha256(f"{path}/hello-world-1-r0.apk")
+    assert ret[0]["build_time"] == 1700000000
+    assert len(hashed) == 2
+
+    # Cached until the next build or index_repo()
+    synced = []
+    sync = pmb.helpers.manifest.sync
+    monkeypatch.setattr(pmb.helpers.manifest, "sync",
+                        lambda args, arch: synced.append(arch) or
+                        sync(args, arch))
+    assert func(args) is ret
+    assert synced == []
+    pmb.helpers.manifest.clear_cache()
+    assert func(args) == ret
+    assert synced == [None]
+
+    # Remember the aport
+    aport = f"{tmpdir}/aport"
+    os.makedirs(aport)
+    with open(f"{aport}/APKBUILD", "w") as handle:
+        handle.write("pkgname=hello-world\n")
+    aport_hash = pmb.helpers.manifest.get_aport_hash(aport)
+    pmb.helpers.manifest.set_aport_hash(args, "x86_64", "hello-world",
+                                        "1-r0", aport_hash)
+    assert [row["aport_hash"] for row in func(args, "x86_64")] == \
+        [aport_hash, aport_hash]
+
+    # Unchanged APKINDEX: nothing gets hashed again
+    assert len(hashed) == 2
+
+    # Rebuilt package: only the new package gets hashed, removed packages and
+    # packages missing on disk get dropped
+    os.remove(f"{path}/hello-world-1-r0.apk")
+    pmb_test.repo.write(path, [
+        ("hello-world", "1-r1", "hello-world", b"c"),
+        ("hello-world-doc", "1-r0", "hello-world", b"b")], 2)
+    os.remove(f"{path}/hello-world-doc-1-r0.apk")
+    pmb.helpers.manifest.clear_cache()
+    ret = func(args, "x86_64")
+    assert [(row["pkgname"], row["version"], row["aport_hash"])
+            for row in ret] == [("hello-world", "1-r1", None)]
+    assert hashed[2:] == [f"{path}/hello-world-1-r1.apk"]
+
+    # Changing the aport changes its hash
+    with open(f"{aport}/APKBUILD", "a") as handle:
+        handle.write("pkgrel=1\n")
+    assert pmb.helpers.manifest.get_aport_hash(aport) != aport_hash
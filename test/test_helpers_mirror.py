@@ -0,0 +1,82 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import json
+import os
+import subprocess
+
+import pmb_test  # noqa
+import pmb_test.mirror
+import pmb.config
+import pmb.config.pmaports
+import pmb.helpers.logging
+import pmb.helpers.mirror
+import pmb.helpers.other
+import pmb.helpers.run
+
+
+def test_get_url():
+    func = pmb.helpers.mirror.get_url
+    assert func(["rsync://a/", "https://a/", "http://a/"]) == "http://a/"
+    assert func(["https://a/"]) == "https://a/"
+    assert func(["rsync://a/"]) is None
+
+
+def test_get_ranking_resolve(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    os.makedirs(f"{tmpdir}/cache_http")
+    args = argparse.Namespace(work=str(tmpdir), offline=False,
+                              mirrors_postmarketos=["auto"],
+                              mirror_alpine="http://alpine.invalid/")
+    arch = pmb.config.arch_native
+    monkeypatch.setattr(pmb.helpers.run, "user",
+                        lambda args, cmd: subprocess.run(cmd, check=True))
+    monkeypatch.setattr(pmb.config.pmaports, "read_config_channel",
+                        lambda args: {"branch_pmaports": "master",
+                                      "mirrordir_alpine": "edge"})
+
+    # Mirror list on the first server, the default mirror is down, the
+    # second mirror is slow
+    servers = pmb_test.mirror.start(3)
+    mirrors = {"slow": {"location": "A", "urls": [servers[1].url]},
+               "fast": {"location": "B", "urls": [servers[2].url]},
+               "rsync": {"location": "C", "urls": ["rsync://c/"]}}
+    servers[0].files["/mirrors.json"] = json.dumps(mirrors).encode()
+    servers[1].delay = 0.3
+    for server in servers[1:]:
+        server.files[f"/master/{arch}/APKINDEX.tar.gz"] = b"x" * 100000
+    monkeypatch.setattr(pmb.config, "mirrors_json_postmarketos",
+                        f"{servers[0].url}mirrors.json")
+    monkeypatch.setitem(pmb.config.defaults, "mirrors_postmarketos",
+                        "http://127.0.0.1:1/")
+
+    try:
+        func = pmb.helpers.mirror.get_ranking
+        ranking = func(args, "postmarketos")
+        assert [r["url"] for r in ranking] == [servers[2].url, servers[1].url]
+        size = pmb.config.mirror_probe_size
+        assert servers[2].requests == [(f"/master/{arch}/APKINDEX.tar.gz",
+                                        f"bytes=0-{size - 1}")]
+
+        # Cached
+        assert func(args, "postmarketos") == ranking
+        assert len(servers[2].requests) == 1
+
+        # Probe again
+        func(args, "postmarketos", True)
+        assert len(servers[2].requests) == 2
+
+        # Select the fastest mirror
+        pmb.helpers.mirror.resolve(args)
+        assert args.mirrors_postmarketos == [servers[2].url]
+        assert args.mirror_alpine == "http://alpine.invalid/"
+    finally:
+        pmb_test.mirror.stop(servers)
+
+    # Offline and not cached: fall back to the default
+    args.offline = True
+    args.mirror_alpine = "auto"
+    assert func(args, "alpine") == []
+    pmb.helpers.mirror.resolve(args)
+    assert args.mirror_alpine == pmb.config.defaults["mirror_alpine"]
@@ -1,10 +1,24 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import json
+import logging
+import os
 import pytest
 import sys
+import time
 
 import pmb_test  # noqa
 import pmb.build.other
+import pmb.helpers.completion
+import pmb.helpers.logging
+import pmb.helpers.other
+import pmb.helpers.package
+import pmb.helpers.pmaports
+import pmb.helpers.repo
+import pmb.helpers.repo_missing
+import pmb.parse
+import pmb.parse.apkindex
 
 
 @pytest.fixture
@@ -136,3 +150,143 @@ def test_generate_output_format(args, monkeypatch):
             "version": "1.0-r0",
             "depends": ["depend1", "depend2"]}]
     assert func(args, "armhf", ["hello-world"]) == ret
+
+
+def write_apkbuild(path, pkgname, extra=""):
+    os.makedirs(path)
+    with open(f"{path}/APKBUILD", "w") as handle:
+        handle.write(f"pkgname={pkgname}\npkgver=1\npkgrel=0\narch=all\n"
+                     f"{extra}")
+
+
+def test_get_pmaports_index(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    args = argparse.Namespace(work=f"{tmpdir}/work", aports=f"{tmpdir}/pma",
+                              ignore_depends=False)
+    monkeypatch.setattr(pmb.helpers.completion, "update",
+                        lambda args, apkbuilds: None)
+    write_apkbuild(f"{args.aports}/main/hello-world", "hello-world",
+                   'subpackages="$pkgname-doc"\nprovides="hello=1"\n'
+                   'depends="foo-dev"\n')
+    write_apkbuild(f"{args.aports}/main/foo", "foo")
+
+    parsed = []
+    apkbuild = pmb.parse.apkbuild
+    monkeypatch.setattr(pmb.parse, "apkbuild", lambda path:
+                        parsed.append(path) or apkbuild(path))
+
+    func = pmb.helpers.repo_missing.get_pmaports_index
+    ret = func(args)
+    assert list(ret["apkbuilds"]) == ["foo", "hello-world"]
+    assert ret["providers"] == {"hello-world-doc": ["hello-world"],
+                                "hello": ["hello-world"]}
+    assert len(parsed) == 2
+
+    # Aports of the pkgnames are cached, subpackages and dependencies get
+    # looked up when needed
+    cache_find = pmb.helpers.other.cache["find_aport"]
+    assert cache_find["hello-world"] == f"{args.aports}/main/hello-world"
+    assert "hello-world-doc" not in cache_find
+    find = pmb.helpers.pmaports.find
+    assert find(args, "hello-world-doc") == f"{args.aports}/main/hello-world"
+    assert find(args, "foo-dev") == f"{args.aports}/main/foo"
+
+    # The index file has a format version, other versions get ignored
+    with open(f"{args.work}/cache_pmaports/index.json") as handle:
+        index = json.load(handle)
+    assert index["version"] == pmb.helpers.repo_missing.pmaports_index_version
+    assert len(index["files"]) == 2
+
+    # Next session: only the changed APKBUILD gets parsed
+    pmb.helpers.other.init_cache()
+    parsed.clear()
+    with open(f"{args.aports}/main/foo/APKBUILD", "a") as handle:
+        handle.write("pkgdesc=changed\n")
+    assert func(args)["apkbuilds"] == {
+        **ret["apkbuilds"],
+        "foo": apkbuild(f"{args.aports}/main/foo/APKBUILD")}
+    assert parsed == [f"{args.aports}/main/foo/APKBUILD"]
+
+    pmb.helpers.other.init_cache()
+    monkeypatch.setattr(pmb.helpers.repo_missing, "pmaports_index_version",
+                        2)
+    func(args)
+    assert len(parsed) == 3
+
+
+def test_filters_index(monkeypatch):
+    """ Aports in the pmaports index get filtered at once, other packages one
+        by one """
+    pmb.helpers.other.init_cache()
+    pmb.helpers.other.cache["pmb.helpers.repo_missing.pmaports_index"] = {
+        "apkbuilds": {"a": {"pkgver": "1", "pkgrel": "0", "arch": ["all"]},
+                      "b": {"pkgver": "2", "pkgrel": "0",
+                            "arch": ["aarch64"]}}}
+    monkeypatch.setattr(pmb.helpers.repo_missing, "get_binary_versions",
+                        lambda args, arch: {"a": "1-r0", "b": "1-r0"})
+
+    checked = []
+
+    def check_arch(args, pkgname, arch, binary=True):
+        checked.append(pkgname)
+        return True
+    monkeypatch.setattr(pmb.helpers.package, "check_arch", check_arch)
+    func = pmb.helpers.repo_missing.filter_arch_packages
+    assert func(None, "armhf", ["a", "b", "c"]) == ["a", "c"]
+    assert checked == ["c"]
+
+    checked.clear()
+    monkeypatch.setattr(pmb.helpers.pmaports, "get",
+                        lambda args, pkgname, must_exist: checked.append(
+                            pkgname) or {"pkgname": pkgname})
+    monkeypatch.setattr(pmb.build, "is_necessary",
+                        lambda args, arch, apkbuild: True)
+    func = pmb.helpers.repo_missing.filter_missing_packages
+    monkeypatch.setattr(pmb.parse.apkindex, "package",
+                        lambda args, pkgname, arch, must_exist: None)
+    assert func(None, "armhf", ["a", "b", "c"]) == ["b", "c"]
+    assert checked == ["b", "c"]
+    pmb.helpers.other.init_cache()
+
+
+def test_generate_arches(caplog, monkeypatch, tmpdir):
+    func = pmb.helpers.repo_missing.generate_arches
+    monkeypatch.setattr(pmb.helpers.repo_missing, "get_pmaports_index",
+                        lambda args: None)
+    monkeypatch.setattr(pmb.helpers.repo, "update", lambda args, arch: None)
+
+    def generate(args, arch, overview, pkgname, built):
+        logging.info(f"generate {arch}")
+        if arch == "armv7":
+            raise ValueError("failed")
+        if arch == "aarch64":
+            time.sleep(30)
+        return [f"{arch}-{os.getpid()}"]
+    monkeypatch.setattr(pmb.helpers.repo_missing, "generate", generate)
+
+    ret = func(None, ["x86_64", "armhf"], True)
+    assert ret == {"x86_64": [f"x86_64-{os.getpid()}"],
+                   "armhf": [f"armhf-{os.getpid()}"]}
+
+    # One process per arch, log messages get forwarded to the parent
+    caplog.set_level(logging.INFO)
+    caplog.clear()
+    ret = func(None, ["x86_64", "armhf"], True, parallel=True)
+    assert list(ret) == ["x86_64", "armhf"]
+    assert ret["x86_64"] != [f"x86_64-{os.getpid()}"]
+    assert sorted(record.getMessage() for record in caplog.records) == \
+        ["generate armhf", "generate x86_64"]
+    assert {record.process for record in caplog.records} != {os.getpid()}
+
+    # Exception type and traceback of the child process are kept
+    with pytest.raises(ValueError) as e:
+        func(None, ["x86_64", "armv7"], True, parallel=True)
+    assert str(e.value) == "failed"
+    assert str(e.value.__cause__).startswith("armv7:\nTraceback")
+
+    # The other child processes get terminated
+    time_start = time.monotonic()
+    with pytest.raises(ValueError):
+        func(None, ["aarch64", "armv7"], True, parallel=True)
+    assert time.monotonic() - time_start < 10
@@ -0,0 +1,119 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import os
+import shutil
+
+import pytest
+
+import pmb_test  # noqa
+import pmb_test.repo
+import pmb.config.pmaports
+import pmb.helpers.logging
+import pmb.helpers.manifest
+import pmb.helpers.other
+import pmb.helpers.repo_publish
+import pmb.helpers.run
+import pmb.sideload
+
+
+def test_parse_dest():
+    func = pmb.helpers.repo_publish.parse_dest
+    assert func("/srv/repo/") == (None, "/srv/repo")
+    assert func("./a:b") == (None, os.path.abspath("./a:b"))
+    assert func("user@host:/srv/repo/") == ("user@host", "/srv/repo")
+    assert func("host:/") == ("host", "/")
+    with pytest.raises(ValueError) as e:
+        func("host:srv")
+    assert "must be absolute" in str(e.value)
+
+
+def test_publish_local(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    args = argparse.Namespace(work=str(tmpdir))
+    monkeypatch.setattr(pmb.config.pmaports, "read_config",
+                        lambda args: {"channel": "edge"})
+    monkeypatch.setattr(pmb.config.pmaports, "read_config_channel",
+                        lambda args: {"branch_pmaports": "master"})
+    path = f"{tmpdir}/packages/edge/x86_64"
+    dest = f"{tmpdir}/dest"
+    os.makedirs(f"{tmpdir}/config_abuild")
+    with open(f"{tmpdir}/config_abuild/pmos@local-1.rsa.pub", "w") as handle:
+        handle.write("key")
+
+    copied = []
+    copyfile = shutil.copyfile
+    monkeypatch.setattr(shutil, "copyfile", lambda src, dst:
+                        copied.append(os.path.basename(src)) or
+                        copyfile(src, dst))
+
+    # Initial publish: everything gets uploaded
+    func = pmb.helpers.repo_publish.publish
+    pmb_test.repo.write(path, [("hello-world", "1-r0", "hello-world", b"a"),
+                               ("old", "1-r0", "old", b"b")], 1)
+    func(args, dest)
+    assert sorted(os.listdir(dest)) == ["master", "pmos@local-1.rsa.pub"]
+    assert sorted(os.listdir(f"{dest}/master/x86_64")) == \
+        ["APKINDEX.tar.gz", "hello-world-1-r0.apk", "old-1-r0.apk"]
+
+    # Nothing changed
+    copied.clear()
+    func(args, dest)
+    assert copied == ["pmos@local-1.rsa.pub"]
+
+    # Only the changed package gets uploaded, the APKINDEX last, and removed
+    # packages get deleted
+    copied.clear()
+    os.remove(f"{path}/old-1-r0.apk")
+    pmb_test.repo.write(path, [("hello-world", "1-r0", "hello-world", b"a"),
+                               ("new", "1-r0", "new", b"c")], 2)
+    pmb.helpers.manifest.clear_cache()
+    func(args, dest, dry=True)
+    assert copied == []
+    func(args, dest)
+    assert copied == ["pmos@local-1.rsa.pub", "new-1-r0.apk",
+                      "APKINDEX.tar.gz"]
+    assert sorted(os.listdir(f"{dest}/master/x86_64")) == \
+        ["APKINDEX.tar.gz", "hello-world-1-r0.apk", "new-1-r0.apk"]
+    with open(f"{dest}/master/x86_64/APKINDEX.tar.gz", "rb") as handle:
+        with open(f"{path}/APKINDEX.tar.gz", "rb") as handle_local:
+            assert handle.read() == handle_local.read()
+
+
+def test_get_remote_index(monkeypatch, tmpdir):
+    args = argparse.Namespace(work=str(tmpdir))
+    os.makedirs(f"{tmpdir}/ssh")
+    monkeypatch.setattr(pmb.sideload, "ssh_options",
+                        lambda args, master: [])
+    func = pmb.helpers.repo_publish.get_remote_index
+
+    codes = []
+    cmds = []
+
+    def fake_user(args, cmd, output="log", check=None):
+        cmds.append(cmd[0])
+        if cmd[0] == "scp":
+            with open(cmd[-1], "w") as handle:
+                handle.write("index")
+            return 0
+        return codes.pop(0)
+    monkeypatch.setattr(pmb.helpers.run, "user", fake_user)
+
+    # Does not exist yet
+    codes.append(1)
+    assert func(args, "host", "22", "/srv/repo/master/x86_64") is None
+    assert cmds == ["ssh"]
+
+    # Exists
+    cmds.clear()
+    codes.append(0)
+    path = func(args, "host", "22", "/srv/repo/master/x86_64")
+    assert cmds == ["ssh", "scp"]
+    assert os.path.exists(path)
+
+    # ssh fails
+    codes.append(255)
+    with pytest.raises(RuntimeError) as e:
+        func(args, "host", "22", "/srv/repo/master/x86_64")
+    assert "exit code 255" in str(e.value)
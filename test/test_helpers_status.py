@@ -10,6 +10,7 @@ import pmb_test
 import pmb_test.git
 import pmb.config
 import pmb.config.workdir
+import pmb.helpers.status
 
 
 @pytest.fixture
@@ -0,0 +1,61 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Make sure that tab completion and 'pmbootstrap --help' stay fast, by not
+    importing the subsystems (see pmb/__init__.py) """
+import subprocess
+import sys
+
+import pytest
+
+import pmb_test  # noqa
+import pmb.config
+
+# Only imported by the actions that use them
+subsystems = ["pmb.aportgen", "pmb.build", "pmb.chroot", "pmb.ci",
+              "pmb.config.init", "pmb.export", "pmb.flasher",
+              "pmb.helpers.frontend", "pmb.helpers.repo", "pmb.install",
+              "pmb.netboot", "pmb.qemu", "pmb.sideload"]
+
+
+def import_time(statement="import pmb"):
+    """
+    Run a python statement with -X importtime.
+
+    :returns: dict of imported module names and the cumulative import time
+              in microseconds
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             statement], cwd=pmb.config.pmb_src,
+                            stderr=subprocess.PIPE, check=True,
+                            universal_newlines=True).stderr
+    ret = {}
+    for line in stderr.splitlines():
+        # Format: "import time: <self [us]> | <cumulative> | <module>"
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[1].strip().isdigit():
+            continue
+        ret[fields[2].strip()] = int(fields[1])
+    return ret
+
+
+def test_import_pmb_no_subsystems():
+    modules = import_time()
+    assert "pmb" in modules
+    assert "pmb.parse.arguments" in modules
+
+    for module in modules:
+        for subsystem in subsystems:
+            assert module != subsystem and \
+                not module.startswith(f"{subsystem}."), \
+                f"'import pmb' must not import {module}, import it in the" \
+                " function that uses it instead"
+
+
+@pytest.mark.skip_ci
+def test_import_pmb_benchmark():
+    """ Best of 5, to get a reproducible result on busy systems """
+    duration = min(import_time()["pmb"] for _ in range(5))
+    print(f"import pmb: {duration / 1000:.1f} ms")
+    assert duration < 100 * 1000
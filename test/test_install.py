@@ -1,6 +1,8 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
 import pytest
+import subprocess
 import sys
 import os
 import shutil
@@ -11,6 +13,9 @@ import pmb.aportgen.device
 import pmb.config
 import pmb.config.init
 import pmb.helpers.logging
+import pmb.helpers.other
+import pmb.helpers.mount
+import pmb.install
 import pmb.install._install
 
 
@@ -170,3 +175,99 @@ def test_generate_binary_list(args):
                        "boot_part_start": "2"}
     assert func(args, suffix, step) == [('small.bin', 424),
                                         ('binary2.bin', 324)]
+
+
+def test_get_populate_uuids(args):
+    func = pmb.install.get_populate_uuids
+
+    # ext2 boot partition: regular UUIDs for both filesystems
+    args.deviceinfo = {"boot_filesystem": ""}
+    uuids = func(args)
+    assert len(uuids["boot"]) == 36
+    assert len(uuids["root"]) == 36
+    assert uuids["boot"] != uuids["root"]
+
+    # FAT boot partition: volume ID formatted like blkid prints it
+    args.deviceinfo = {"boot_filesystem": "fat32"}
+    uuids = func(args)
+    assert len(uuids["boot"]) == 9
+    assert uuids["boot"][4] == "-"
+    assert uuids["boot"] == uuids["boot"].upper()
+    assert len(uuids["root"]) == 36
+
+
+def test_populate_stage(monkeypatch, tmpdir):
+    args = argparse.Namespace(work=str(tmpdir))
+    native = f"{tmpdir}/chroot_native"
+    source = f"{native}/mnt/rootfs_qemu-amd64"
+    for folder in ["boot", "etc", "home/user", "usr/lib"]:
+        os.makedirs(f"{source}/{folder}")
+    open(f"{source}/boot/vmlinuz", "w").close()
+    os.symlink("usr/lib", f"{source}/lib")
+
+    def root(args, cmd, suffix="native"):
+        cmd = [f"{native}{arg}" if arg.startswith("/mnt") else arg
+               for arg in cmd]
+        subprocess.run(cmd, check=True)
+
+    def bind(args, source, destination):
+        bound.append((source, destination))
+        os.makedirs(destination)
+
+    bound = []
+    monkeypatch.setattr(pmb.chroot, "root", root)
+    monkeypatch.setattr(pmb.helpers.mount, "bind", bind)
+    monkeypatch.setattr(pmb.helpers.mount, "umount_all",
+                        lambda args, folder: None)
+
+    # /boot is empty, /home is missing, folders get bind mounted
+    install_format = sys.modules["pmb.install.format"]
+    staging = install_format.populate_stage(args, "/mnt/rootfs_qemu-amd64")
+    staging_outside = f"{native}{staging}"
+    assert sorted(os.listdir(staging_outside)) == ["boot", "etc", "lib",
+                                                   "usr"]
+    assert os.listdir(f"{staging_outside}/boot") == []
+    assert os.readlink(f"{staging_outside}/lib") == "usr/lib"
+    assert bound == [(f"{source}/etc", f"{staging_outside}/etc"),
+                     (f"{source}/usr", f"{staging_outside}/usr")]
+
+    install_format.populate_stage_remove(args, staging)
+    assert not os.path.exists(staging_outside)
+    assert os.path.exists(f"{source}/boot/vmlinuz")
+
+
+def test_get_rootfs_size(tmpdir):
+    """ Files generated by triggers get added, package files in the scanned
+        folders are only counted once """
+    pmb.helpers.other.init_cache()
+    chroot = str(tmpdir)
+    args = argparse.Namespace()
+
+    def write(path, size):
+        os.makedirs(os.path.dirname(f"{chroot}/{path}"), exist_ok=True)
+        with open(f"{chroot}/{path}", "wb") as handle:
+            handle.write(b"x" * size)
+        return os.lstat(f"{chroot}/{path}").st_blocks * 512
+
+    # Package owns /etc/owned.conf and an icon, the trigger generates the
+    # icon cache
+    size_owned = write("etc/owned.conf", 8192)
+    size_owned += write("usr/share/icons/hicolor/icon.png", 8192)
+    size_cache = write("usr/share/icons/hicolor/icon-theme.cache", 20000)
+    size_generated = write("etc/generated.conf", 4096)
+    os.makedirs(f"{chroot}/lib/apk/db")
+    with open(f"{chroot}/lib/apk/db/installed", "w") as handle:
+        handle.write("C:Q1a=\nP:icons\nV:1-r0\nI:16384\n"
+                     "F:etc\nR:owned.conf\n"
+                     "F:usr/share/icons/hicolor\nR:icon.png\n\n")
+    with open(f"{chroot}/lib/apk/db/triggers", "w") as handle:
+        handle.write("Q1a= /usr/share/icons/*\n")
+
+    func = pmb.install._install.get_rootfs_size
+    folders = (pmb.helpers.other.folder_size_scandir(f"{chroot}/etc") +
+               pmb.helpers.other.folder_size_scandir(
+                   f"{chroot}/usr/share/icons/hicolor"))
+    assert folders == (size_owned + size_cache + size_generated) // 1024
+    assert func(args, chroot) == \
+        (16384 + 2 * 2048) // 1024 + (size_cache + size_generated) // 1024
+
@@ -0,0 +1,164 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import os
+import sys
+
+import pmb_test  # noqa
+import pmb.chroot
+import pmb.chroot.apk
+import pmb.config.pmaports
+import pmb.helpers.logging
+import pmb.helpers.mount
+import pmb.helpers.run
+import pmb.install
+import pmb.install._install
+import pmb.install.blockdevice
+import pmb.install.format
+import pmb.install.incremental
+
+
+def write_db(path, packages):
+    """ :param packages: list of (pkgname, version, checksum, {folder: files})
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as handle:
+        for pkgname, version, checksum, folders in packages:
+            handle.write(f"C:{checksum}\nP:{pkgname}\nV:{version}\nA:x86_64\n")
+            for folder, files in folders.items():
+                handle.write(f"F:{folder}\n")
+                for file in files:
+                    handle.write(f"R:{file}\na:0:0:755\nZ:Q1abc=\n")
+            handle.write("\n")
+
+
+def test_parse_installed_files(tmpdir):
+    path = f"{tmpdir}/lib/apk/db/installed"
+    write_db(path, [("hello", "1.0-r0", "Q1a=", {"usr/bin": ["hello"],
+                                                 "usr/share/hello": []}),
+                    ("musl", "1.2.4-r0", "Q1b=", {"lib": ["ld-musl.so.1"]})])
+    func = pmb.install.incremental.parse_installed_files
+
+    assert func(f"{tmpdir}/does-not-exist") == {}
+    assert func(path) == {
+        "hello": {"version": "1.0-r0",
+                  "checksum": "Q1a=",
+                  "folders": ["usr/bin", "usr/share/hello"],
+                  "files": ["usr/bin/hello"]},
+        "musl": {"version": "1.2.4-r0",
+                 "checksum": "Q1b=",
+                 "folders": ["lib"],
+                 "files": ["lib/ld-musl.so.1"]},
+    }
+
+
+def test_get_changes():
+    func = pmb.install.incremental.get_changes
+
+    def package(version, checksum, folders, files):
+        return {"version": version, "checksum": checksum, "folders": folders,
+                "files": files}
+
+    old = {"same": package("1-r0", "Q1a=", ["a"], ["a/same"]),
+           "rebuilt": package("1-r0", "Q1b=", ["b"], ["b/one", "b/two"]),
+           "removed": package("1-r0", "Q1c=", ["c"], ["c/removed", "b/two"]),
+           "moved": package("1-r0", "Q1d=", ["d"], ["d/moved"])}
+    new = {"same": package("1-r0", "Q1a=", ["a"], ["a/same"]),
+           "rebuilt": package("1-r0", "Q1B=", ["b"], ["b/one"]),
+           "added": package("2-r0", "Q1e=", ["e"], ["e/added", "d/moved"])}
+
+    (update, delete) = func(old, new)
+    assert update == ["b", "b/one", "d/moved", "e", "e/added"]
+    assert delete == ["b/two", "c/removed"]
+
+
+def test_get_trigger_folders(tmpdir):
+    func = pmb.install.incremental.get_trigger_folders
+    assert func(str(tmpdir)) == []
+
+    for folder in ["usr/share/icons/hicolor", "usr/share/icons/Adwaita",
+                   "usr/share/glib-2.0/schemas"]:
+        os.makedirs(f"{tmpdir}/{folder}")
+    os.makedirs(f"{tmpdir}/lib/apk/db")
+    with open(f"{tmpdir}/lib/apk/db/triggers", "w") as handle:
+        handle.write("Q1a= /usr/share/icons/*\n"
+                     "Q1b= /usr/share/glib-2.0/schemas /does/not/exist\n")
+
+    assert func(str(tmpdir)) == ["usr/share/glib-2.0/schemas",
+                                 "usr/share/icons/Adwaita",
+                                 "usr/share/icons/hicolor"]
+
+
+def test_install_system_image_rsync(monkeypatch, tmpdir):
+    """ Update an existing image file with --rsync: nothing gets formatted,
+        the partitions of the previous installation only get mounted """
+    pmb.helpers.logging.add_verbose_log_level()
+    args = argparse.Namespace(rsync=True, work=str(tmpdir),
+                              device="qemu-amd64", filesystem=None,
+                              full_disk_encryption=False, install_cgpt=False,
+                              mkfs_populate=False, sparse=False,
+                              deviceinfo={"boot_filesystem": "",
+                                          "cgpt_kpart": "",
+                                          "root_filesystem": ""})
+    install = pmb.install._install
+    commands = []
+    monkeypatch.setattr(pmb.chroot, "root",
+                        lambda args, cmd, *a, **k: commands.append(cmd))
+    monkeypatch.setattr(pmb.chroot, "shutdown", lambda args, only=False: None)
+    monkeypatch.setattr(pmb.chroot, "remove_mnt_pmbootstrap",
+                        lambda args, suffix: None)
+    monkeypatch.setattr(pmb.chroot.apk, "install",
+                        lambda args, packages: commands.append(packages))
+    monkeypatch.setattr(pmb.config.pmaports, "read_config",
+                        lambda args: {})
+    monkeypatch.setattr(pmb.helpers.run, "root", lambda args, cmd: None)
+    monkeypatch.setattr(pmb.helpers.mount, "umount_all",
+                        lambda args, folder: None)
+    monkeypatch.setattr(pmb.install.blockdevice, "image_fits",
+                        lambda args, layout, boot, root, split: True)
+    monkeypatch.setattr(pmb.install.blockdevice, "update",
+                        lambda args, split: commands.append("update"))
+    monkeypatch.setattr(pmb.install, "partitions_mount",
+                        lambda args, layout, disk: None)
+    monkeypatch.setattr(install, "get_subpartitions_size",
+                        lambda args, suffix: (128, 1024))
+    for func in ["create_fstab", "copy_files_from_chroot",
+                 "create_home_from_skel", "configure_apk", "copy_ssh_keys",
+                 "embed_firmware", "write_cgpt_kpart"]:
+        monkeypatch.setattr(install, func, lambda args, *a, **k: None)
+
+    install.install_system_image(args, 0, "rootfs_qemu-amd64", 1, 2)
+    assert args.rsync
+    assert commands == [
+        "update",
+        ["mkdir", "-p", "/mnt/install"],
+        ["mount", "/dev/installp2", "/mnt/install"],
+        ["mkdir", "-p", "/mnt/install/boot"],
+        ["mount", "/dev/installp1", "/mnt/install/boot"],
+        ["mkinitfs"]]
+
+
+def test_format_and_mount_boot_rsync_disk(monkeypatch):
+    """ --rsync only keeps the boot partition of an image file that gets
+        updated, with --disk it gets formatted like before """
+    args = argparse.Namespace(rsync=True,
+                              deviceinfo={"boot_filesystem": ""})
+    commands = []
+    monkeypatch.setattr(pmb.chroot, "root",
+                        lambda args, cmd, *a, **k: commands.append(cmd))
+    monkeypatch.setattr(pmb.chroot.apk, "install",
+                        lambda args, packages: commands.append(packages))
+    # pmb.install.format is shadowed by the format() function
+    func = sys.modules["pmb.install.format"].format_and_mount_boot
+
+    func(args, "/dev/installp1", "pmOS_boot", "/dev/sdX")
+    assert commands == [["e2fsprogs"],
+                        ["mkfs.ext2", "-F", "-q", "-L", "pmOS_boot",
+                         "/dev/installp1"],
+                        ["mkdir", "-p", "/mnt/install/boot"],
+                        ["mount", "/dev/installp1", "/mnt/install/boot"]]
+
+    commands.clear()
+    func(args, "/dev/installp1", "pmOS_boot")
+    assert commands == [["mkdir", "-p", "/mnt/install/boot"],
+                        ["mount", "/dev/installp1", "/mnt/install/boot"]]
@@ -3,12 +3,14 @@
 """ Test pmb.parse.apkindex """
 import collections
 import os
+import pickle
 import pytest
 import sys
 
 import pmb_test  # noqa
 import pmb.parse.apkindex
 import pmb.helpers.logging
+import pmb.helpers.other
 import pmb.helpers.repo
 
 
@@ -41,6 +43,34 @@ def test_parse_next_block_exceptions():
         assert error_substr in str(e.value)
 
 
+def test_block():
+    lines = ["P:curl\n", "V:7.57.0-r0\n", "A:x86_64\n", "D:so:libz.so.1\n",
+             "\n"]
+    block = pmb.parse.apkindex.parse_next_block("APKINDEX", lines, [0])
+    assert dict(block) == {"arch": "x86_64",
+                           "depends": ["so:libz.so.1"],
+                           "pkgname": "curl",
+                           "provides": [],
+                           "version": "7.57.0-r0"}
+    assert not hasattr(block, "__dict__")
+    assert block["pkgname"] is sys.intern("curl")
+
+    # Missing keys behave like in a dict
+    assert "timestamp" not in block
+    assert block.get("origin", "none") == "none"
+    with pytest.raises(KeyError):
+        block["invalid"]
+
+    # Read-only, modifying a returned list doesn't change the block
+    with pytest.raises(TypeError):
+        block["version"] = "1"
+    block["depends"].append("musl")
+    assert block["depends"] == ["so:libz.so.1"]
+
+    # Can be sent to other processes, see pmb.helpers.other.run_forked()
+    assert pickle.loads(pickle.dumps(block)) == block
+
+
 def test_parse_next_block_no_error():
     # Read the file
     func = pmb.parse.apkindex.parse_next_block
@@ -51,6 +81,7 @@ def test_parse_next_block_no_error():
     # First block
     start = [0]
     block = {'arch': 'x86_64',
+             'checksum': 'Q1gKkFdQUwKAmcUpGY8VaErq0uHNo=',
              'depends': [],
              'origin': 'musl',
              'pkgname': 'musl',
@@ -62,6 +93,7 @@ def test_parse_next_block_no_error():
 
     # Second block
     block = {'arch': 'x86_64',
+             'checksum': 'Q1iundrWyXyQtSTZ9h2qqh44cZcYA=',
              'depends': ['ca-certificates',
                          'so:libc.musl-x86_64.so.1',
                          'so:libcurl.so.4',
@@ -92,6 +124,7 @@ def test_parse_next_block_virtual():
     # First block
     start = [0]
     block = {'arch': 'x86_64',
+             'checksum': 'Q1XaZzCVZ9mvH8djPyEb5aUYhG3r4=',
              'depends': ['so:libc.musl-x86_64.so.1'],
              'origin': 'hello-world',
              'pkgname': 'hello-world',
@@ -103,6 +136,7 @@ def test_parse_next_block_virtual():
 
     # Second block: virtual package
     block = {'arch': 'noarch',
+             'checksum': 'Q127l1Ui9vzedbeR3BMelZnSa4pwY=',
              'depends': ['hello-world'],
              'pkgname': '.pmbootstrap',
              'provides': [],
@@ -129,6 +163,7 @@ def test_parse_next_block_conflict():
     # First block
     start = [0]
     block = {'arch': 'x86_64',
+             'checksum': 'Q1XaZzCVZ9mvH8djPyEb5aUYhG3r4=',
              'depends': ['!conflict', 'so:libc.musl-x86_64.so.1'],
              'origin': 'hello-world',
              'pkgname': 'hello-world',
@@ -239,6 +274,7 @@ def test_parse_cached(args, tmpdir):
 def test_parse():
     path = pmb.config.pmb_src + "/test/testdata/apkindex/no_error"
     block_musl = {'arch': 'x86_64',
+                  'checksum': 'Q1gKkFdQUwKAmcUpGY8VaErq0uHNo=',
                   'depends': [],
                   'origin': 'musl',
                   'pkgname': 'musl',
@@ -246,6 +282,7 @@ def test_parse():
                   'timestamp': '1515217616',
                   'version': '1.1.18-r5'}
     block_curl = {'arch': 'x86_64',
+                  'checksum': 'Q1iundrWyXyQtSTZ9h2qqh44cZcYA=',
                   'depends': ['ca-certificates',
                               'so:libc.musl-x86_64.so.1',
                               'so:libcurl.so.4',
@@ -282,6 +319,7 @@ def test_parse_virtual():
     """
     path = pmb.config.pmb_src + "/test/testdata/apkindex/virtual_package"
     block = {'arch': 'x86_64',
+             'checksum': 'Q1XaZzCVZ9mvH8djPyEb5aUYhG3r4=',
              'depends': ['so:libc.musl-x86_64.so.1'],
              'origin': 'hello-world',
              'pkgname': 'hello-world',
@@ -293,6 +331,45 @@ def test_parse_virtual():
     assert pmb.helpers.other.cache["apkindex"][path]["single"] == ret
 
 
+def test_parse_db(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    path = f"{tmpdir}/installed"
+    func = pmb.parse.apkindex.parse_db
+    assert func(path) == {}
+
+    def write(version, mtime):
+        with open(path, "w") as handle:
+            handle.write("C:Q1abc=\nP:musl\nV:1.1.18-r5\nA:x86_64\n"
+                         "t:1515217616\np:so:libc.musl-x86_64.so.1\n"
+                         "F:lib\nR:libc.musl-x86_64.so.1\nZ:Q1def=\n\n"
+                         f"C:Q1ghi=\nP:curl\nV:{version}\nA:x86_64\n"
+                         "t:1512030418\nD:musl\nF:usr/bin\nR:curl\n\n")
+        os.utime(path, ns=(0, mtime))
+
+    # Same result as parse(), but the file lists are not parsed
+    write("7.57.0-r0", 1)
+    ret = func(path)
+    assert ret == pmb.parse.apkindex.parse(path, False)
+    assert list(ret) == ["musl", "so:libc.musl-x86_64.so.1", "curl"]
+    assert ret["curl"]["depends"] == ["musl"]
+
+    # Cached
+    assert func(path) is ret
+
+    # Only the changed block gets parsed again
+    parsed = []
+    parse_next_block = pmb.parse.apkindex.parse_next_block
+    monkeypatch.setattr(pmb.parse.apkindex, "parse_next_block",
+                        lambda path, lines, start: parsed.append(lines) or
+                        parse_next_block(path, lines, start))
+    write("7.58.0-r0", 2)
+    ret_new = func(path)
+    assert len(parsed) == 1
+    assert ret_new["curl"]["version"] == "7.58.0-r0"
+    assert ret_new["musl"] is ret["musl"]
+
+
 def test_providers_invalid_package(args, tmpdir):
     # Create empty APKINDEX
     path = str(tmpdir) + "/APKINDEX"
@@ -1,15 +1,22 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 """ Test pmb.helper.pkgrel_bump """
+import argparse
 import glob
+import json
 import os
 import pytest
 import sys
 
 import pmb_test  # noqa
 import pmb_test.git
+import pmb_test.repo
+import pmb.config.pmaports
+import pmb.helpers.completion
 import pmb.helpers.pkgrel_bump
 import pmb.helpers.logging
+import pmb.helpers.other
+import pmb.helpers.repo
 
 
 @pytest.fixture
@@ -169,3 +176,41 @@ def test_pkgrel_bump_high_level(args, tmpdir):
     # Clean up
     pmbootstrap(args, tmpdir, ["shutdown"])
     pmb.helpers.run.root(args, ["rm", "-rf", tmpdir])
+
+
+def test_auto(monkeypatch, tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    args = argparse.Namespace(work=f"{tmpdir}/work", aports=f"{tmpdir}/pma",
+                              ignore_depends=False)
+    monkeypatch.setattr(pmb.config.pmaports, "read_config",
+                        lambda args: {"channel": "edge"})
+    monkeypatch.setattr(pmb.helpers.completion, "update",
+                        lambda args, apkbuilds: None)
+    monkeypatch.setattr(pmb.helpers.repo, "urls", lambda *args: [])
+    monkeypatch.setattr(pmb.config, "build_device_architectures",
+                        ["x86_64", "armhf"])
+    for pkgname in ["testlib", "testapp"]:
+        os.makedirs(f"{args.aports}/main/{pkgname}")
+        with open(f"{args.aports}/main/{pkgname}/APKBUILD", "w") as handle:
+            handle.write(f"pkgname={pkgname}\npkgver=1\npkgrel=0\n")
+
+    # testapp was linked against an older soname of testlib and depends on a
+    # package that was removed from pmaports. The conflict and the versioned
+    # dependency on testlib are fine.
+    depends = ["so:libtestlib.so.1", "testlib>=1", "!testlib-old", "gone"]
+    for arch in ["x86_64", "armhf"]:
+        pmb_test.repo.write(f"{args.work}/packages/edge/{arch}", [
+            ("testlib", "1-r0", "testlib", b"a"),
+            ("testapp", "1-r0", "testapp", b"b", depends)], 1)
+
+    report = f"{tmpdir}/report.json"
+    assert pmb.helpers.pkgrel_bump.auto(args, report=report) == ["testapp"]
+    missing = {"pkgname": "testapp", "origin": "testapp", "version": "1-r0",
+               "missing": ["gone", "so:libtestlib.so.1"]}
+    with open(report) as handle:
+        assert json.load(handle) == {"x86_64": [missing], "armhf": [missing]}
+
+    # Bumped only once
+    with open(f"{args.aports}/main/testapp/APKBUILD") as handle:
+        assert "\npkgrel=1\n" in handle.read()
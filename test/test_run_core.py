@@ -1,13 +1,17 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 """ Test pmb.helpers.run_core """
+import argparse
+import os
 import pytest
 import re
+import signal
 import subprocess
 import sys
 import time
 
 import pmb_test  # noqa
+import pmb.helpers.logging
 import pmb.helpers.run_core
 
 
@@ -122,6 +126,39 @@ def test_foreground_pipe(args):
     assert len(child_procs) == 0
 
 
+def test_get_process_tree():
+    cmd = ["sh", "-c", "sleep 10 | sleep 11"]
+    process = subprocess.Popen(cmd, start_new_session=True)
+    time.sleep(0.3)
+    try:
+        tree = pmb.helpers.run_core.get_process_tree(process.pid)
+        assert tree[0] == process.pid
+        assert len(tree) == 3
+        for pid in tree:
+            assert pmb.helpers.run_core.get_process_group(pid) == process.pid
+    finally:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    assert pmb.helpers.run_core.get_process_group(process.pid) is None
+
+
+def test_foreground_pipe_session(monkeypatch, tmpdir):
+    """ Only root commands with timeout run in their own session, other
+        commands (e.g. ssh asking for a password) keep the terminal """
+    func = pmb.helpers.run_core.foreground_pipe
+    args = argparse.Namespace(timeout=10)
+    logfd = open(f"{tmpdir}/log.txt", "a+")
+    monkeypatch.setattr(pmb.helpers.logging, "logfd", logfd)
+    cmd = ["sh", "-c", "cut -d ' ' -f 6 /proc/$$/stat"]
+    try:
+        code, sid = func(args, cmd, output_return=True, sudo=False)
+        assert int(sid) == os.getsid(0)
+        code, sid = func(args, cmd, output_return=True, sudo=True)
+        assert int(sid) != os.getsid(0)
+    finally:
+        logfd.close()
+
+
 def test_foreground_tui():
     func = pmb.helpers.run_core.foreground_tui
     assert func(["echo", "test"]) == 0
@@ -158,6 +195,29 @@ def test_core(args, monkeypatch):
     assert re.search(r"^Command failed \(exit code -?\d*\): ", str(e.value))
 
 
+@pytest.mark.skip_ci
+def test_foreground_pipe_benchmark(args, tmpdir):
+    """ Copy 1 GB of compiler-like output to the log and print the speed """
+    size = 1000 * 1000 * 1000
+    log = f"{tmpdir}/log.txt"
+    logfd = pmb.helpers.logging.logfd
+    pmb.helpers.logging.logfd = open(log, "a+")
+    cmd = ["sh", "-c", "yes 'gcc -O2 -Wall -c src/file.c -o build/file.o'"
+           f" | head -c {size}"]
+    args.timeout = 60
+    try:
+        time_start = time.perf_counter()
+        assert pmb.helpers.run_core.foreground_pipe(args, cmd) == (0, "")
+        duration = time.perf_counter() - time_start
+    finally:
+        pmb.helpers.logging.logfd.close()
+        pmb.helpers.logging.logfd = logfd
+
+    assert os.path.getsize(log) == size
+    os.unlink(log)
+    print(f"foreground_pipe: {size / 1024 / 1024 / duration:.0f} MiB/s")
+
+
 @pytest.mark.skip_ci
 def test_sudo_timer(args):
     pmb.helpers.run.root(args, ["whoami"])
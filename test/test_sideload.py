@@ -0,0 +1,140 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
+import hashlib
+import pytest
+
+import pmb_test  # noqa
+import pmb.helpers.logging
+import pmb.helpers.other
+import pmb.helpers.run
+import pmb.parse.apkindex
+import pmb.sideload
+
+
+def test_ssh_options():
+    args = argparse.Namespace(work="/work")
+    func = pmb.sideload.ssh_options
+    assert func(args, True) == ["-o", "ControlMaster=auto",
+                                "-o", "ControlPath=/work/ssh/%C",
+                                "-o", "ControlPersist=60"]
+    assert func(args, False)[-2:] == ["-o", "BatchMode=yes"]
+
+
+def test_ssh_install_apks(monkeypatch, tmpdir):
+    args = argparse.Namespace(work=str(tmpdir))
+    paths = []
+    for name in ["hello-world-1-r0.apk", "hello-world-wrapper-1-r0.apk"]:
+        paths += [f"{tmpdir}/{name}"]
+        with open(paths[-1], "w") as handle:
+            handle.write(name)
+    checksums = pmb.sideload.get_checksums(paths)
+    assert checksums["hello-world-1-r0.apk"] == \
+        hashlib.sha256(b"hello-world-1-r0.apk").hexdigest()
+
+    # Target device has the first package already, the second one with a
+    # different checksum and an old package from a previous sideload
+    ssh_commands = []
+
+    def ssh(args, user, host, port, remote_cmd, interactive, tty=False,
+            output_return=False):
+        ssh_commands.append(remote_cmd)
+        if output_return:
+            return (f"{checksums['hello-world-1-r0.apk']}"
+                    "  hello-world-1-r0.apk\n"
+                    f"{'0' * 64}  hello-world-wrapper-1-r0.apk\n"
+                    f"{'1' * 64}  old-1-r0.apk\n")
+    monkeypatch.setattr(pmb.sideload, "ssh", ssh)
+
+    scp_calls = []
+
+    def scp(args, user, host, port, paths, target, interactive):
+        scp_calls.append((paths, target))
+    monkeypatch.setattr(pmb.sideload, "scp", scp)
+
+    func = pmb.sideload.ssh_install_apks
+    copied = func(args, "user", "host", "22", paths, checksums, False)
+    assert copied == [paths[1]]
+    assert scp_calls == [([paths[1]], pmb.sideload.remote_dir)]
+
+    remote_dir = pmb.sideload.remote_dir
+    assert ssh_commands[-1] == (
+        f"rm -f {remote_dir}/old-1-r0.apk;"
+        f" sudo -n apk --wait 30 add {remote_dir}/hello-world-1-r0.apk"
+        f" {remote_dir}/hello-world-wrapper-1-r0.apk &&"
+        f" rm -rf {remote_dir}")
+
+
+def write_index(path, packages):
+    """ :param packages: list of (pkgname, version, checksum, depends,
+                         provides) """
+    with open(path, "w") as handle:
+        for pkgname, version, checksum, depends, provides in packages:
+            handle.write(f"C:{checksum}\nP:{pkgname}\nV:{version}\n"
+                         "A:aarch64\nt:1700000000\n")
+            if depends:
+                handle.write(f"D:{depends}\n")
+            if provides:
+                handle.write(f"p:{provides}\n")
+            handle.write("\n")
+
+
+def test_get_install_blocks(tmpdir):
+    pmb.helpers.logging.add_verbose_log_level()
+    pmb.helpers.other.init_cache()
+    index = f"{tmpdir}/APKINDEX"
+    write_index(index, [
+        ("hello-world", "2-r0", "Q1new=", "libhello so:libc.musl-aarch64.so.1",
+         "cmd:hello-world"),
+        ("hello-world-wrapper", "1-r0", "Q1same=", "hello-world", ""),
+        ("libhello", "1-r0", "Q1lib=", "!hello-conflict", ""),
+        ("unrelated", "1-r0", "Q1unrelated=", "", "")])
+    write_index(f"{tmpdir}/installed", [
+        ("hello-world", "2-r0", "Q1old=", "so:libc.musl-aarch64.so.1", ""),
+        ("hello-world-wrapper", "1-r0", "Q1same=", "hello-world", ""),
+        ("musl", "1.2.4-r2", "Q1musl=", "", "so:libc.musl-aarch64.so.1")])
+    installed = pmb.parse.apkindex.parse(f"{tmpdir}/installed", False)
+    func = pmb.sideload.get_install_blocks
+
+    # Same version but different checksum: install again, with the missing
+    # dependency from the local repository. The wrapper is up-to-date.
+    blocks = func(None, installed, ["hello-world", "hello-world-wrapper"],
+                  "aarch64", index)
+    assert [(b["pkgname"], b["version"]) for b in blocks] == [
+        ("hello-world", "2-r0"), ("libhello", "1-r0")]
+
+    # Nothing to do
+    assert func(None, installed, ["hello-world-wrapper"], "aarch64",
+                index) == []
+
+    # Requested package not in the local repository
+    with pytest.raises(RuntimeError) as e:
+        func(None, installed, ["does-not-exist"], "aarch64", index)
+    assert "not found in the local repository" in str(e.value)
+
+
+def test_sideload_host_connect(monkeypatch):
+    """ With one host, the connection gets opened interactively first """
+    args = argparse.Namespace(work="/work")
+    calls = []
+    monkeypatch.setattr(pmb.sideload, "ssh_connect",
+                        lambda args, user, host, port:
+                        calls.append("connect"))
+    monkeypatch.setattr(pmb.sideload, "get_installed",
+                        lambda args, user, host, port, interactive:
+                        calls.append(("installed", interactive)) or {})
+    monkeypatch.setattr(pmb.sideload, "get_install_blocks",
+                        lambda args, installed, pkgnames, arch, index: [])
+    monkeypatch.setattr(pmb.helpers.run, "user",
+                        lambda args, cmd, check=None: calls.append(cmd[-3]))
+
+    func = pmb.sideload.sideload_host
+    ret = func(args, "user", "host", "22", False, ["hello-world"], "aarch64",
+               "/work/packages/edge/aarch64/APKINDEX.tar.gz", {}, True)
+    assert calls == ["connect", ("installed", True), "-O"]
+    assert ret["installed"] == 0
+
+    calls.clear()
+    func(args, "user", "host", "22", False, ["hello-world"], "aarch64",
+         "/work/packages/edge/aarch64/APKINDEX.tar.gz", {}, False)
+    assert calls == [("installed", False), "-O"]